@@ -0,0 +1,115 @@
+# Micro-benchmark of command routing with 1k-10k learned skills: the old
+# linear scan (each registry entry, then a substring check per skill) against
+# the compiled CommandDispatcher. Also prints which route wins for a few
+# commands that the first-match order used to misroute.
+#
+# Usage: python benchmarks/bench_dispatcher.py [--sizes 1000 5000 10000]
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from main import (CommandDispatcher, RE_LEARN_EN, RE_OPEN_EN, RE_CLOSE_EN, RE_SEARCH_GOOGLE_EN,  # noqa: E402
+                  RE_YOUTUBE_EN, RE_SPOTIFY_EN, RE_CALCULATE_EN)
+
+
+def handler(name):
+    def run(command):
+        return name
+    run.__name__ = name
+    return run
+
+
+REGISTRY = [
+    {'regex': RE_LEARN_EN, 'handler': handler('learn'), 'priority': 100},
+    {'regex': RE_OPEN_EN, 'handler': handler('open')},
+    {'regex': RE_CLOSE_EN, 'handler': handler('close')},
+    {'regex': RE_SEARCH_GOOGLE_EN, 'handler': handler('google')},
+    {'regex': RE_YOUTUBE_EN, 'handler': handler('youtube')},
+    {'regex': RE_SPOTIFY_EN, 'handler': handler('spotify')},
+    {'regex': RE_CALCULATE_EN, 'handler': handler('calculate')},
+    {'keywords': ['system status', 'system information'], 'handler': handler('system_status')},
+    {'keywords': ['screenshot', 'take a screenshot'], 'handler': handler('screenshot')},
+    {'keywords': ['pause', 'play', 'next song', 'previous song', 'media control'], 'handler': handler('media')},
+    {'keywords': ['volume up', 'volume down', 'mute'], 'handler': handler('volume')},
+    {'keywords': ['translator to', 'translate to'], 'handler': handler('translator')},
+    {'keywords': ['take a note', 'write a note'], 'handler': handler('note_start')},
+    {'keywords': ['end note', 'finish note'], 'handler': handler('note_end')},
+]
+VERBS = ["create", "delete", "rename", "archive", "backup", "zip", "clean", "sort", "email", "print"]
+OBJECTS = ["report", "folder", "invoice", "photo album", "playlist", "spreadsheet", "desktop icons", "downloads"]
+
+
+def make_skills(count):
+    rng = random.Random(7)
+    skills = {}
+    while len(skills) < count:
+        key = f"{rng.choice(VERBS)} the {rng.choice(OBJECTS)} {rng.randint(0, 10 ** 6)}"
+        skills[key] = f"skill_{len(skills)}.py"
+    return skills
+
+
+def linear_route(registry, skills, clean_command):
+    for cmd_data in registry:
+        if ('regex' in cmd_data and cmd_data['regex'].search(clean_command)) or \
+           ('keywords' in cmd_data and any(kw in clean_command for kw in cmd_data['keywords'])):
+            return cmd_data['handler'].__name__
+    for skill_key in skills:
+        if skill_key in clean_command:
+            return skill_key
+    return None
+
+
+def dispatcher_route(dispatcher, clean_command):
+    match = dispatcher.match(clean_command)
+    if match is None:
+        return None
+    return match.route['skill_key'] if match.route['kind'] == 'skill' else match.route['handler'].__name__
+
+
+def per_call_us(fn, commands, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for command in commands:
+            fn(command)
+    return (time.perf_counter() - start) / (repeat * len(commands)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 10000])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    print("--- Routing of ambiguous commands (before -> after) ---")
+    dispatcher = CommandDispatcher(REGISTRY)
+    for command in ["play a video about black holes", "what is the system status", "play the next song", "pause the music please", "learn to open notepad and type hello"]:
+        print(f"{command!r}: {linear_route(REGISTRY, {}, command)} -> {dispatcher_route(dispatcher, command)}")
+
+    for size in args.sizes:
+        skills = make_skills(size)
+        keys = list(skills)
+        commands = [f"please {keys[i]} now" for i in range(0, size, max(size // 20, 1))]
+        commands += ["tell me a joke about computers", "how tall is the eiffel tower"]  # LLM fallbacks
+
+        start = time.perf_counter()
+        dispatcher = CommandDispatcher(REGISTRY, skills)
+        dispatcher.match("warm up")
+        build_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        dispatcher.add_skill("defragment the spare drive", "skill_new.py")
+        dispatcher.match("warm up")
+        add_ms = (time.perf_counter() - start) * 1000
+
+        before = per_call_us(lambda c: linear_route(REGISTRY, skills, c), commands, args.repeat)
+        after = per_call_us(lambda c: dispatcher_route(dispatcher, c), commands, args.repeat)
+        print(f"--- {size} skills --- build {build_ms:.1f} ms | add one skill {add_ms:.1f} ms")
+        print(f"before: linear scan        {before:9.1f} us/command")
+        print(f"after: CommandDispatcher   {after:9.1f} us/command ({before / after:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,502 @@
+# End-to-end turn latency of a headless VirtualAssistant: no Tk window, no
+# microphone, no speaker and no network. The assistant runs in a temporary
+# working directory with local stand-ins:
+#   - WAV fixtures streamed in real time through AudioCapture instead of sr.Microphone
+#   - stub_gemini_server.py for Gemini, with latency, streamed words, 429s and 500s
+#   - recognize_google and GoogleTranslator replaced by fixed-latency fakes
+#   - a fake pyttsx3 engine that "speaks" at a fixed number of characters per second
+#
+# Every scenario is run --runs times and p50/p95/p99 are reported per stage:
+#   wake         end of the wake phrase -> wake word detected (negative when the
+#                matcher fires before the last syllable has been played)
+#   stt          end of the command -> transcript (endpointing + recognizer)
+#   process      transcript -> process_command returned
+#   llm_first    request sent -> first streamed word (LLM scenario)
+#   first_audio  end of the command -> first utterance starts playing
+#   turn         end of the command -> last utterance finished
+#
+# Scenarios: wake_word (wake phrase + built-in command), builtin (push-to-talk
+# calculation), skill (a learned skill), llm (streamed Gemini chat) and
+# translator (a phrase in translator mode).
+#
+# Fixtures are synthesized (see bench_wake_word.py) unless --fixtures points to
+# a directory with recordings: wake_take1..3.wav (enrollment), wake.wav, and
+# <name>.wav plus <name>.txt (its transcript) for each command below.
+#
+# Usage: python benchmarks/bench_e2e.py [--runs 10] [--scenarios llm skill]
+#        [--llm-latency 0.4] [--rate-limit 0.05] [--failure-rate 0.02]
+
+import argparse
+import glob
+import json
+import logging
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+import wave
+
+import numpy as np
+import speech_recognition as sr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main as assistant_main  # noqa: E402
+from main import AudioCapture, TemplateWakeWord, VirtualAssistant  # noqa: E402
+from bench_wake_word import DISTRACTOR, HEY_ASSISTANT, synthesize, to_pcm  # noqa: E402
+from stub_gemini_server import StubGeminiServer  # noqa: E402
+
+RATE = AudioCapture.SAMPLE_RATE
+COMMANDS = {
+    'builtin': "calculate 12 x 7",
+    'wake_command': "calculate 3 x 5",
+    'skill': "say hello",
+    'llm': "tell me about the moon",
+    'translator': "good morning",
+}
+SKILL_CODE = 'print("Hello from a learned skill")\n'
+REPLY = ("The Moon is Earth's only natural satellite. It is about 384,000 kilometres away. "
+         "Its gravity drives the tides, and the same side always faces us.")
+STAGES = ('wake', 'stt', 'process', 'llm_first', 'first_audio', 'turn')
+
+
+class Clip:
+    def __init__(self, samples, transcript=""):
+        self.samples = samples
+        self.transcript = transcript
+        self.ended = threading.Event()
+        self.ended_at = None
+
+
+class FixtureMicrophone:
+    """Stands in for sr.Microphone: plays queued clips in real time, with quiet noise in between."""
+
+    def __init__(self, noise=0.003, seed=0):
+        self.stream = self
+        self.clips = queue.Queue()
+        self.last_transcript = ""
+        self._rng = np.random.default_rng(seed)
+        self._noise = noise
+        self._current, self._offset = None, 0
+        self._next_due = None
+
+    def __enter__(self):
+        self._next_due = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def play(self, clip):
+        self.clips.put(clip)
+        return clip
+
+    def read(self, size):
+        # A real device hands a chunk over once it has been recorded.
+        self._next_due += size / RATE
+        delay = self._next_due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        chunk = to_pcm(self._rng.normal(0, self._noise, size))
+        filled = 0
+        while filled < size:
+            if self._current is None:
+                try:
+                    self._current, self._offset = self.clips.get_nowait(), 0
+                except queue.Empty:
+                    break
+            take = min(size - filled, len(self._current.samples) - self._offset)
+            chunk[filled:filled + take] = self._current.samples[self._offset:self._offset + take]
+            filled += take
+            self._offset += take
+            if self._offset >= len(self._current.samples):
+                clip, self._current = self._current, None
+                clip.ended_at = time.perf_counter()
+                self.last_transcript = clip.transcript
+                clip.ended.set()
+        return chunk.tobytes()
+
+
+class FixtureRecognizer(sr.Recognizer):
+    """Real endpointing from sr.Recognizer.listen; "recognition" returns the fixture's transcript."""
+
+    def __init__(self, microphone, latency, template):
+        super().__init__()
+        self.microphone = microphone
+        self.latency = latency
+        for name in ('energy_threshold', 'dynamic_energy_threshold', 'pause_threshold'):
+            setattr(self, name, getattr(template, name))
+
+    def recognize_google(self, audio_data, key=None, language="en-US", **kwargs):
+        time.sleep(self.latency)
+        transcript, self.microphone.last_transcript = self.microphone.last_transcript, ""
+        if not transcript:
+            raise sr.UnknownValueError()
+        return transcript
+
+
+class StubTranslator:
+    latency = 0.15
+
+    def __init__(self, source='auto', target='en'):
+        self.target = target
+
+    def translate(self, text):
+        time.sleep(self.latency)
+        return f"[{self.target}] {text}"
+
+
+class FakeEngine:
+    """pyttsx3-like engine: each utterance starts after start_delay and lasts len(text) / chars_per_second."""
+
+    def __init__(self, timeline, chars_per_second=40.0, start_delay=0.03):
+        self.timeline = timeline
+        self.chars_per_second = chars_per_second
+        self.start_delay = start_delay
+        self.properties = {'rate': 160, 'voice': 'fake', 'voices': []}
+        self.callbacks = {}
+        self.current = None
+
+    def connect(self, topic, callback):
+        self.callbacks[topic] = callback
+
+    def startLoop(self, use_driver_loop=True):
+        pass
+
+    def endLoop(self):
+        pass
+
+    def getProperty(self, name):
+        return self.properties.get(name)
+
+    def setProperty(self, name, value):
+        self.properties[name] = value
+
+    def say(self, text):
+        said_at = time.perf_counter()
+        self.current = [text, said_at + self.start_delay, said_at + self.start_delay + len(text) / self.chars_per_second, False]
+
+    def iterate(self):
+        if not self.current:
+            return
+        text, starts_at, ends_at, started = self.current
+        now = time.perf_counter()
+        if not started and now >= starts_at:
+            self.current[3] = True
+            self.timeline.mark('first_audio', once=True)
+            self.callbacks['started-utterance']()
+        if now >= ends_at:
+            self.current = None
+            self.timeline.mark('audio_end')
+            self.callbacks['finished-utterance'](completed=True)
+
+    def stop(self):
+        if self.current:
+            self.current = None
+            self.callbacks['finished-utterance'](completed=False)
+
+
+class Timeline:
+    """Timestamps of the current turn."""
+
+    def __init__(self):
+        self.events = {}
+
+    def reset(self):
+        self.events = {}
+
+    def mark(self, name, once=False, at=None):
+        if once and name in self.events:
+            return
+        self.events[name] = at or time.perf_counter()
+
+    def since(self, start, end):
+        if start in self.events and end in self.events:
+            return self.events[end] - self.events[start]
+        return None
+
+
+class ImmediateRoot:
+    def after(self, delay, callback, *args):
+        callback(*args)
+
+
+class HeadlessApp:
+    """The parts of App that VirtualAssistant calls back into."""
+
+    def __init__(self, bench):
+        self.bench = bench
+        self.root = ImmediateRoot()
+        self.is_listening_continuously = False
+        self.chat = []
+
+    def add_text_to_chat(self, text, is_assistant=True, tag=None):
+        self.chat.append((tag or ('assistant' if is_assistant else 'user'), text))
+
+    def show_partial_transcript(self, text):
+        pass
+
+    def clear_partial_transcript(self):
+        pass
+
+    def begin_stream_message(self):
+        return "stream"
+
+    def append_stream_text(self, stream_id, text):
+        self.bench.timeline.mark('llm_first', once=True)
+
+    def end_stream_message(self, stream_id, full_text):
+        self.chat.append(('assistant', full_text))
+
+    def ask_user_confirmation(self, message):
+        return False
+
+    def _on_speech_finished(self):
+        pass
+
+    def _on_wake_word_detected(self):
+        self.bench.timeline.mark('wake', once=True)
+        threading.Thread(target=self.bench.voice_turn, args=(True,), daemon=True).start()
+
+    def _toggle_wake_word(self):
+        self.is_listening_continuously = False
+
+
+class HeadlessAssistant(VirtualAssistant):
+    def __init__(self, app, microphone, stt_latency, timeline, chars_per_second):
+        self.fixture_microphone = microphone
+        self.stt_latency = stt_latency
+        self.timeline = timeline
+        self.chars_per_second = chars_per_second
+        super().__init__(app)
+
+    def _open_audio_stream(self):
+        return self.fixture_microphone
+
+    def _create_tts_engine(self):
+        return FakeEngine(self.timeline, self.chars_per_second)
+
+    def _init_speech_backends(self):
+        self.recognizer = FixtureRecognizer(self.fixture_microphone, self.stt_latency, self.recognizer)
+        super()._init_speech_backends()
+
+
+def read_wav(path):
+    with wave.open(path, 'rb') as wav:
+        assert wav.getframerate() == RATE and wav.getsampwidth() == 2 and wav.getnchannels() == 1, path
+        return np.frombuffer(wav.readframes(wav.getnframes()), dtype='<i2')
+
+
+def write_wav(path, samples):
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(RATE)
+        wav.writeframes(samples.astype('<i2').tobytes())
+
+
+def make_fixtures(directory, seed):
+    """Writes synthesized fixtures in the --fixtures layout."""
+    rng = np.random.default_rng(seed)
+    for take, (f0, speed) in enumerate(((120, 1.0), (135, 0.9), (150, 1.1)), start=1):
+        write_wav(os.path.join(directory, f"wake_take{take}.wav"), to_pcm(synthesize(HEY_ASSISTANT, rng, f0=f0, speed=speed)))
+    write_wav(os.path.join(directory, "wake.wav"), to_pcm(synthesize(HEY_ASSISTANT, rng, f0=140, speed=0.95)))
+    for index, (name, transcript) in enumerate(COMMANDS.items()):
+        # Commands are a few "words" long; the speed keeps each under two seconds.
+        segments = DISTRACTOR * (1 + len(transcript.split()) // 3)
+        write_wav(os.path.join(directory, f"{name}.wav"), to_pcm(synthesize(segments, rng, f0=110 + 10 * index, speed=1.3)))
+        with open(os.path.join(directory, f"{name}.txt"), 'w', encoding='utf-8') as f:
+            f.write(transcript)
+
+
+def load_fixtures(directory):
+    fixtures = {'wake_takes': [read_wav(path) for path in sorted(glob.glob(os.path.join(directory, "wake_take*.wav")))],
+                'wake': read_wav(os.path.join(directory, "wake.wav"))}
+    for name in COMMANDS:
+        with open(os.path.join(directory, f"{name}.txt"), encoding='utf-8') as f:
+            fixtures[name] = (read_wav(os.path.join(directory, f"{name}.wav")), f.read().strip())
+    return fixtures
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered) + 0.5)) - 1))]
+
+
+class Bench:
+    def __init__(self, args, fixtures, workdir):
+        self.args = args
+        self.fixtures = fixtures
+        self.timeline = Timeline()
+        self.results = {}
+        self.turn_done = threading.Event()
+        self.microphone = FixtureMicrophone(seed=args.seed)
+        self.app = HeadlessApp(self)
+        os.makedirs(os.path.join(workdir, VirtualAssistant.WAKE_TEMPLATES_DIR, "en"))
+        TemplateWakeWord.enroll(os.path.join(workdir, VirtualAssistant.WAKE_TEMPLATES_DIR, "en"), fixtures['wake_takes'])
+        os.makedirs(os.path.join(workdir, VirtualAssistant.SKILLS_DIR))
+        with open(os.path.join(workdir, VirtualAssistant.SKILLS_DIR, "skill_say_hello.py"), 'w', encoding='utf-8') as f:
+            f.write(SKILL_CODE)
+        with open(os.path.join(workdir, VirtualAssistant.SKILLS_REGISTRY), 'w', encoding='utf-8') as f:
+            json.dump({COMMANDS['skill']: "skill_say_hello.py"}, f)
+        with open(os.path.join(workdir, VirtualAssistant.CONFIG_FILE), 'w', encoding='utf-8') as f:
+            json.dump({"api_key": "bench-key", "wake_word_enabled": False, "wake_word_backend": "template",
+                       "speech_backend": "google", "tts_phrase_cache": False, "response_cache_enabled": False}, f)
+        self.server = StubGeminiServer(reply_text=REPLY, latency=args.llm_latency, jitter=args.llm_jitter,
+                                       word_interval=args.word_interval, rate_limit_rate=args.rate_limit,
+                                       failure_rate=args.failure_rate, seed=args.seed).start()
+        assistant_main.deep_translator = types.SimpleNamespace(GoogleTranslator=StubTranslator)
+        StubTranslator.latency = args.translate_latency
+        start = time.perf_counter()
+        self.assistant = HeadlessAssistant(self.app, self.microphone, args.stt_latency, self.timeline, args.speech_cps)
+        self.startup = time.perf_counter() - start
+        self.assistant.gemini.api_root = self.server.api_root
+        stream_text = self.assistant.gemini.stream_text
+
+        def timed_stream_text(payload, timeout=None):
+            self.timeline.mark('llm_start', once=True)
+            yield from stream_text(payload, timeout)
+        self.assistant.gemini.stream_text = timed_stream_text
+
+    def voice_turn(self, after_wake_word):
+        """What App does for a voice command, minus the widgets."""
+        try:
+            command = self.assistant.listen_for_command(after_wake_word=after_wake_word)
+            self.timeline.mark('transcript')
+            response = self.assistant.process_command(command)
+            self.timeline.mark('processed')
+            if response:
+                self.assistant.say_text(response)
+            while self.assistant.tts.busy:
+                time.sleep(0.005)
+        finally:
+            self.turn_done.set()
+
+    def run_turn(self, name, clip_names):
+        self.timeline.reset()
+        self.turn_done.clear()
+        clips = []
+        for clip_name in clip_names:
+            samples, transcript = (self.fixtures[clip_name], "") if clip_name == 'wake' else self.fixtures[clip_name]
+            clips.append(self.microphone.play(Clip(samples, transcript)))
+            if clip_name == 'wake':
+                self.microphone.play(Clip(np.zeros(int(0.2 * RATE), dtype=np.int16)))
+        if clip_names[0] != 'wake':
+            threading.Thread(target=self.voice_turn, args=(False,), daemon=True).start()
+        if not self.turn_done.wait(self.args.turn_timeout):
+            print(f"  {name}: turn timed out, events {sorted(self.timeline.events)}")
+            self.assistant.interrupt_speech()
+            return
+        command_clip = clips[-1]
+        command_clip.ended.wait(1)
+        if command_clip.ended_at:
+            self.timeline.mark('speech_end', at=command_clip.ended_at)
+        if clip_names[0] == 'wake' and clips[0].ended_at:
+            self.timeline.mark('wake_end', at=clips[0].ended_at)
+        stages = {
+            'wake': self.timeline.since('wake_end', 'wake'),
+            'stt': self.timeline.since('speech_end', 'transcript'),
+            'process': self.timeline.since('transcript', 'processed'),
+            'llm_first': self.timeline.since('llm_start', 'llm_first'),
+            'first_audio': self.timeline.since('speech_end', 'first_audio'),
+            'turn': self.timeline.since('speech_end', 'audio_end'),
+        }
+        for stage, value in stages.items():
+            if value is not None:
+                self.results.setdefault(name, {}).setdefault(stage, []).append(value)
+        time.sleep(self.args.gap)
+
+    def scenario(self, name):
+        print(f"Running {name} x{self.args.runs}...")
+        if name == 'wake_word':
+            self.app.is_listening_continuously = True
+            self.assistant.wake_word_thread = threading.Thread(target=self.assistant.run_wake_word_loop, daemon=True)
+            self.assistant.wake_word_thread.start()
+            time.sleep(0.5)
+            for _ in range(self.args.runs):
+                self.run_turn(name, ['wake', 'wake_command'])
+            self.app.is_listening_continuously = False
+            self.assistant.wake_word_thread.join(2)
+        elif name == 'translator':
+            self.assistant.process_command("translate to french")
+            for _ in range(self.args.runs):
+                self.run_turn(name, ['translator'])
+            self.assistant.process_command("exit translator mode")
+        else:
+            for _ in range(self.args.runs):
+                self.run_turn(name, [name])
+
+    def report(self):
+        print(f"\nStartup (VirtualAssistant.__init__): {self.startup * 1000:.0f} ms")
+        print(f"{'scenario':<11} {'stage':<12} {'n':>3} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+        for name, stages in self.results.items():
+            for stage in STAGES:
+                values = stages.get(stage)
+                if values:
+                    print(f"{name:<11} {stage:<12} {len(values):>3} {percentile(values, 50) * 1000:9.1f} "
+                          f"{percentile(values, 95) * 1000:9.1f} {percentile(values, 99) * 1000:9.1f}")
+        print(f"\nGemini stub: {self.server.request_count} requests, status counts {self.server.status_counts}")
+        print(f"TTS: {self.assistant.tts.latency_summary()}")
+
+    def close(self):
+        assistant = self.assistant
+        assistant.is_running = False
+        assistant.tts.close()
+        assistant.audio_capture.stop()
+        assistant.fact_queue.close()
+        if assistant.memory:
+            assistant.memory.close()
+        assistant.gemini.close()
+        if assistant.skill_pool:
+            assistant.skill_pool.close()
+        self.server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--scenarios', nargs='+', default=['wake_word', 'builtin', 'skill', 'llm', 'translator'])
+    parser.add_argument('--fixtures', help="directory with recorded WAV fixtures (see the header)")
+    parser.add_argument('--llm-latency', type=float, default=0.4, help="seconds before the stub's first byte")
+    parser.add_argument('--llm-jitter', type=float, default=0.1)
+    parser.add_argument('--word-interval', type=float, default=0.02, help="seconds between streamed words")
+    parser.add_argument('--rate-limit', type=float, default=0.0, help="share of Gemini requests answered with 429")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="share of Gemini requests answered with 500")
+    parser.add_argument('--stt-latency', type=float, default=0.3, help="seconds recognize_google takes")
+    parser.add_argument('--translate-latency', type=float, default=0.15)
+    parser.add_argument('--speech-cps', type=float, default=40.0, help="characters per second the fake TTS speaks")
+    parser.add_argument('--gap', type=float, default=0.3, help="pause between turns")
+    parser.add_argument('--turn-timeout', type=float, default=30.0)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--verbose', action='store_true', help="show the assistant's log")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.CRITICAL + 1)
+    fixtures_dir = os.path.abspath(args.fixtures) if args.fixtures else None
+    workdir = tempfile.mkdtemp(prefix="assistant_e2e_")
+    cwd = os.getcwd()
+    try:
+        if not fixtures_dir:
+            fixtures_dir = os.path.join(workdir, "fixtures")
+            os.makedirs(fixtures_dir)
+            make_fixtures(fixtures_dir, args.seed)
+        fixtures = load_fixtures(fixtures_dir)
+        # The assistant keeps its database, config and skills in the working directory.
+        os.chdir(workdir)
+        bench = Bench(args, fixtures, workdir)
+        try:
+            for name in args.scenarios:
+                bench.scenario(name)
+            bench.report()
+        finally:
+            bench.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
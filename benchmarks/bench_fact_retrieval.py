@@ -0,0 +1,107 @@
+# Compares the old "send every fact" memory prompt against FactRetriever
+# (FTS5 candidates + local re-scoring) on a synthetic database with 10k+
+# facts per user. Reports lookup latency and the size of the memory section.
+#
+# Usage: python benchmarks/bench_fact_retrieval.py [--facts 10000] [--users 3]
+
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from main import FactRetriever  # noqa: E402
+
+TEMPLATES = [
+    "likes to eat {food}", "has a {pet} named {name}", "works as a {job}", "visited {city} in {year}",
+    "plays {sport} on weekends", "is learning {language}", "prefers {color} clothes", "reads books about {topic}",
+    "has a friend called {name} who lives in {city}", "bought a new {item} in {year}",
+]
+WORDS = {
+    'food': ["pizza", "sushi", "tacos", "paella", "ramen", "lasagna", "curry", "empanadas"],
+    'pet': ["dog", "cat", "parrot", "turtle", "hamster"],
+    'name': ["Max", "Luna", "Rocky", "Bella", "Simba", "Nala", "Toby", "Coco"],
+    'job': ["teacher", "nurse", "programmer", "designer", "chef", "pilot"],
+    'city': ["Madrid", "Paris", "Tokyo", "Lima", "Berlin", "Bogota", "Rome"],
+    'year': [str(y) for y in range(1990, 2026)],
+    'sport': ["football", "tennis", "chess", "basketball", "padel"],
+    'language': ["French", "German", "Japanese", "Italian", "Portuguese"],
+    'color': ["blue", "black", "green", "red"],
+    'topic': ["history", "astronomy", "cooking", "philosophy", "economics"],
+    'item': ["laptop", "bicycle", "guitar", "camera", "phone"],
+}
+QUERIES = [
+    "What food do I like?", "Tell me something about my dog", "Which cities have I visited?",
+    "Recommend a book for me", "What sport could I play tomorrow?", "How do I say hello in the language I'm learning?",
+    "Hello, how are you?",
+]
+
+
+def build_db(path, users, facts_per_user):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE user_facts (user_id TEXT, fact TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (user_id, fact))")
+    FactRetriever.create_schema(conn)
+    rng = random.Random(42)
+    for u in range(users):
+        rows = set()
+        while len(rows) < facts_per_user:
+            template = rng.choice(TEMPLATES)
+            fact = template.format(**{k: rng.choice(v) for k, v in WORDS.items()}) + f" (note {rng.randint(0, 10 ** 6)})"
+            rows.add(fact)
+        conn.executemany("INSERT OR IGNORE INTO user_facts (user_id, fact) VALUES (?, ?)", [(f"user{u}", f) for f in rows])
+    conn.commit()
+    return conn
+
+
+def old_prompt(conn, user_id):
+    facts = [row[0] for row in conn.execute("SELECT fact FROM user_facts WHERE user_id = ? ORDER BY timestamp DESC", (user_id,))]
+    facts_list = '\n- '.join(facts)
+    return f"Known facts about the user (total {len(facts)}): \n- {facts_list}"
+
+
+def new_prompt(conn, retriever, user_id, query):
+    facts_list = '\n- '.join(retriever.retrieve(conn, user_id, query))
+    return f"Known facts about the user relevant to this request: \n- {facts_list}"
+
+
+def measure(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return result, timings[len(timings) // 2] * 1000, timings[int(len(timings) * 0.95) - 1] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--facts', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        conn = build_db(os.path.join(tmp, "facts.db"), args.users, args.facts)
+        print(f"Built {args.users} x {args.facts} facts in {time.perf_counter() - start:.1f}s")
+        retriever = FactRetriever()
+
+        prompt, p50, p95 = measure(lambda: old_prompt(conn, "user0"), max(args.repeat // 5, 3))
+        print(f"{'before: all facts':<36} p50 {p50:8.2f} ms | p95 {p95:8.2f} ms | ~{FactRetriever.estimate_tokens(prompt):>7} tokens")
+
+        sizes = []
+        for query in QUERIES:
+            prompt, p50, p95 = measure(lambda: new_prompt(conn, retriever, "user0", query), args.repeat)
+            sizes.append(FactRetriever.estimate_tokens(prompt))
+            print(f"after: {query[:29]:<29} p50 {p50:8.2f} ms | p95 {p95:8.2f} ms | ~{sizes[-1]:>7} tokens")
+        print(f"Mean memory section after: ~{statistics.mean(sizes):.0f} tokens (budget {retriever.token_budget})")
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# Compares cold `requests.post` calls (one connection per call) against the
+# pooled keep-alive GeminiClient, using a local stub of the Gemini API.
+#
+# Usage: python benchmarks/bench_gemini_client.py [--calls 300] [--threads 4]
+
+import argparse
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from main import GeminiClient, GEMINI_MODEL  # noqa: E402
+from stub_gemini_server import StubGeminiServer  # noqa: E402
+
+PAYLOAD = {"contents": [{"parts": [{"text": "Hello"}]}]}
+
+
+def cold_call(url):
+    response = requests.post(url, headers={'Content-Type': 'application/json'}, json=PAYLOAD, timeout=25)
+    return response.json()['candidates'][0]['content']['parts'][0]['text']
+
+
+def measure(call, calls, threads):
+    latencies = []
+
+    def timed(_):
+        start = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    if threads == 1:
+        for i in range(calls): timed(i)
+    else:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(timed, range(calls)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p95_ms': latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        'calls_per_s': calls / elapsed,
+    }
+
+
+def report(label, stats):
+    print(f"{label:<28} mean {stats['mean_ms']:7.2f} ms | p50 {stats['p50_ms']:7.2f} ms | "
+          f"p95 {stats['p95_ms']:7.2f} ms | {stats['calls_per_s']:8.1f} calls/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=300)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    server = StubGeminiServer().start()
+    url = f"{server.api_root}/{GEMINI_MODEL}:generateContent"
+    client = GeminiClient("bench-key", api_root=server.api_root, pool_maxsize=max(args.threads, 1))
+    try:
+        for threads in (1, args.threads):
+            print(f"--- {args.calls} calls, {threads} thread(s) ---")
+            report("before: requests.post (cold)", measure(lambda: cold_call(url), args.calls, threads))
+            report("after: GeminiClient (pooled)", measure(lambda: client.generate_text(PAYLOAD), args.calls, threads))
+    finally:
+        client.close()
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
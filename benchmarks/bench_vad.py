@@ -0,0 +1,123 @@
+# Runs the wake-word VoiceActivityGate over generated WAV fixtures and shows
+# which segments would still be sent to Google Speech Recognition. Before the
+# gate, every segment that crossed the energy threshold was transcribed.
+#
+# Fixtures (16 kHz mono, 16-bit) are written to a temporary directory and read
+# back with `wave`, like the microphone segments the wake loop receives:
+#   wake_phrase     ~1 s of voiced, syllable-modulated harmonics   -> sent
+#   long_speech     ~6 s of the same (a conversation, not a wake)  -> rejected
+#   white_noise     1.5 s of hiss                                  -> rejected
+#   mains_hum       2 s of 50 Hz hum with harmonics                -> rejected
+#   keyboard        clicks every 150 ms                            -> rejected
+#   fan             2 s of low-passed noise                        -> rejected
+#
+# Exits with status 1 when a fixture gets a different decision than the one
+# listed above, so a regression in the gate fails the run.
+#
+# Usage: python benchmarks/bench_vad.py [--repeat 200] [--keep DIR]
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import wave
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from main import VoiceActivityGate  # noqa: E402
+
+RATE = 16000
+EXPECTED_SENT = {'wake_phrase'}
+
+
+def voiced(seconds, rng, f0=140.0):
+    """Harmonic source with formant-like weighting, pitch drift and ~4 Hz syllables."""
+    t = np.arange(int(seconds * RATE)) / RATE
+    pitch = f0 * (1 + 0.08 * np.sin(2 * np.pi * 0.7 * t))
+    phase = 2 * np.pi * np.cumsum(pitch) / RATE
+    signal = np.zeros_like(t)
+    for harmonic in range(1, 25):
+        freq = f0 * harmonic
+        weight = np.exp(-((freq - 500) / 300) ** 2) + 0.6 * np.exp(-((freq - 1500) / 400) ** 2) + 0.05
+        signal += weight * np.sin(harmonic * phase)
+    syllables = np.clip(np.sin(2 * np.pi * 4.0 * t + rng.uniform(0, np.pi)), 0.1, None)
+    return signal * syllables
+
+
+def with_padding(signal, rng, before=0.4, after=0.4, noise=0.002):
+    padded = np.concatenate([np.zeros(int(before * RATE)), signal, np.zeros(int(after * RATE))])
+    return padded + rng.normal(0, noise, len(padded))
+
+
+def fixtures(rng):
+    clicks = np.zeros(int(2.0 * RATE))
+    for start in range(0, len(clicks) - 80, int(0.15 * RATE)):
+        clicks[start:start + 80] = rng.normal(0, 0.5, 80) * np.exp(-np.arange(80) / 15)
+    t = np.arange(int(2.0 * RATE)) / RATE
+    hum = sum(np.sin(2 * np.pi * 50 * k * t) / k for k in (1, 2, 3))
+    fan = np.convolve(rng.normal(0, 1, int(2.0 * RATE)), np.ones(40) / 40, mode='same')
+    return {
+        'wake_phrase': with_padding(voiced(1.0, rng), rng),
+        'long_speech': with_padding(voiced(6.0, rng, f0=120.0), rng),
+        'white_noise': with_padding(rng.normal(0, 0.3, int(1.5 * RATE)), rng),
+        'mains_hum': with_padding(0.3 * hum, rng),
+        'keyboard': with_padding(clicks, rng),
+        'fan': with_padding(fan * 2.0, rng),
+    }
+
+
+def write_wav(path, signal):
+    pcm = (np.clip(signal / (np.max(np.abs(signal)) + 1e-9) * 0.5, -1, 1) * 32767).astype('<i2')
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(RATE)
+        wav.writeframes(pcm.tobytes())
+
+
+def read_wav(path):
+    with wave.open(path, 'rb') as wav:
+        assert wav.getframerate() == RATE and wav.getsampwidth() == 2 and wav.getnchannels() == 1
+        return wav.readframes(wav.getnframes())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--keep', help="write the fixtures to this directory instead of a temporary one")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(16)
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = args.keep or tmp
+        os.makedirs(directory, exist_ok=True)
+        segments = {}
+        for name, signal in fixtures(rng).items():
+            path = os.path.join(directory, f"{name}.wav")
+            write_wav(path, signal)
+            segments[name] = read_wav(path)
+
+        gate = VoiceActivityGate()
+        mismatches = []
+        print(f"{'fixture':<12} {'seconds':>7} {'decision':>9} {'cost':>14}")
+        for name, pcm in segments.items():
+            seconds = len(pcm) / 2 / RATE
+            sent = gate.accept(pcm)
+            if sent != (name in EXPECTED_SENT):
+                mismatches.append(name)
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                VoiceActivityGate().speech_mask(pcm)
+            per_second = (time.perf_counter() - start) / args.repeat / seconds * 1000
+            print(f"{name:<12} {seconds:7.2f} {'sent' if sent else 'rejected':>9} {per_second:8.3f} ms/s audio")
+        print(f"before: {len(segments)} of {len(segments)} segments sent to recognize_google")
+        print(f"after:  {gate.stats['sent']} of {gate.stats['segments']} sent | {gate.stats}")
+    if mismatches:
+        print(f"FAIL: unexpected decision for {', '.join(mismatches)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# Measures the offline TemplateWakeWord matcher (MFCC + subsequence DTW) on a
+# synthetic stream: three enrollment takes of a formant-synthesized "hey
+# assistant", then a stream with the phrase said twice (once faster and over
+# louder noise) between distractor phrases. Reports where it fired and the CPU
+# cost per 20 ms frame. The old path needed a Google transcription round trip
+# for every candidate segment; this one runs locally in a few percent of real
+# time.
+#
+# Usage: python benchmarks/bench_wake_word.py [--seed 3]
+
+import argparse
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from main import TemplateWakeWord  # noqa: E402
+
+RATE = 16000
+# (kind, seconds, (F1, F2)): 'v' voiced with two formants, 's' fricative noise, 'p' pause
+HEY_ASSISTANT = [('s', 0.06, None), ('v', 0.18, (600, 1900)), ('v', 0.10, (400, 2300)), ('p', 0.05, None),
+                 ('v', 0.08, (700, 1200)), ('s', 0.12, None), ('v', 0.10, (400, 2000)), ('s', 0.10, None),
+                 ('v', 0.14, (650, 1700)), ('p', 0.04, None), ('v', 0.06, (500, 1500))]
+DISTRACTOR = [('v', 0.15, (300, 800)), ('v', 0.15, (700, 1100)), ('p', 0.05, None), ('v', 0.20, (350, 2200)),
+              ('s', 0.10, None), ('v', 0.20, (500, 900))]
+
+
+def synthesize(segments, rng, f0=130.0, speed=1.0, noise=0.003):
+    parts, phase = [], 0.0
+    for kind, seconds, formants in segments:
+        n = int(seconds * RATE / speed)
+        if kind == 'v':
+            t = np.arange(n) / RATE
+            pitch = f0 * (1 + 0.05 * np.sin(2 * np.pi * 1.3 * t))
+            phases = phase + 2 * np.pi * np.cumsum(pitch) / RATE
+            phase = phases[-1]
+            f1, f2 = formants
+            signal = sum((np.exp(-((f0 * h - f1) / 150) ** 2) + 0.7 * np.exp(-((f0 * h - f2) / 250) ** 2) + 0.02) * np.sin(h * phases)
+                         for h in range(1, 30))
+            parts.append(signal * np.sin(np.pi * np.arange(n) / n) ** 0.5)
+        elif kind == 's':
+            white = rng.normal(0, 1, n)
+            parts.append(0.6 * (white - np.convolve(white, np.ones(3) / 3, 'same')) * np.hanning(n))
+        else:
+            parts.append(np.zeros(n))
+    signal = np.concatenate(parts)
+    signal = signal / np.abs(signal).max() * 0.4
+    return signal + rng.normal(0, noise, len(signal))
+
+
+def to_pcm(signal):
+    return (np.clip(signal, -1, 1) * 32767).astype(np.int16)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seed', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    takes = [to_pcm(synthesize(HEY_ASSISTANT, rng, f0=f0, speed=speed)) for f0, speed in ((120, 1.0), (135, 0.9), (150, 1.1))]
+    silence = lambda seconds: rng.normal(0, 0.003, int(seconds * RATE))
+    pieces = [silence(1.0), synthesize(DISTRACTOR, rng, f0=125), silence(1.0),
+              synthesize(HEY_ASSISTANT, rng, f0=140, speed=0.95), silence(1.5),
+              synthesize(DISTRACTOR, rng, f0=170, speed=1.2), silence(1.0),
+              synthesize(HEY_ASSISTANT, rng, f0=115, speed=1.15, noise=0.02), silence(1.0)]
+    expected, offset = [], 0
+    for index, piece in enumerate(pieces):
+        offset += len(piece)
+        if index in (3, 7):
+            expected.append(round(offset / RATE, 2))
+    stream = to_pcm(np.concatenate(pieces))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        saved = TemplateWakeWord.enroll(tmp, takes)
+        matcher = TemplateWakeWord.load(tmp)
+    print(f"Enrolled {saved} templates, calibrated threshold {matcher.threshold:.2f}")
+
+    detections = []
+    step = matcher.frame_length
+    for start in range(0, len(stream) - step + 1, step):
+        if matcher.detect(stream[start:start + step]):
+            detections.append(round((start + step) / RATE, 2))
+    print(f"Wake phrase ends at {expected} s; detected at {detections} s")
+    print(f"Cost: {matcher.cost_summary()}")
+
+
+if __name__ == "__main__":
+    main()
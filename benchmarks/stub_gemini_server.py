@@ -0,0 +1,125 @@
+# Local stand-in for the Gemini REST API, used by the benchmark scripts.
+#
+# It answers `:generateContent` with a fixed candidate (and
+# `:streamGenerateContent?alt=sse` with one event per word) and speaks HTTP/1.1,
+# so clients that keep connections alive can reuse them exactly as they
+# would against the real endpoint. Requests that ask for JSON output
+# (`responseMimeType`) get an empty JSON list.
+#
+# Optional knobs make it behave like a loaded backend: a fixed latency plus
+# jitter before the first byte, a delay between streamed words, and a share of
+# requests answered with 429 (rate limited) or 500 instead.
+
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        status = self.server.next_status()
+        if status != 200:
+            self.send_error_status(status)
+            return
+        time.sleep(self.server.first_byte_delay())
+        wants_json = 'responseMimeType' in request.get('generationConfig', {})
+        reply_text = "[]" if wants_json else self.server.reply_text
+        if ':streamGenerateContent' in self.path:
+            self.stream(reply_text)
+            return
+        body = json.dumps({
+            "candidates": [{"content": {"parts": [{"text": reply_text}], "role": "model"}}]
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream(self, reply_text):
+        # One server-sent event per word, like the real streaming endpoint.
+        events = [json.dumps({"candidates": [{"content": {"parts": [{"text": word}], "role": "model"}}]})
+                  for word in re.findall(r'\S+\s*', reply_text)]
+        if not self.server.word_interval:
+            body = "".join(f"data: {event}\r\n\r\n" for event in events).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for index, event in enumerate(events):
+            if index:
+                time.sleep(self.server.word_interval)
+            data = f"data: {event}\r\n\r\n".encode('utf-8')
+            self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def send_error_status(self, status):
+        body = json.dumps({"error": {"code": status, "message": "stubbed failure"}}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubGeminiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, reply_text="Hello from the stub.", latency=0.0, jitter=0.0,
+                 word_interval=0.0, rate_limit_rate=0.0, failure_rate=0.0, seed=0):
+        super().__init__((host, port), StubGeminiHandler)
+        self.reply_text = reply_text
+        self.latency = latency
+        self.jitter = jitter
+        self.word_interval = word_interval
+        self.rate_limit_rate = rate_limit_rate
+        self.failure_rate = failure_rate
+        self.request_count = 0
+        self.status_counts = {200: 0, 429: 0, 500: 0}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def api_root(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1beta/models"
+
+    def next_status(self):
+        with self._lock:
+            self.request_count += 1
+            draw = self._random.random()
+            status = 429 if draw < self.rate_limit_rate else 500 if draw < self.rate_limit_rate + self.failure_rate else 200
+            self.status_counts[status] += 1
+            return status
+
+    def first_byte_delay(self):
+        with self._lock:
+            return max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
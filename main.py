@@ -17,56 +17,2937 @@
 #    integrating it as an attribute of the VirtualAssistant class.
 # =============================================================================
 
-import speech_recognition as sr
-import pyttsx3
 import datetime
 import webbrowser
-import pywhatkit
 import os
 import subprocess
 import time
 import tkinter as tk
 from tkinter import messagebox, scrolledtext, ttk, simpledialog
 from threading import Thread
+import threading
 import queue
-import wikipedia
 import re
-import psutil
-import pyautogui
-from deep_translator import GoogleTranslator
 import json
 import sys
 import logging
 import sqlite3
-import requests
+import itertools
+import hashlib
+import collections
+import functools
+import math
+import marshal
+import struct
+import importlib.util
+import multiprocessing
+import contextlib
+import io
+import traceback
+import zlib
+import wave
 from urllib.parse import quote
 
+# Third-party module name -> (seconds spent importing it, thread that paid for it).
+IMPORT_TIMES = {}
+
+
+def _timed_import(name):
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    IMPORT_TIMES[name] = (time.perf_counter() - start, threading.current_thread().name)
+    return module
+
+
+class LazyModule:
+    """Stands in for a module and imports it on first attribute access.
+
+    Dependencies that only a few handlers use are bound to a LazyModule instead
+    of being imported, so they no longer delay the window; `prewarm_lazy_modules`
+    loads them in the background once the UI is up, except those created with
+    `prewarm=False`, which load where they are first used. `load` and
+    `after_load` shadow module attributes of the same name.
+    """
+    instances = []
+
+    def __init__(self, name, prewarm=True):
+        self._name = name
+        self.prewarm = prewarm
+        self._module = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        LazyModule.instances.append(self)
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    module = _timed_import(self._name)
+                    for callback in self._callbacks:
+                        callback(module)
+                    self._module = module
+        return self._module
+
+    def after_load(self, callback):
+        """Runs callback(module) now if the module is loaded, otherwise right after it is."""
+        with self._lock:
+            if self._module is None:
+                self._callbacks.append(callback)
+                return
+        callback(self._module)
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+    def __repr__(self):
+        return f"<LazyModule '{self._name}' ({'loaded' if self.loaded else 'not loaded'})>"
+
+
+def prewarm_lazy_modules():
+    """Imports every deferred module so the first command that needs one does not wait for it."""
+    for module in LazyModule.instances:
+        if not module.prewarm:
+            continue
+        try:
+            module.load()
+        except Exception as e:
+            logging.warning(f"Could not import '{module._name}': {e}")
+    logging.info(import_time_report())
+
+
+def _optional_module(name):
+    """A LazyModule that is not prewarmed, or None when the package is not installed."""
+    return LazyModule(name, prewarm=False) if importlib.util.find_spec(name.split('.')[0]) else None
+
+
+def import_time_report():
+    """One line per third-party module, slowest first, with the thread that imported it."""
+    lines = ["Import times:"]
+    for name, (seconds, thread) in sorted(IMPORT_TIMES.items(), key=lambda item: -item[1][0]):
+        lines.append(f"  {name:<20} {seconds * 1000:8.1f} ms  ({thread})")
+    pending = [module._name for module in LazyModule.instances if not module.loaded]
+    if pending:
+        lines.append(f"  not loaded yet: {', '.join(pending)}")
+    return "\n".join(lines)
+
+
+# CaptureSource subclasses sr.AudioSource and numpy backs the audio classes, so these two load up front.
+sr = _timed_import('speech_recognition')
+np = _timed_import('numpy')
+pyttsx3 = LazyModule('pyttsx3')
+pywhatkit = LazyModule('pywhatkit')  # Checks the internet connection when imported
+wikipedia = LazyModule('wikipedia')
+psutil = LazyModule('psutil')
+pyautogui = LazyModule('pyautogui')
+deep_translator = LazyModule('deep_translator')
+requests = LazyModule('requests')
+
 # Logging handler to send records to the GUI queue
 class QueueHandler(logging.Handler):
     def __init__(self, log_queue):
         super().__init__()
         self.log_queue = log_queue
 
-    def emit(self, record):
-        self.log_queue.put(self.format(record))
+    def emit(self, record):
+        self.log_queue.put((record.levelno, self.format(record)))
+
+
+class ConsoleRenderer:
+    """Moves log records from a queue into a Text widget in one insert per frame.
+
+    The last `max_lines` records are kept in a ring and the widget is trimmed to
+    the same size. When more than `max_lines_per_frame` records arrive between
+    two frames, only the newest are shown and a "N lines suppressed" marker
+    replaces the rest. Records below `min_level` are kept but not displayed, so
+    lowering the level re-renders them from the ring.
+    """
+    DRAIN_LIMIT = 10000  # Records taken from the queue per frame, so a flood cannot stall the main loop
+
+    def __init__(self, widget, log_queue, max_lines=2000, max_lines_per_frame=200, min_level=logging.INFO):
+        self.widget = widget
+        self.log_queue = log_queue
+        self.max_lines_per_frame = max_lines_per_frame
+        self.min_level = min_level
+        self.suppressed = 0
+        self._ring = collections.deque(maxlen=max_lines)
+        self._widget_records = collections.deque()  # Physical line count of each record shown in the widget
+
+    @staticmethod
+    def _tag(levelno):
+        if levelno >= logging.ERROR:
+            return 'error'
+        return 'warning' if levelno >= logging.WARNING else 'info'
+
+    def drain(self):
+        records = []
+        try:
+            while len(records) < self.DRAIN_LIMIT:
+                records.append(self.log_queue.get_nowait())
+        except queue.Empty:
+            pass
+        suppressed = len(records) - self.max_lines_per_frame
+        if suppressed > 0:
+            records = records[-self.max_lines_per_frame:]
+            self.suppressed += suppressed
+            records.insert(0, (logging.WARNING, f"... {suppressed} lines suppressed ..."))
+        self._ring.extend(records)
+        self._render([r for r in records if r[0] >= self.min_level])
+
+    def set_level(self, min_level):
+        self.min_level = min_level
+        self.widget.config(state='normal')
+        self.widget.delete('1.0', 'end')
+        self.widget.config(state='disabled')
+        self._widget_records.clear()
+        self._render([r for r in self._ring if r[0] >= min_level])
+
+    def _render(self, records):
+        if not records:
+            return
+        follow = self.widget.yview()[1] >= 0.999
+        args = []
+        for levelno, text in records:
+            args += [text + '\n', self._tag(levelno)]
+        self.widget.config(state='normal')
+        self.widget.insert('end', *args)
+        # Tracebacks span several lines, so the widget is trimmed by whole records, not by lines.
+        self._widget_records.extend(text.count('\n') + 1 for _, text in records)
+        excess_lines = 0
+        while len(self._widget_records) > self._ring.maxlen:
+            excess_lines += self._widget_records.popleft()
+        if excess_lines:
+            self.widget.delete('1.0', f'{excess_lines + 1}.0')
+        self.widget.config(state='disabled')
+        # Only keep scrolling when the user has not scrolled up to read something.
+        if follow:
+            self.widget.see('end')
+
+
+class MarkdownTagger:
+    """Turns Markdown text into (text, tags) runs for a Text widget, one fragment at a time.
+
+    Understands the subset short LLM answers use: **bold**, *italic*, `code` and
+    "* " / "- " bullets at the start of a line. Asterisks only count as markers at
+    word boundaries, and bold and italic end with the line, so "2**10" or an
+    unmatched marker cannot restyle the rest of a reply. Markers that may be split
+    across two fragments (trailing asterisks, a dash at the start of a line) are
+    held back until the next fragment shows what they are.
+    """
+
+    def __init__(self, tag):
+        self.tag = tag
+        self.bold = self.italic = self.code = False
+        self.line_start = True
+        self._previous = ""
+        self._held = ""
+
+    def feed(self, text):
+        text = self._held + text
+        cut = len(text.rstrip('*'))
+        if cut and text[cut - 1] == '-' and (text[cut - 2:cut - 1] == '\n' or (cut == 1 and self.line_start)):
+            cut -= 1
+        self._held = text[cut:]
+        return self._runs(text[:cut])
+
+    def flush(self):
+        held, self._held = self._held, ""
+        return self._runs(held)
+
+    def _tags(self):
+        tags = (self.tag,)
+        if self.code:
+            return tags + ('md_code',)
+        return tags + (('md_bold',) if self.bold else ()) + (('md_italic',) if self.italic else ())
+
+    def _is_marker(self, text, i, width, closing):
+        before = text[i - 1] if i else self._previous
+        after = text[i + width] if i + width < len(text) else ""
+        if closing:
+            return bool(before) and not before.isspace() and not after.isalnum()
+        # "2*3", "2**10" and "a * b" are left alone.
+        return bool(after) and not after.isspace() and not before.isalnum()
+
+    def _runs(self, text):
+        runs, chars, i = [], [], 0
+
+        def emit():
+            if chars:
+                runs.append((''.join(chars), self._tags()))
+                chars.clear()
+
+        while i < len(text):
+            ch = text[i]
+            if self.line_start and not self.code and text.startswith(('* ', '- '), i):
+                chars.append('• ')
+                self.line_start = False
+                i += 2
+            elif ch == '`':
+                emit()
+                self.code = not self.code
+                i += 1
+            elif not self.code and text.startswith('**', i):
+                if self._is_marker(text, i, 2, self.bold):
+                    emit()
+                    self.bold = not self.bold
+                else:
+                    chars.append('**')
+                    self.line_start = False
+                i += 2
+            elif not self.code and ch == '*' and self._is_marker(text, i, 1, self.italic):
+                emit()
+                self.italic = not self.italic
+                i += 1
+            else:
+                chars.append(ch)
+                self.line_start = ch == '\n'
+                if self.line_start and (self.bold or self.italic):
+                    emit()
+                    self.bold = self.italic = False
+                i += 1
+        emit()
+        if text:
+            self._previous = text[-1]
+        return runs
+
+
+class ChatRenderer:
+    """Applies chat updates coming from any thread to the chat Text widget, at most once per frame.
+
+    Messages, streamed fragments and the provisional transcript are queued and
+    applied together by `flush` on the Tk thread: inserts at the end become one
+    Text.insert call, fragments of a streamed message one insert at its mark,
+    and the view scrolls once. Markdown is converted to tags as text arrives,
+    so a streamed answer is formatted while it is written; only assistant text
+    is treated as Markdown. Every message prefix carries the MESSAGE_START tag.
+    While the view follows the newest message, the widget is trimmed to
+    `max_lines` lines by dropping whole messages from the top, and `on_trim` is
+    called.
+    """
+    FRAME_MS = 33
+    MESSAGE_START = 'message_start'
+
+    def __init__(self, widget, max_lines=3000, on_trim=None, frame_ms=FRAME_MS):
+        self.widget = widget
+        self.max_lines = max_lines
+        self.on_trim = on_trim
+        self.frame_ms = frame_ms
+        self.stats = {'frames': 0, 'updates': 0, 'max_updates_per_frame': 0, 'trimmed_lines': 0}
+        self._updates = queue.SimpleQueue()
+        self._scheduled = False
+        self._lock = threading.Lock()
+        self._streams = {}
+
+    def add_message(self, prefix, text, tag):
+        self._post('message', prefix, text, tag)
+
+    def begin_stream(self, stream_id, prefix):
+        self._post('begin', stream_id, prefix)
+
+    def append_stream(self, stream_id, text):
+        self._post('append', stream_id, text)
+
+    def end_stream(self, stream_id):
+        self._post('end', stream_id)
+
+    def set_partial(self, text):
+        """Replaces the provisional transcript line; None removes it."""
+        self._post('partial', text)
+
+    @staticmethod
+    def format(text, tag):
+        """Text.insert arguments for the text of a complete message."""
+        if tag != 'assistant':
+            return [text, tag]
+        tagger = MarkdownTagger(tag)
+        return [item for run in tagger.feed(text) + tagger.flush() for item in run]
+
+    def _post(self, *update):
+        self._updates.put(update)
+        with self._lock:
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self.widget.after(self.frame_ms, self.flush)
+
+    def flush(self):
+        with self._lock:
+            self._scheduled = False
+        updates = []
+        try:
+            while True:
+                updates.append(self._updates.get_nowait())
+        except queue.Empty:
+            pass
+        if not updates:
+            return
+        follow = self.widget.yview()[1] >= 0.999
+        at_end, at_streams = [], {}
+        self.widget.config(state='normal')
+        for kind, *args in updates:
+            if kind == 'message':
+                prefix, text, tag = args
+                at_end += [prefix, ('system', self.MESSAGE_START)] + self.format(text, tag) + ['\n\n', tag]
+            elif kind == 'begin':
+                stream_id, prefix = args
+                at_end += [prefix, ('system', self.MESSAGE_START), '\n\n', ()]
+                self._insert_end(at_end)
+                # A right-gravity mark just before the trailing blank line keeps pointing
+                # after the streamed text, so messages added meanwhile do not interleave.
+                self.widget.mark_set(stream_id, 'end-3c')
+                self.widget.mark_gravity(stream_id, 'right')
+                self._streams[stream_id] = MarkdownTagger('assistant')
+            elif kind == 'append':
+                stream_id, text = args
+                if stream_id in self._streams:
+                    at_streams.setdefault(stream_id, []).extend(self._streams[stream_id].feed(text))
+            elif kind == 'end':
+                stream_id, = args
+                tagger = self._streams.pop(stream_id, None)
+                if tagger:
+                    at_streams.setdefault(stream_id, []).extend(tagger.flush())
+                    self._insert_stream(stream_id, at_streams.pop(stream_id))
+                    self.widget.mark_unset(stream_id)
+            elif kind == 'partial':
+                text, = args
+                self._insert_end(at_end)
+                ranges = self.widget.tag_ranges('partial')
+                if ranges:
+                    self.widget.delete(ranges[0], ranges[-1])
+                if text:
+                    self.widget.insert('end', f"… {text}\n\n", 'partial')
+        self._insert_end(at_end)
+        for stream_id, runs in at_streams.items():
+            self._insert_stream(stream_id, runs)
+        if follow:
+            self._trim()
+        self.widget.config(state='disabled')
+        if follow:
+            self.widget.see('end')
+        self.stats['frames'] += 1
+        self.stats['updates'] += len(updates)
+        self.stats['max_updates_per_frame'] = max(self.stats['max_updates_per_frame'], len(updates))
+
+    def _insert_end(self, args):
+        if args:
+            self.widget.insert('end', *args)
+            args.clear()
+
+    def _insert_stream(self, stream_id, runs):
+        if runs:
+            self.widget.insert(stream_id, *[item for run in runs for item in run])
+
+    def _trim(self):
+        lines = int(self.widget.index('end-1c').split('.')[0])
+        if lines <= self.max_lines:
+            return
+        # Cut where the first message that fits begins, so no message is left half-deleted.
+        first_kept = self.widget.tag_nextrange(self.MESSAGE_START, f'{lines - self.max_lines + 1}.0')
+        if not first_kept:
+            return
+        self.widget.delete('1.0', first_kept[0])
+        self.stats['trimmed_lines'] += lines - int(self.widget.index('end-1c').split('.')[0])
+        if self.on_trim:
+            self.on_trim()
+
+class LatencyHistogram:
+    """Log-linear (HDR-style) histogram of durations with constant-time recording.
+
+    Durations are counted in microseconds. Below 2**SUB_BUCKET_BITS every value
+    has its own bucket; above that, each power of two is split into
+    2**(SUB_BUCKET_BITS - 1) equal buckets, so a percentile is reported within
+    about 3% of the true value however wide the range is.
+    """
+    SUB_BUCKET_BITS = 6
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @classmethod
+    def _index(cls, micros):
+        shift = max(0, micros.bit_length() - cls.SUB_BUCKET_BITS)
+        return (shift << (cls.SUB_BUCKET_BITS - 1)) + (micros >> shift)
+
+    @classmethod
+    def _midpoint(cls, index):
+        half = 1 << (cls.SUB_BUCKET_BITS - 1)
+        if index < 2 * half:
+            return index
+        shift = index // half - 1
+        return ((index - shift * half) << shift) + ((1 << shift) - 1) / 2
+
+    def record(self, seconds):
+        self.counts[self._index(max(0, int(seconds * 1e6)))] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q):
+        """The q-th percentile (0-100) in seconds, or None when nothing was recorded."""
+        if not self.count:
+            return None
+        target = max(1, math.ceil(q / 100 * self.count))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self._midpoint(index) / 1e6, self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'sum': self.total, 'max': self.max,
+                'p50': self.percentile(50), 'p95': self.percentile(95), 'p99': self.percentile(99)}
+
+
+class _Span:
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.record(self.name, time.perf_counter() - self.start)
+
+
+class Metrics:
+    """Per-stage latency histograms and event counters for the whole assistant.
+
+    `span(name)` times a block and `timed(name)` a function. While disabled they
+    cost an attribute check and record nothing, so the instrumentation stays in
+    place. `set_gauge` keeps the latest value of a level such as a queue depth.
+    The Console tab shows `snapshot()` and `gauges()`; `start_export` periodically
+    writes `exposition()` (Prometheus text format) to a file.
+    """
+    QUANTILES = (50, 95, 99)
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._histograms = {}
+        self._counters = collections.Counter()
+        self._gauges = {}
+        self._lock = threading.Lock()
+        self._export_stop = None
+        self._export_thread = None
+
+    def record(self, name, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = LatencyHistogram()
+            histogram.record(seconds)
+
+    def increment(self, name, amount=1):
+        if self.enabled:
+            with self._lock:
+                self._counters[name] += amount
+
+    def set_gauge(self, name, value):
+        if self.enabled:
+            with self._lock:
+                self._gauges[name] = value
+
+    def gauges(self):
+        with self._lock:
+            return dict(self._gauges)
+
+    def span(self, name):
+        return _Span(self, name) if self.enabled else contextlib.nullcontext()
+
+    def timed(self, name):
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.record(name, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        """Returns ({stage: summary}, {counter: value})."""
+        with self._lock:
+            return {name: histogram.summary() for name, histogram in sorted(self._histograms.items())}, dict(self._counters)
+
+    def exposition(self):
+        stages, counters = self.snapshot()
+        lines = ["# HELP assistant_stage_seconds Duration of each pipeline stage.", "# TYPE assistant_stage_seconds summary"]
+        for name, summary in stages.items():
+            for q in self.QUANTILES:
+                lines.append(f'assistant_stage_seconds{{stage="{name}",quantile="{q / 100}"}} {summary[f"p{q}"]:.6f}')
+            lines.append(f'assistant_stage_seconds_sum{{stage="{name}"}} {summary["sum"]:.6f}')
+            lines.append(f'assistant_stage_seconds_count{{stage="{name}"}} {summary["count"]}')
+        lines += ["# HELP assistant_events_total Count of notable events.", "# TYPE assistant_events_total counter"]
+        lines += [f'assistant_events_total{{event="{name}"}} {value}' for name, value in sorted(counters.items())]
+        lines += ["# HELP assistant_level Current value of a level such as a queue depth.", "# TYPE assistant_level gauge"]
+        lines += [f'assistant_level{{name="{name}"}} {value}' for name, value in sorted(self.gauges().items())]
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(self.exposition())
+        os.replace(temp_path, path)
+
+    def start_export(self, path, interval=60):
+        self._export_stop = threading.Event()
+        self._export_thread = Thread(target=self._export_loop, args=(path, interval, self._export_stop), daemon=True, name="metrics-export")
+        self._export_thread.start()
+
+    def stop_export(self, timeout=2):
+        """Stops the periodic export after writing the file one last time."""
+        if self._export_stop:
+            self._export_stop.set()
+            self._export_thread.join(timeout)
+
+    def _export_loop(self, path, interval, stop):
+        while True:
+            stopping = stop.wait(interval)
+            try:
+                self.export(path)
+            except OSError as e:
+                logging.error(f"Could not export metrics to '{path}': {e}")
+            if stopping:
+                return
+
+
+METRICS = Metrics()
+
+# --- MODEL AND DATABASE CONFIGURATION ---
+GEMINI_MODEL = "gemini-2.5-flash-preview-05-20"
+API_ROOT = "https://generativelanguage.googleapis.com/v1beta/models"
+DB_NAME = "assistant_memory.db"
+
+# --- HTTP CLIENT CONFIGURATION ---
+HTTP_POOL_CONNECTIONS = 2   # Number of distinct hosts kept in the pool
+HTTP_POOL_MAXSIZE = 8       # Keep-alive connections per host
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 25
+
+
+class GeminiClient:
+    """Shared keep-alive HTTP client used by every Gemini call.
+
+    A single requests.Session keeps a pool of open connections, so only the
+    first request pays the TCP+TLS handshake. Conversation, fact extraction
+    and skill generation all go through the same instance.
+    """
+
+    def __init__(self, api_key=None, model=GEMINI_MODEL, api_root=API_ROOT,
+                 pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE,
+                 connect_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=HTTP_READ_TIMEOUT, max_retries=3):
+        self.api_key = api_key
+        self.model = model
+        self.api_root = api_root.rstrip('/')
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        # Created on first use, so `requests` is not imported before the window is shown.
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    # Retries are handled below (429 backoff), so the adapter itself never retries.
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize, max_retries=0)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    session.headers.update({'Content-Type': 'application/json', 'Connection': 'keep-alive'})
+                    self._session = session
+        return self._session
+
+    def url(self, method="generateContent"):
+        return f"{self.api_root}/{self.model}:{method}"
+
+    @METRICS.timed('gemini_request')
+    def generate_content(self, payload, timeout=None):
+        """POSTs a generateContent request and returns the decoded JSON body.
+
+        Rate-limited calls (429) are retried with exponential backoff. Returns
+        None if every attempt was rate-limited; other HTTP errors are raised.
+        """
+        timeout = (self.connect_timeout, timeout or self.read_timeout)
+        for i in range(self.max_retries):
+            response = self.session.post(self.url(), headers={'x-goog-api-key': self.api_key or ''}, json=payload, timeout=timeout)
+            if response.status_code == 200:
+                return response.json()
+            elif response.status_code == 429:
+                logging.warning(f"Rate limit reached. Retrying in {2 ** i}s...")
+                METRICS.increment('gemini_rate_limited')
+                with METRICS.span('gemini_retry_wait'):
+                    time.sleep(2 ** i)
+            else:
+                response.raise_for_status()
+        return None
+
+    def generate_text(self, payload, timeout=None):
+        """Same as generate_content, but returns only the first candidate's text."""
+        result = self.generate_content(payload, timeout=timeout)
+        if result is None:
+            return None
+        return result['candidates'][0]['content']['parts'][0]['text']
+
+    def stream_text(self, payload, timeout=None):
+        """Yields text fragments from `streamGenerateContent` as they arrive.
+
+        Uses the server-sent events variant (`alt=sse`), where each event
+        carries a partial GenerateContentResponse.
+        """
+        timeout = (self.connect_timeout, timeout or self.read_timeout)
+        start = time.perf_counter()
+        for i in range(self.max_retries):
+            response = self.session.post(f"{self.url('streamGenerateContent')}?alt=sse", headers={'x-goog-api-key': self.api_key or ''}, json=payload, timeout=timeout, stream=True)
+            if response.status_code == 200:
+                break
+            elif response.status_code == 429:
+                response.close()
+                logging.warning(f"Rate limit reached. Retrying in {2 ** i}s...")
+                METRICS.increment('gemini_rate_limited')
+                with METRICS.span('gemini_retry_wait'):
+                    time.sleep(2 ** i)
+            else:
+                response.raise_for_status()
+        else:
+            return
+
+        response.encoding = 'utf-8'
+        first = True
+        with response:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+                chunk = json.loads(line[5:])
+                for candidate in chunk.get('candidates', [])[:1]:
+                    for part in candidate.get('content', {}).get('parts', []):
+                        if part.get('text'):
+                            if first:
+                                METRICS.record('gemini_first_token', time.perf_counter() - start)
+                                first = False
+                            yield part['text']
+        METRICS.record('gemini_stream', time.perf_counter() - start)
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+class SentenceSplitter:
+    """Buffers streamed text and returns each sentence as soon as it is complete."""
+    BOUNDARY = re.compile(r'(?<=[.!?…])\s+|\n+')
+
+    def __init__(self):
+        self._buffer = ""
+
+    def feed(self, text):
+        self._buffer += text
+        parts = self.BOUNDARY.split(self._buffer)
+        self._buffer = parts.pop()
+        return [part.strip() for part in parts if part.strip()]
+
+    def flush(self):
+        rest, self._buffer = self._buffer.strip(), ""
+        return [rest] if rest else []
+
+class AudioCapture:
+    """Single microphone reader that fills a ring buffer shared by every audio consumer.
+
+    One thread reads 20 ms chunks of 16 kHz mono PCM and appends them to a
+    fixed NumPy ring. Positions are absolute sample counts, so readers keep
+    their own cursor and the writer never waits for them (a reader that falls
+    more than `seconds` behind skips ahead). Because the ring keeps the recent
+    past, a command recording can start a little before the moment it was
+    requested (the pre-roll). The ambient noise level is tracked continuously
+    from the quiet chunks, replacing per-command calibration.
+    """
+    SAMPLE_RATE = 16000
+    SAMPLE_WIDTH = 2
+    CHUNK = 320
+
+    def __init__(self, seconds=10, open_stream=None):
+        self.capacity = int(seconds * self.SAMPLE_RATE)
+        self.noise_rms = None
+        self.overruns = 0
+        self._ring = np.zeros(self.capacity, dtype=np.int16)
+        self._written = 0
+        self._open_stream = open_stream or (lambda: sr.Microphone(sample_rate=self.SAMPLE_RATE, chunk_size=self.CHUNK))
+        self._new_data = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    @property
+    def position(self):
+        return self._written
+
+    def start(self):
+        self._running = True
+        self._thread = Thread(target=self._run, daemon=True, name="audio-capture")
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread:
+            self._thread.join(1)
+
+    @property
+    def alive(self):
+        return self._running and self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        try:
+            with self._open_stream() as source:
+                logging.info("Audio capture started.")
+                while self._running:
+                    self._append(np.frombuffer(source.stream.read(self.CHUNK), dtype='<i2'))
+        except Exception as e:
+            logging.critical(f"Audio capture stopped: {e}")
+        finally:
+            self._running = False
+            with self._new_data:
+                self._new_data.notify_all()
+
+    def _append(self, samples):
+        start = self._written % self.capacity
+        end = start + len(samples)
+        if end <= self.capacity:
+            self._ring[start:end] = samples
+        else:
+            split = self.capacity - start
+            self._ring[start:] = samples[:split]
+            self._ring[:end - self.capacity] = samples[split:]
+        self._update_noise(samples)
+        # The data is in place before the position moves, so readers never see a half-written chunk.
+        self._written += len(samples)
+        with self._new_data:
+            self._new_data.notify_all()
+
+    def _update_noise(self, samples):
+        rms = float(np.sqrt(np.mean(samples.astype(np.float32) ** 2))) if len(samples) else 0.0
+        if self.noise_rms is None:
+            self.noise_rms = rms
+        elif rms < self.noise_rms:
+            self.noise_rms = 0.7 * self.noise_rms + 0.3 * rms   # Follow quieter rooms quickly
+        else:
+            self.noise_rms = 0.995 * self.noise_rms + 0.005 * rms  # Rise slowly, so speech barely moves it
+
+    def energy_threshold(self, multiplier=3.0, minimum=150):
+        """A speech_recognition energy threshold derived from the current noise estimate."""
+        return max(minimum, (self.noise_rms or 0) * multiplier)
+
+    def read(self, position, count, timeout=1.0):
+        """Returns (samples, next_position) starting at position, waiting until count samples exist."""
+        deadline = time.monotonic() + timeout
+        with self._new_data:
+            while self._written < position + count and self._running:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._new_data.wait(remaining)
+        written = self._written
+        if position < written - self.capacity:
+            self.overruns += 1
+            position = written - self.capacity
+        end = min(position + count, written)
+        if end <= position:
+            return np.zeros(0, dtype=np.int16), position
+        start_index, end_index = position % self.capacity, end % self.capacity
+        if start_index < end_index:
+            samples = self._ring[start_index:end_index].copy()
+        else:
+            samples = np.concatenate([self._ring[start_index:], self._ring[:end_index]])
+        return samples, end
+
+    def source(self, start=None, preroll=0.0):
+        """A speech_recognition AudioSource reading from start (default: now) minus preroll seconds."""
+        position = self._written if start is None else start
+        return CaptureSource(self, max(0, position - int(preroll * self.SAMPLE_RATE)))
+
+
+class CaptureSource(sr.AudioSource):
+    """Adapts an AudioCapture cursor to the AudioSource interface used by sr.Recognizer.listen."""
+
+    def __init__(self, capture, position):
+        self.capture = capture
+        self.position = position
+        self.SAMPLE_RATE = capture.SAMPLE_RATE
+        self.SAMPLE_WIDTH = capture.SAMPLE_WIDTH
+        self.CHUNK = capture.CHUNK
+        self.stream = self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def read(self, size):
+        samples, self.position = self.capture.read(self.position, size)
+        return samples.tobytes()
+
+    def read_frame(self, size):
+        """Returns exactly size samples, or an empty array (without consuming anything) on timeout."""
+        samples, position = self.capture.read(self.position, size)
+        if len(samples) < size:
+            return samples[:0]
+        self.position = position
+        return samples
+
+    def skip_to_live(self):
+        self.position = self.capture.position
+
+
+class SpeechBackend:
+    """Turns the command audio read from a CaptureSource into text.
+
+    `transcribe` raises the speech_recognition exceptions (WaitTimeoutError,
+    UnknownValueError, RequestError) so callers handle every backend alike.
+    Backends that decode while the user speaks call `on_partial(text,
+    stable_seconds)` with the running hypothesis; returning True stops
+    listening and uses that partial text as the command. `on_captured` is
+    called when the audio has been captured but still has to be decoded.
+    """
+    name = "speech"
+
+    def transcribe(self, source, language, on_partial=None, on_captured=None, timeout=5, phrase_time_limit=10):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class GoogleSpeechBackend(SpeechBackend):
+    """The Google Web Speech API through sr.Recognizer; optionally re-decodes locally when offline."""
+    name = "google"
+
+    def __init__(self, recognizer, fallback=None):
+        self.recognizer = recognizer
+        self.fallback = fallback
+
+    def transcribe(self, source, language, on_partial=None, on_captured=None, timeout=5, phrase_time_limit=10):
+        audio = self.recognizer.listen(source, timeout=timeout, phrase_time_limit=phrase_time_limit)
+        if on_captured:
+            on_captured()
+        try:
+            with METRICS.span('stt_google'):
+                return self.recognizer.recognize_google(audio, language=language)
+        except sr.RequestError as e:
+            if not self.fallback:
+                raise
+            logging.warning(f"Google Speech is unreachable ({e}); transcribing with {self.fallback.name} instead.")
+            return self.fallback.transcribe_pcm(audio.get_raw_data(convert_rate=16000, convert_width=2))
+
+
+class VoskSpeechBackend(SpeechBackend):
+    """Offline Kaldi decoding with Vosk. The model is loaded once and reused for every command."""
+    name = "vosk"
+    CHUNK = 1600  # 100 ms per decoder step
+
+    def __init__(self, model_path, sample_rate=16000):
+        self.sample_rate = sample_rate
+        self.model = vosk.Model(model_path)
+
+    def transcribe(self, source, language, on_partial=None, on_captured=None, timeout=5, phrase_time_limit=10):
+        recognizer = vosk.KaldiRecognizer(self.model, self.sample_rate)
+        step = self.CHUNK / self.sample_rate
+        heard, speech_started_at, last_partial, stable = 0.0, None, "", 0.0
+        while True:
+            frame = source.read_frame(self.CHUNK)
+            if not len(frame):
+                if not source.capture.alive:
+                    break
+                continue
+            heard += step
+            if recognizer.AcceptWaveform(frame.tobytes()):
+                # Vosk detected the end of an utterance.
+                text = json.loads(recognizer.Result()).get('text', '')
+                if text:
+                    return text
+                continue
+            partial = json.loads(recognizer.PartialResult()).get('partial', '')
+            if partial:
+                if speech_started_at is None:
+                    speech_started_at = heard
+                stable = stable + step if partial == last_partial else 0.0
+                last_partial = partial
+                if on_partial and on_partial(partial, stable):
+                    return partial
+                if heard - speech_started_at > phrase_time_limit:
+                    break
+            elif speech_started_at is None and heard > timeout:
+                raise sr.WaitTimeoutError("listening timed out while waiting for phrase to start")
+        text = json.loads(recognizer.FinalResult()).get('text', '')
+        if not text:
+            raise sr.UnknownValueError()
+        return text
+
+    def transcribe_pcm(self, pcm):
+        recognizer = vosk.KaldiRecognizer(self.model, self.sample_rate)
+        recognizer.AcceptWaveform(pcm)
+        text = json.loads(recognizer.FinalResult()).get('text', '')
+        if not text:
+            raise sr.UnknownValueError()
+        return text
+
+
+class VoiceActivityGate:
+    """Decides locally whether a recorded segment could contain the wake phrase.
+
+    Each 20 ms frame of 16-bit mono PCM is classified as speech from three
+    vectorized features: energy above an adaptive noise floor, a zero-crossing
+    rate in the range of voiced speech and a low spectral flatness (speech is
+    harmonic, hiss is not). A hangover keeps short pauses between syllables
+    inside the speech region. A segment is accepted only when its speech region
+    lasts about as long as the wake phrase and its loudness rises and falls
+    like syllables do, which rules out steady noise such as fans and hum.
+    """
+
+    def __init__(self, sample_rate=16000, frame_ms=20, min_speech=0.3, max_speech=2.5, margin_db=10.0,
+                 min_energy_db=-55.0, zcr_range=(0.01, 0.35), max_flatness=0.45, hangover_ms=200, min_voiced_ratio=0.35,
+                 min_modulation_db=8.0):
+        self.sample_rate = sample_rate
+        self.frame_length = int(sample_rate * frame_ms / 1000)
+        self.frame_seconds = self.frame_length / sample_rate
+        self.min_speech = min_speech
+        self.max_speech = max_speech
+        self.margin_db = margin_db
+        self.min_energy_db = min_energy_db
+        self.zcr_range = zcr_range
+        self.max_flatness = max_flatness
+        self.hangover_frames = max(int(hangover_ms / frame_ms), 0)
+        self.min_voiced_ratio = min_voiced_ratio
+        self.min_modulation_db = min_modulation_db
+        self.noise_floor_db = None
+        self.stats = {'frames': 0, 'segments': 0, 'sent': 0, 'rejected_silence': 0, 'rejected_duration': 0, 'rejected_stationary': 0}
+        self._window = np.hanning(self.frame_length).astype(np.float32)
+        freqs = np.fft.rfftfreq(self.frame_length, 1.0 / sample_rate)
+        self._band = (freqs >= 100) & (freqs <= 4000)
+
+    def frame_features(self, pcm):
+        """Returns (energy_db, zcr, flatness) arrays, one value per frame."""
+        samples = np.frombuffer(pcm, dtype='<i2') if isinstance(pcm, (bytes, bytearray)) else np.asarray(pcm)
+        count = len(samples) // self.frame_length
+        frames = samples[:count * self.frame_length].reshape(count, self.frame_length).astype(np.float32) / 32768.0
+        energy_db = 10.0 * np.log10(np.mean(frames * frames, axis=1) + 1e-10)
+        signs = np.signbit(frames)
+        zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / float(self.frame_length - 1)
+        power = np.abs(np.fft.rfft(frames * self._window, axis=1))[:, self._band] ** 2 + 1e-12
+        flatness = np.exp(np.mean(np.log(power), axis=1)) / np.mean(power, axis=1)
+        return energy_db, zcr, flatness
+
+    def speech_mask(self, pcm):
+        return self._classify(pcm)[0]
+
+    def _classify(self, pcm):
+        energy_db, zcr, flatness = self.frame_features(pcm)
+        if not len(energy_db):
+            return np.zeros(0, dtype=bool), energy_db
+        # The quietest frames of each segment track the room noise level.
+        quiet_db = float(np.percentile(energy_db, 10))
+        self.noise_floor_db = quiet_db if self.noise_floor_db is None else 0.8 * self.noise_floor_db + 0.2 * quiet_db
+        threshold = max(self.min_energy_db, self.noise_floor_db + self.margin_db)
+        voiced = (energy_db > threshold) & (zcr > self.zcr_range[0]) & (zcr < self.zcr_range[1]) & (flatness < self.max_flatness)
+        if self.hangover_frames:
+            # Each voiced frame keeps the following hangover_frames marked as speech.
+            voiced = np.convolve(voiced, np.ones(self.hangover_frames + 1), mode='full')[:len(voiced)] > 0
+        return voiced, energy_db
+
+    def accept(self, pcm):
+        """True when the segment should be sent to speech recognition."""
+        mask, energy_db = self._classify(pcm)
+        self.stats['frames'] += len(mask)
+        self.stats['segments'] += 1
+        indices = np.flatnonzero(mask)
+        if not len(indices):
+            self.stats['rejected_silence'] += 1
+            return False
+        span = indices[-1] - indices[0] + 1
+        duration = span * self.frame_seconds
+        if len(indices) / span < self.min_voiced_ratio:
+            self.stats['rejected_silence'] += 1
+            return False
+        if not self.min_speech <= duration <= self.max_speech:
+            self.stats['rejected_duration'] += 1
+            return False
+        low, high = np.percentile(energy_db[indices[0]:indices[-1] + 1], [10, 90])
+        if high - low < self.min_modulation_db:
+            self.stats['rejected_stationary'] += 1
+            return False
+        self.stats['sent'] += 1
+        return True
+
+class MfccExtractor:
+    """Log-mel cepstral coefficients (c1..c12) from 16-bit PCM, 25 ms windows every 10 ms."""
+
+    def __init__(self, sample_rate=16000, n_mfcc=13, n_mels=26, window=400, hop=160, nfft=512):
+        self.window = window
+        self.hop = hop
+        self.nfft = nfft
+        self._hamming = np.hamming(window).astype(np.float32)
+        mel = lambda hz: 2595.0 * np.log10(1.0 + hz / 700.0)
+        hz = lambda m: 700.0 * (10 ** (m / 2595.0) - 1.0)
+        edges = np.floor((nfft + 1) * hz(np.linspace(mel(60), mel(sample_rate / 2), n_mels + 2)) / sample_rate).astype(int)
+        filters = np.zeros((n_mels, nfft // 2 + 1), dtype=np.float32)
+        for m in range(1, n_mels + 1):
+            left, center, right = edges[m - 1], edges[m], edges[m + 1]
+            filters[m - 1, left:center] = (np.arange(left, center) - left) / max(center - left, 1)
+            filters[m - 1, center:right] = (right - np.arange(center, right)) / max(right - center, 1)
+        self._filters = filters.T
+        n = np.arange(n_mels)
+        self._dct = np.cos(np.pi / n_mels * (n[:, None] + 0.5) * np.arange(1, n_mfcc)[None, :]).astype(np.float32)
+
+    def features(self, samples):
+        """Returns an (n_frames, n_mfcc - 1) array; samples shorter than one window give no frames."""
+        samples = np.asarray(samples, dtype=np.float32) / 32768.0
+        if len(samples) < self.window:
+            return np.zeros((0, self._dct.shape[1]), dtype=np.float32)
+        emphasized = np.append(samples[0], samples[1:] - 0.97 * samples[:-1])
+        count = 1 + (len(emphasized) - self.window) // self.hop
+        frames = np.lib.stride_tricks.as_strided(
+            emphasized, shape=(count, self.window), strides=(emphasized.strides[0] * self.hop, emphasized.strides[0]))
+        power = np.abs(np.fft.rfft(frames * self._hamming, self.nfft, axis=1)) ** 2
+        return np.log(power @ self._filters + 1e-8) @ self._dct
+
+
+class WakeWordBackend:
+    """Local keyword spotter fed with fixed-size frames of 16 kHz 16-bit mono PCM.
+
+    Subclasses implement `process(frame) -> bool`. `detect` wraps it to count
+    frames and measure the CPU time spent per frame.
+    """
+    name = "local"
+    sample_rate = 16000
+    frame_length = 512
+    # Word the backend actually listens for; None means the assistant's own wake phrase.
+    phrase = None
+
+    def __init__(self):
+        self.stats = {'frames': 0, 'detections': 0, 'busy_seconds': 0.0, 'max_frame_ms': 0.0}
+
+    def detect(self, frame):
+        start = time.perf_counter()
+        detected = self.process(frame)
+        elapsed = time.perf_counter() - start
+        self.stats['frames'] += 1
+        self.stats['busy_seconds'] += elapsed
+        self.stats['max_frame_ms'] = max(self.stats['max_frame_ms'], elapsed * 1000)
+        if detected:
+            self.stats['detections'] += 1
+        return detected
+
+    def process(self, frame):
+        raise NotImplementedError
+
+    def cost_summary(self):
+        frames = self.stats['frames']
+        if not frames:
+            return {'frames': 0}
+        audio_seconds = frames * self.frame_length / self.sample_rate
+        return {'frames': frames, 'detections': self.stats['detections'],
+                'mean_frame_us': round(self.stats['busy_seconds'] / frames * 1e6, 1),
+                'max_frame_ms': round(self.stats['max_frame_ms'], 2),
+                'real_time_factor': round(self.stats['busy_seconds'] / audio_seconds, 4)}
+
+    def close(self):
+        pass
+
+
+class PorcupineWakeWord(WakeWordBackend):
+    """Picovoice Porcupine; needs an access key and a keyword file (.ppn) or built-in keyword."""
+    name = "porcupine"
+
+    def __init__(self, access_key, keyword_path=None, keyword=None, sensitivity=0.6):
+        super().__init__()
+        self._porcupine = pvporcupine.create(
+            access_key=access_key,
+            keyword_paths=[keyword_path] if keyword_path else None,
+            keywords=None if keyword_path else [keyword or "computer"],
+            sensitivities=[sensitivity],
+        )
+        # A keyword file is trained for the assistant's phrase; a built-in keyword is its own word.
+        self.phrase = None if keyword_path else (keyword or "computer")
+        self.sample_rate = self._porcupine.sample_rate
+        self.frame_length = self._porcupine.frame_length
+
+    def process(self, frame):
+        return self._porcupine.process(frame) >= 0
+
+    def close(self):
+        self._porcupine.delete()
+
+
+class TemplateWakeWord(WakeWordBackend):
+    """Matches the user's own recordings of the wake phrase with MFCCs and subsequence DTW.
+
+    Incoming audio is turned into MFCC frames incrementally. Every
+    `check_every` frames the recent history is aligned against each enrolled
+    template with a slope-constrained DTW that is vectorized along the time
+    axis, and a detection fires when the best path cost ends within the last
+    `end_window` frames and is below the threshold. Without an explicit
+    threshold it is calibrated from how far the templates are from each other.
+    """
+    name = "template"
+    frame_length = 320  # 20 ms
+    TEMPLATE_PREFIX = "wake_template_"
+
+    def __init__(self, templates, threshold=None, threshold_scale=1.8, check_every=5, end_window=25, refractory=1.5):
+        super().__init__()
+        if not templates:
+            raise ValueError("at least one wake word template is needed")
+        self.mfcc = MfccExtractor(self.sample_rate)
+        self.templates = [self._normalize(t) for t in templates]
+        if threshold is None:
+            threshold = self.calibrate(self.templates) * threshold_scale
+        self.threshold = threshold
+        self.check_every = check_every
+        self.end_window = end_window
+        self.refractory_frames = int(refractory * self.sample_rate / self.frame_length)
+        self.last_score = None
+        longest = max(len(t) for t in self.templates)
+        self._history = collections.deque(maxlen=2 * longest + end_window)
+        self._pending = np.zeros(0, dtype=np.int16)
+        self._since_check = 0
+        self._cooldown = 0
+
+    @staticmethod
+    def _normalize(features):
+        features = np.asarray(features, dtype=np.float32)
+        return features - features.mean(axis=0)
+
+    @staticmethod
+    def dtw_costs(template, query):
+        """Normalized cost of the best alignment of the whole template ending at each query frame.
+
+        Steps are (1,1), (1,2) and (2,1), so each template row only depends on
+        the two previous rows and can be computed for all query frames at once.
+        The start is free: the template may begin anywhere in the query.
+        """
+        cost = np.sqrt(np.maximum(
+            (template * template).sum(1)[:, None] + (query * query).sum(1)[None, :] - 2.0 * template @ query.T, 0.0))
+        previous2 = np.full(len(query), np.inf, dtype=np.float32)
+        previous = cost[0]
+        for row in cost[1:]:
+            best = np.full(len(query), np.inf, dtype=np.float32)
+            best[1:] = np.minimum(previous[:-1], previous2[:-1])
+            best[2:] = np.minimum(best[2:], previous[:-2])
+            previous2, previous = previous, row + best
+        return previous / len(template)
+
+    @classmethod
+    def calibrate(cls, templates):
+        if len(templates) < 2:
+            raise ValueError("at least two templates are needed to calibrate the threshold")
+        distances = [cls.dtw_costs(a, b).min() for i, a in enumerate(templates) for j, b in enumerate(templates) if i != j]
+        return float(np.max(distances))
+
+    def process(self, frame):
+        self._pending = np.concatenate([self._pending, np.asarray(frame, dtype=np.int16)])
+        if len(self._pending) >= self.mfcc.window:
+            features = self.mfcc.features(self._pending)
+            self._history.extend(features)
+            self._pending = self._pending[len(features) * self.mfcc.hop:]
+        if self._cooldown:
+            self._cooldown -= 1
+            return False
+        self._since_check += 1
+        if self._since_check < self.check_every or len(self._history) < min(len(t) for t in self.templates):
+            return False
+        self._since_check = 0
+        history = np.array(self._history)
+        scores = []
+        for template in self.templates:
+            # Cepstral mean normalization over a stretch about as long as the template, not the whole history.
+            query = self._normalize(history[-(len(template) + self.end_window):])
+            scores.append(float(self.dtw_costs(template, query)[-self.end_window:].min()))
+        self.last_score = min(scores)
+        if self.last_score < self.threshold:
+            self._cooldown = self.refractory_frames
+            self._history.clear()
+            return True
+        return False
+
+    @classmethod
+    def load(cls, directory, **kwargs):
+        """Returns a matcher for the templates saved in directory, or None if there are not enough."""
+        if not os.path.isdir(directory):
+            return None
+        templates = [np.load(os.path.join(directory, name)) for name in sorted(os.listdir(directory))
+                     if name.startswith(cls.TEMPLATE_PREFIX) and name.endswith('.npy')]
+        if len(templates) < 2 and kwargs.get('threshold') is None:
+            return None
+        return cls(templates, **kwargs) if templates else None
+
+    @classmethod
+    def enroll(cls, directory, recordings, vad=None):
+        """Saves MFCC templates from PCM recordings of the wake phrase, trimmed to their speech region."""
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.startswith(cls.TEMPLATE_PREFIX):
+                os.remove(os.path.join(directory, name))
+        vad = vad or VoiceActivityGate()
+        mfcc = MfccExtractor(cls.sample_rate)
+        saved = 0
+        for pcm in recordings:
+            samples = np.frombuffer(pcm, dtype='<i2') if isinstance(pcm, (bytes, bytearray)) else np.asarray(pcm, dtype=np.int16)
+            speech = np.flatnonzero(vad.speech_mask(samples))
+            if len(speech):
+                samples = samples[speech[0] * vad.frame_length:(speech[-1] + 1) * vad.frame_length]
+            features = mfcc.features(samples)
+            if len(features) >= 20:
+                np.save(os.path.join(directory, f"{cls.TEMPLATE_PREFIX}{saved}.npy"), features)
+                saved += 1
+        return saved
+
+
+class PhraseAudioCache:
+    """On-disk WAV cache for fixed phrases the assistant says again and again.
+
+    Only registered phrases (split into sentences, like the TTS chunks) are
+    cached. Files are keyed on text, voice and rate, so changing either renders
+    the phrase again. The least recently played files are evicted once the
+    directory exceeds `max_entries` or `max_bytes`. Playback uses winsound.
+    """
+
+    def __init__(self, directory, phrases=(), max_entries=300, max_bytes=30 * 1024 * 1024):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stats = {'hits': 0, 'misses': 0, 'rendered': 0, 'evictions': 0}
+        self._phrases = set()
+        os.makedirs(directory, exist_ok=True)
+        self.add_phrases(phrases)
+
+    def add_phrases(self, texts):
+        for text in texts:
+            splitter = SentenceSplitter()
+            self._phrases.update(splitter.feed(text) + splitter.flush())
+
+    def wants(self, text):
+        return text in self._phrases
+
+    def path_for(self, text, voice, rate):
+        key = hashlib.sha256(json.dumps([text, voice, rate], ensure_ascii=False).encode('utf-8')).hexdigest()[:32]
+        return os.path.join(self.directory, f"{key}.wav")
+
+    def lookup(self, text, voice, rate):
+        path = self.path_for(text, voice, rate)
+        try:
+            os.utime(path)  # The modification time doubles as the LRU clock
+        except OSError:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        return path
+
+    def temp_path(self):
+        return os.path.join(self.directory, f"render_{os.getpid()}.tmp")
+
+    def store(self, temp_path, text, voice, rate):
+        try:
+            with wave.open(temp_path, 'rb') as wav:
+                if wav.getnframes() == 0:
+                    raise wave.Error("no audio frames")
+            os.replace(temp_path, self.path_for(text, voice, rate))
+        except (OSError, EOFError, wave.Error) as e:
+            logging.warning(f"Could not cache the audio for '{text}': {e}")
+            return False
+        self.stats['rendered'] += 1
+        self._evict()
+        return True
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.wav'):
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        while entries and (len(entries) > self.max_entries or total > self.max_bytes):
+            _, size, path = entries.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.stats['evictions'] += 1
+
+    def play(self, path):
+        """Starts playing a cached file asynchronously and returns its duration in seconds."""
+        with wave.open(path, 'rb') as wav:
+            duration = wav.getnframes() / float(wav.getframerate())
+        winsound.PlaySound(path, winsound.SND_FILENAME | winsound.SND_ASYNC | winsound.SND_NODEFAULT)
+        return duration
+
+    def stop(self):
+        winsound.PlaySound(None, winsound.SND_PURGE)
+
+class TTSScheduler:
+    """Speaks queued text on a dedicated engine thread, one sentence at a time.
+
+    The worker blocks on a priority queue while idle and only pumps the engine
+    loop while an utterance is playing. `cancel()` stops the current sentence
+    and discards everything queued before it, which is how a wake word or a new
+    command barges in. The engine comes from `engine_factory`, called on the
+    worker thread, so a fake pyttsx3-like object can stand in for tests.
+
+    With an `audio_cache`, registered phrases are played from disk when they
+    have been rendered before; otherwise they are spoken normally and rendered
+    afterwards at low priority.
+    """
+    PRIORITY_HIGH = 0
+    PRIORITY_NORMAL = 10
+    PRIORITY_LOW = 20
+    RENDER_TIMEOUT = 15
+    ITERATE_INTERVAL = 0.02  # Engine pump period while speaking; also bounds the cancellation latency
+    STATS_WINDOW = 200
+
+    def __init__(self, engine_factory, on_idle=None, audio_cache=None):
+        self._engine_factory = engine_factory
+        self._on_idle = on_idle
+        self.audio_cache = audio_cache
+        self.engine = None
+        self.stats = {'spoken': 0, 'cancelled': 0, 'queue_wait': collections.deque(maxlen=self.STATS_WINDOW),
+                      'start_latency': collections.deque(maxlen=self.STATS_WINDOW)}
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._generation = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._finished = False
+        self._started_at = None
+        self._thread = Thread(target=self._run, daemon=True, name="tts")
+        self._thread.start()
+
+    @property
+    def busy(self):
+        return self._pending > 0
+
+    @property
+    def generation(self):
+        """Changes on every cancel(); a streamed reply passes the value it started with to say()."""
+        return self._generation
+
+    def say(self, text, priority=PRIORITY_NORMAL, generation=None):
+        """Queues text; with `generation`, text from speech that has been cancelled since is dropped."""
+        splitter = SentenceSplitter()
+        chunks = splitter.feed(str(text)) + splitter.flush()
+        with self._lock:
+            if generation is None:
+                generation = self._generation
+            elif generation != self._generation:
+                self.stats['cancelled'] += len(chunks)
+                return
+            self._pending += len(chunks)
+        for chunk in chunks:
+            self._queue.put((priority, next(self._seq), ('say', chunk, time.perf_counter(), generation)))
+
+    def prewarm(self, texts):
+        """Renders the cacheable sentences of texts in the background, behind any speech."""
+        if not self.audio_cache:
+            return
+        for text in texts:
+            splitter = SentenceSplitter()
+            for chunk in splitter.feed(text) + splitter.flush():
+                self._queue.put((self.PRIORITY_LOW, next(self._seq), ('render', chunk)))
+
+    def configure(self, action):
+        """Runs action(engine) on the engine thread before any queued speech."""
+        self._queue.put((-1, next(self._seq), action))
+
+    def cancel(self):
+        """Stops the current utterance and drops everything queued so far."""
+        with self._lock:
+            self._generation += 1
+        self._wake.set()
+
+    def close(self, timeout=2):
+        self.cancel()
+        self._queue.put((sys.maxsize, next(self._seq), None))
+        self._thread.join(timeout)
+
+    def latency_summary(self):
+        summary = {'spoken': self.stats['spoken'], 'cancelled': self.stats['cancelled']}
+        for name in ('queue_wait', 'start_latency'):
+            values = sorted(self.stats[name])
+            if values:
+                summary[f'{name}_p50_ms'] = round(values[len(values) // 2] * 1000, 1)
+                summary[f'{name}_max_ms'] = round(values[-1] * 1000, 1)
+        return summary
+
+    def _on_started(self, name=None):
+        self._started_at = time.perf_counter()
+
+    def _on_finished(self, name=None, completed=True):
+        self._finished = True
+        self._wake.set()
+
+    def _done_with(self):
+        with self._lock:
+            self._pending -= 1
+            idle = self._pending <= 0
+        if idle and self._on_idle:
+            self._on_idle()
+
+    def _run(self):
+        try:
+            engine = self._engine_factory()
+            engine.connect('started-utterance', self._on_started)
+            engine.connect('finished-utterance', self._on_finished)
+            engine.startLoop(False)
+            self.engine = engine
+        except Exception as e:
+            logging.critical(f"Could not initialize the TTS engine: {e}")
+        while True:
+            _, _, item = self._queue.get()
+            if item is None:
+                break
+            if callable(item):
+                if self.engine:
+                    try:
+                        item(self.engine)
+                    except Exception as e:
+                        logging.error(f"Error configuring the TTS engine: {e}")
+                continue
+            if item[0] == 'render':
+                if self.engine:
+                    self._render(item[1])
+                continue
+            _, text, enqueued_at, generation = item
+            if self.engine and generation == self._generation:
+                self._speak(text, enqueued_at, generation)
+            else:
+                self.stats['cancelled'] += 1
+            self._done_with()
+        if self.engine:
+            self.engine.endLoop()
+
+    def _voice_and_rate(self):
+        return self.engine.getProperty('voice'), self.engine.getProperty('rate')
+
+    def _speak(self, text, enqueued_at, generation):
+        said_at = time.perf_counter()
+        self.stats['queue_wait'].append(said_at - enqueued_at)
+        METRICS.record('tts_queue_wait', said_at - enqueued_at)
+        if self.audio_cache and self.audio_cache.wants(text):
+            path = self.audio_cache.lookup(text, *self._voice_and_rate())
+            if path:
+                self._play_cached(path, generation, said_at)
+                return
+            self._queue.put((self.PRIORITY_LOW, next(self._seq), ('render', text)))
+        self._finished = False
+        self._started_at = None
+        self._wake.clear()
+        try:
+            self.engine.say(text)
+            while not self._finished:
+                if generation != self._generation:
+                    self.engine.stop()
+                    self.engine.iterate()
+                    self.stats['cancelled'] += 1
+                    METRICS.increment('tts_cancelled')
+                    return
+                self.engine.iterate()
+                self._wake.wait(self.ITERATE_INTERVAL)
+                self._wake.clear()
+        except Exception as e:
+            logging.error(f"Error speaking text: {e}")
+            return
+        if self._started_at is not None:
+            self.stats['start_latency'].append(self._started_at - said_at)
+            METRICS.record('tts_start', self._started_at - said_at)
+        METRICS.record('tts_utterance', time.perf_counter() - said_at)
+        self.stats['spoken'] += 1
+
+    def _play_cached(self, path, generation, said_at):
+        try:
+            duration = self.audio_cache.play(path)
+        except Exception as e:
+            logging.error(f"Error playing cached audio: {e}")
+            return
+        self.stats['start_latency'].append(time.perf_counter() - said_at)
+        METRICS.record('tts_start', time.perf_counter() - said_at)
+        self._wake.clear()
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            if generation != self._generation:
+                self.audio_cache.stop()
+                self.stats['cancelled'] += 1
+                return
+            self._wake.wait(deadline - time.perf_counter())
+            self._wake.clear()
+        self.stats['spoken'] += 1
+
+    def _render(self, text):
+        voice, rate = self._voice_and_rate()
+        if os.path.exists(self.audio_cache.path_for(text, voice, rate)):
+            return
+        temp_path = self.audio_cache.temp_path()
+        self._finished = False
+        self._wake.clear()
+        try:
+            self.engine.save_to_file(text, temp_path)
+            deadline = time.perf_counter() + self.RENDER_TIMEOUT
+            while not self._finished and time.perf_counter() < deadline:
+                self.engine.iterate()
+                self._wake.wait(self.ITERATE_INTERVAL)
+                self._wake.clear()
+        except Exception as e:
+            logging.error(f"Error rendering '{text}' to audio: {e}")
+            return
+        self.audio_cache.store(temp_path, text, voice, rate)
+
+class ResponseCache:
+    """Persistent cache of Gemini replies with TTL, size-bounded LRU eviction and single-flight.
+
+    Entries live in their own SQLite file and are keyed on a hash of the model,
+    system instruction, normalized query and generation config. Concurrent
+    lookups of the same key while it is being computed wait for the first
+    caller instead of issuing duplicate requests.
+    """
+
+    def __init__(self, path, ttl=86400, max_entries=500, max_bytes=5 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'evictions': 0}
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, created REAL, last_access REAL, size INTEGER)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_access ON responses (last_access)")
+        self._conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model, system_instruction, query, generation_config=None, history=None):
+        normalized_query = re.sub(r'\s+', ' ', query.strip().lower())
+        material = json.dumps([model, system_instruction, normalized_query, generation_config, history or []], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if time.time() - row[1] > self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return row[0]
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO responses (key, value, created, last_access, size) VALUES (?, ?, ?, ?, ?)",
+                               (key, value, now, now, len(value.encode('utf-8'))))
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        victims = []
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            victims.append((key,))
+            count -= 1
+            total -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", victims)
+        self.stats['evictions'] += len(victims)
+
+    def get_or_compute(self, key, compute):
+        """Returns the cached value for key, or runs compute() once and caches its result.
+
+        compute() may return None to signal a failure that must not be cached.
+        """
+        value = self.get(key)
+        if value is not None:
+            with self._lock:
+                self.stats['hits'] += 1
+            return value
+
+        with self._lock:
+            flight = self._inflight.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = self._inflight[key] = {'event': threading.Event(), 'value': None, 'error': None}
+                self.stats['misses'] += 1
+            else:
+                self.stats['coalesced'] += 1
+        if not is_leader:
+            flight['event'].wait()
+            if flight['error']:
+                raise flight['error']
+            return flight['value']
+
+        try:
+            flight['value'] = compute()
+            if flight['value'] is not None:
+                self.put(key, flight['value'])
+            return flight['value']
+        except Exception as e:
+            flight['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight['event'].set()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class FactRetriever:
+    """Selects the user facts relevant to a query instead of sending every stored fact.
+
+    Candidates come from an FTS5 index over `user_facts` (ranked by BM25) and
+    are re-scored locally with character-trigram cosine similarity plus a small
+    recency bonus. The best ones are kept up to `top_k` facts and an approximate
+    token budget. When nothing matches, the most recent facts are used instead.
+    """
+    CANDIDATES = 50
+    STOPWORDS = frozenset(
+        "a an and are as at be but by can do does for from have how i in is it me my of on or so that the this to was what "
+        "when where which who why will with you your al con de del el en es la las lo los me mi por que se su un una y yo".split()
+    )
+
+    def __init__(self, top_k=8, token_budget=250):
+        self.top_k = top_k
+        self.token_budget = token_budget
+        self.fts_available = None  # Detected on first use
+
+    @staticmethod
+    def create_schema(conn):
+        """Creates the FTS5 index and the triggers that keep it in sync with user_facts."""
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_user_facts_recent ON user_facts (user_id, timestamp)")
+        try:
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'user_facts_fts'").fetchone()
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS user_facts_fts USING fts5(fact, content='user_facts', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2')")
+            conn.execute("CREATE TRIGGER IF NOT EXISTS user_facts_ai AFTER INSERT ON user_facts BEGIN "
+                         "INSERT INTO user_facts_fts(rowid, fact) VALUES (new.rowid, new.fact); END")
+            conn.execute("CREATE TRIGGER IF NOT EXISTS user_facts_ad AFTER DELETE ON user_facts BEGIN "
+                         "INSERT INTO user_facts_fts(user_facts_fts, rowid, fact) VALUES ('delete', old.rowid, old.fact); END")
+            conn.execute("CREATE TRIGGER IF NOT EXISTS user_facts_au AFTER UPDATE ON user_facts BEGIN "
+                         "INSERT INTO user_facts_fts(user_facts_fts, rowid, fact) VALUES ('delete', old.rowid, old.fact); "
+                         "INSERT INTO user_facts_fts(rowid, fact) VALUES (new.rowid, new.fact); END")
+            if not exists:
+                conn.execute("INSERT INTO user_facts_fts(user_facts_fts) VALUES ('rebuild')")
+            return True
+        except sqlite3.OperationalError as e:
+            logging.warning(f"SQLite FTS5 is not available, falling back to recent facts only: {e}")
+            return False
+
+    @staticmethod
+    def estimate_tokens(text):
+        return len(text) // 4 + 1
+
+    @staticmethod
+    def _trigrams(text):
+        text = f"  {text.lower()} "
+        return collections.Counter(text[i:i + 3] for i in range(len(text) - 2))
+
+    @staticmethod
+    def _cosine(a, b):
+        dot = sum(count * b[gram] for gram, count in a.items() if gram in b)
+        if not dot:
+            return 0.0
+        return dot / (math.sqrt(sum(v * v for v in a.values())) * math.sqrt(sum(v * v for v in b.values())))
+
+    def _match_expression(self, query):
+        terms = [t for t in re.findall(r'\w+', query.lower()) if len(t) > 1 and t not in self.STOPWORDS]
+        return " OR ".join(f'"{t}"*' for t in dict.fromkeys(terms))
+
+    def retrieve(self, conn, user_id, query):
+        """Returns the selected facts for user_id, most relevant first."""
+        if self.fts_available is None:
+            self.fts_available = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'user_facts_fts'").fetchone() is not None
+        candidates = []
+        expression = self._match_expression(query or "") if self.fts_available else ""
+        if expression:
+            candidates = conn.execute(
+                "SELECT f.fact, bm25(user_facts_fts), f.rowid FROM user_facts_fts JOIN user_facts f ON f.rowid = user_facts_fts.rowid "
+                "WHERE user_facts_fts MATCH ? AND f.user_id = ? ORDER BY bm25(user_facts_fts) LIMIT ?",
+                (expression, user_id, self.CANDIDATES)).fetchall()
+
+        selected, used_tokens = [], 0
+        if candidates:
+            query_grams = self._trigrams(query)
+            best_bm25 = min(rank for _, rank, _ in candidates) or -1.0
+            newest = max(rowid for _, _, rowid in candidates)
+            scored = []
+            for fact, rank, rowid in candidates:
+                # bm25() is negative, lower is better; normalize it to (0, 1].
+                score = 0.6 * (rank / best_bm25) + 0.35 * self._cosine(query_grams, self._trigrams(fact)) + 0.05 * (rowid / newest)
+                scored.append((score, fact))
+            scored.sort(reverse=True)
+            for _, fact in scored:
+                if len(selected) >= self.top_k:
+                    break
+                cost = self.estimate_tokens(fact)
+                if used_tokens + cost > self.token_budget:
+                    continue
+                selected.append(fact)
+                used_tokens += cost
+
+        if len(selected) < self.top_k:
+            for (fact,) in conn.execute("SELECT fact FROM user_facts WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?", (user_id, self.top_k)):
+                if len(selected) >= self.top_k:
+                    break
+                cost = self.estimate_tokens(fact)
+                if fact in selected or used_tokens + cost > self.token_budget:
+                    continue
+                selected.append(fact)
+                used_tokens += cost
+        return selected
+
+class MemoryStore:
+    """Long-term SQLite memory with per-thread readers and a single batching writer.
+
+    The database runs in WAL mode, so readers never wait for the writer. Every
+    write is queued and applied by one dedicated thread, which groups whatever
+    is pending into a single transaction. Statements are kept as constant SQL
+    strings so each connection's statement cache reuses the prepared form.
+    The schema is versioned through `PRAGMA user_version`.
+    """
+    INSERT_FACT_SQL = "INSERT OR IGNORE INTO user_facts (user_id, fact) VALUES (?, ?)"
+
+    def __init__(self, path, batch_size=64, batch_delay=0.05):
+        self.path = path
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self._local = threading.local()
+        self._writes = queue.Queue()
+        conn = self._connect()
+        self._migrate(conn)
+        conn.close()
+        self._writer = Thread(target=self._writer_loop, daemon=True, name="memory-writer")
+        self._writer.start()
+
+    # Each migration brings the schema from version N-1 to version N.
+    @staticmethod
+    def _migration_1_user_facts(conn):
+        conn.execute("CREATE TABLE IF NOT EXISTS user_facts (user_id TEXT, fact TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (user_id, fact))")
+
+    @staticmethod
+    def _migration_2_fact_index(conn):
+        FactRetriever.create_schema(conn)
+
+    @staticmethod
+    def _migration_3_chat_messages(conn):
+        ChatHistoryStore.create_schema(conn)
+
+    MIGRATIONS = [_migration_1_user_facts, _migration_2_fact_index, _migration_3_chat_messages]
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, cached_statements=128)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _migrate(self, conn):
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, migration in enumerate(self.MIGRATIONS[version:], start=version + 1):
+            with conn:
+                migration(conn)
+                conn.execute(f"PRAGMA user_version = {number}")
+            logging.info(f"Memory database migrated to schema version {number}.")
+
+    def reader(self):
+        """Returns this thread's long-lived read connection."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    def write(self, sql, rows):
+        """Queues `executemany(sql, rows)` for the writer thread."""
+        self._writes.put((sql, list(rows)))
+
+    def add_facts(self, user_id, facts):
+        self.write(self.INSERT_FACT_SQL, [(user_id, fact.strip()) for fact in facts if fact and fact.strip()])
+
+    def flush(self, timeout=5):
+        """Blocks until every write queued so far has been committed."""
+        done = threading.Event()
+        self._writes.put(done)
+        return done.wait(timeout)
+
+    def _writer_loop(self):
+        conn = self._connect()
+        running = True
+        while running:
+            batch = [self._writes.get()]
+            deadline = time.monotonic() + self.batch_delay
+            while len(batch) < self.batch_size and not isinstance(batch[-1], threading.Event) and batch[-1] is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._writes.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            waiters = []
+            for item in batch:
+                if item is None:
+                    running = False
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    try:
+                        conn.executemany(*item)
+                    except sqlite3.Error as e:
+                        logging.error(f"Error writing to memory: {e}")
+            try:
+                conn.commit()
+            except sqlite3.Error as e:
+                logging.error(f"Error committing memory batch: {e}")
+            for waiter in waiters:
+                waiter.set()
+        conn.close()
+
+    def close(self, timeout=5):
+        self._writes.put(None)
+        self._writer.join(timeout)
+
+class ChatHistoryStore:
+    """Append-only chat log stored in the memory database, with paging and full-text search.
+
+    Each message is queued to the MemoryStore writer as soon as it is shown, so
+    a crash loses at most the last uncommitted batch. Only a bounded window of
+    recent messages is kept in memory; older ones are read back page by page.
+    Messages shown before the database is open stay in the window until
+    `attach` writes them; rows up to `session_start_id` are from earlier runs.
+    """
+    INSERT_SQL = "INSERT INTO chat_messages (text, is_assistant, tag, timestamp) VALUES (?, ?, ?, ?)"
+
+    def __init__(self, memory, window=200):
+        self.memory = memory
+        self.window = collections.deque(maxlen=window)
+        self.session_start_id = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def create_schema(conn):
+        conn.execute("CREATE TABLE IF NOT EXISTS chat_messages (id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT NOT NULL, is_assistant INTEGER NOT NULL, "
+                     "tag TEXT, timestamp TEXT, created DATETIME DEFAULT CURRENT_TIMESTAMP)")
+        try:
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chat_messages_fts USING fts5(text, content='chat_messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2')")
+            conn.execute("CREATE TRIGGER IF NOT EXISTS chat_messages_ai AFTER INSERT ON chat_messages BEGIN "
+                         "INSERT INTO chat_messages_fts(rowid, text) VALUES (new.id, new.text); END")
+        except sqlite3.OperationalError as e:
+            logging.warning(f"SQLite FTS5 is not available, history search will use LIKE: {e}")
+
+    @staticmethod
+    def _row_to_entry(row):
+        return {'id': row[0], 'text': row[1], 'is_assistant': bool(row[2]), 'tag': row[3], 'timestamp': row[4]}
+
+    @staticmethod
+    def _entry_row(entry):
+        return (entry['text'], int(entry['is_assistant']), entry['tag'], entry['timestamp'])
+
+    def append(self, entry):
+        with self._lock:
+            self.window.append(entry)
+            if self.memory:
+                self.memory.write(self.INSERT_SQL, [self._entry_row(entry)])
+
+    def attach(self, memory, legacy_path=None):
+        """Starts storing in `memory`, after the legacy file and then the messages shown so far."""
+        with self._lock:
+            self.memory = memory
+            if legacy_path:
+                self.import_legacy_file(legacy_path)
+            self.session_start_id = memory.reader().execute("SELECT COALESCE(MAX(id), 0) FROM chat_messages").fetchone()[0]
+            if self.window:
+                memory.write(self.INSERT_SQL, [self._entry_row(entry) for entry in self.window])
+                memory.flush()
+
+    def import_legacy_file(self, path):
+        """Moves a chat_history.json from older versions into the store, once."""
+        if not self.memory or not os.path.exists(path):
+            return
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            self.memory.write(self.INSERT_SQL, [(str(e['text']), int(e['is_assistant']), e.get('tag'), e.get('timestamp', '')) for e in entries])
+            self.memory.flush()
+            os.replace(path, path + ".bak")
+            logging.info(f"Imported {len(entries)} messages from '{path}' into the history store.")
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.error(f"Could not import legacy history: {e}")
+
+    def page_before(self, before_id=None, limit=50):
+        """Returns up to limit messages older than before_id (or the newest ones), oldest first."""
+        if not self.memory:
+            return list(self.window)[-limit:] if before_id is None else []
+        rows = self.memory.reader().execute(
+            "SELECT id, text, is_assistant, tag, timestamp FROM chat_messages WHERE id < ? ORDER BY id DESC LIMIT ?",
+            (before_id if before_id is not None else sys.maxsize, limit)).fetchall()
+        return [self._row_to_entry(row) for row in reversed(rows)]
+
+    def earlier_runs_page(self, limit=50):
+        """The newest `limit` messages stored before this run, oldest first."""
+        if self.session_start_id is None:
+            return []
+        return self.page_before(self.session_start_id + 1, limit)
+
+    def search(self, query, limit=20):
+        """Full-text search over past messages, best matches first."""
+        if not self.memory:
+            return []
+        conn = self.memory.reader()
+        terms = " ".join(f'"{t}"' for t in re.findall(r'\w+', query.lower()))
+        if not terms:
+            return []
+        try:
+            rows = conn.execute(
+                "SELECT m.id, m.text, m.is_assistant, m.tag, m.timestamp, m.created FROM chat_messages_fts "
+                "JOIN chat_messages m ON m.id = chat_messages_fts.rowid WHERE chat_messages_fts MATCH ? ORDER BY rank LIMIT ?",
+                (terms, limit)).fetchall()
+        except sqlite3.OperationalError:
+            rows = conn.execute("SELECT id, text, is_assistant, tag, timestamp, created FROM chat_messages WHERE text LIKE ? ORDER BY id DESC LIMIT ?",
+                                (f"%{query}%", limit)).fetchall()
+        return [dict(self._row_to_entry(row), created=row[5]) for row in rows]
+
+
+class FactExtractionQueue:
+    """Accumulates conversation turns and extracts facts from them in batched requests.
+
+    A single worker sends the pending turns once `batch_turns` have piled up or
+    after `idle_seconds` without a new turn, so at most one extraction request
+    is in flight. The queue holds at most `max_pending` turns; when the worker
+    falls behind, the oldest turns are dropped instead of spawning more calls.
+    """
+
+    def __init__(self, extract_batch, batch_turns=4, idle_seconds=20, max_pending=16):
+        self._extract_batch = extract_batch
+        self.batch_turns = batch_turns
+        self.idle_seconds = idle_seconds
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._pending = []
+        self._last_submit = 0.0
+        self._flush_waiters = []
+        self._closed = False
+        self._cond = threading.Condition()
+        self._worker = Thread(target=self._run, daemon=True, name="fact-extraction")
+        self._worker.start()
+
+    def submit(self, user_query, assistant_response):
+        with self._cond:
+            if self._closed:
+                return
+            if len(self._pending) >= self.max_pending:
+                self._pending.pop(0)
+                self.dropped += 1
+                logging.warning("Fact extraction is falling behind; dropped the oldest pending turn.")
+            self._pending.append((user_query, assistant_response))
+            self._last_submit = time.monotonic()
+            self._cond.notify()
+
+    def _next_batch(self):
+        # Called with the condition held; blocks until there is something to send.
+        while True:
+            if self._pending and (self._flush_waiters or len(self._pending) >= self.batch_turns
+                                  or time.monotonic() - self._last_submit >= self.idle_seconds):
+                batch, self._pending = self._pending, []
+                return batch
+            if self._pending:
+                self._cond.wait(self._last_submit + self.idle_seconds - time.monotonic())
+                continue
+            for waiter in self._flush_waiters:
+                waiter.set()
+            self._flush_waiters.clear()
+            if self._closed:
+                return None
+            self._cond.wait()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                self._extract_batch(batch)
+            except Exception as e:
+                logging.error(f"Error in batched fact extraction: {e}")
+
+    def flush(self, timeout=10):
+        """Sends any pending turns now and waits for them to be processed."""
+        done = threading.Event()
+        with self._cond:
+            self._flush_waiters.append(done)
+            self._cond.notify()
+        return done.wait(timeout)
+
+    def close(self, timeout=10):
+        with self._cond:
+            self._closed = True
+        return self.flush(timeout)
+
+
+class ScheduledRequest:
+    """A unit of work queued on a RequestScheduler."""
+
+    def __init__(self, function, args, session, lane, supersedable, barrier=False):
+        self.function = function
+        self.args = args
+        self.session = session
+        self.lane = lane
+        self.supersedable = supersedable
+        self.barrier = barrier
+        self.submitted = time.monotonic()
+        self.done = threading.Event()
+        self._cancelled = threading.Event()
+
+    @property
+    def key(self):
+        return (self.session, self.lane)
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+
+
+class RequestScheduler:
+    """Runs user requests on a fixed pool of worker threads, by lane priority and in order per session.
+
+    Each request belongs to a session and a lane. An idle worker takes the oldest
+    queued request of the most urgent lane (LANES order) whose session and lane
+    have nothing running, so requests of one session and lane run one at a time
+    in submission order while a local command runs next to a slow LLM request.
+    A new request cancels the `supersedable` requests of its session and lane:
+    queued ones are dropped and a running one sees `RequestScheduler.cancelled()`
+    turn true. A lane holds at most `max_queued` requests; the oldest is
+    dropped when it overflows. A `barrier` request changes how later requests
+    of its session must be classified; `has_barrier` reports it until it ends.
+    """
+    LANES = ('local', 'voice', 'conversation')
+    _current = threading.local()
+
+    def __init__(self, workers=3, max_queued=8):
+        self.max_queued = max_queued
+        self._queues = {lane: collections.deque() for lane in self.LANES}
+        self._running = {}
+        self._closed = False
+        self._cond = threading.Condition()
+        self._workers = [Thread(target=self._run, daemon=True, name=f"request-{i}") for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    @classmethod
+    def cancelled(cls):
+        """True when called from a request that has been superseded or dropped."""
+        request = getattr(cls._current, 'request', None)
+        return request is not None and request.cancelled
+
+    def submit(self, function, *args, session='default', lane='conversation', supersedable=False, barrier=False):
+        request = ScheduledRequest(function, args, session, lane, supersedable, barrier)
+        with self._cond:
+            if self._closed:
+                request.cancel()
+                request.done.set()
+                return request
+            pending = self._queues[lane]
+            for other in [other for other in pending if other.session == session and other.supersedable]:
+                self._drop(other, 'request_superseded')
+            running = self._running.get(request.key)
+            if running and running.supersedable and not running.cancelled:
+                running.cancel()
+                METRICS.increment('request_superseded')
+            if len(pending) >= self.max_queued:
+                logging.warning(f"Too many pending '{lane}' requests; dropped the oldest one.")
+                self._drop(pending[0], 'request_dropped')
+            pending.append(request)
+            METRICS.set_gauge(f'request_queue_{lane}', len(pending))
+            self._cond.notify()
+        return request
+
+    def has_barrier(self, session, lane):
+        """True while a barrier request of this session and lane is queued or running."""
+        with self._cond:
+            running = self._running.get((session, lane))
+            return (running is not None and running.barrier) or \
+                any(request.session == session and request.barrier for request in self._queues[lane])
+
+    def depth(self):
+        with self._cond:
+            return {lane: len(pending) for lane, pending in self._queues.items()}
+
+    def _drop(self, request, counter):
+        # Called with the condition held.
+        self._queues[request.lane].remove(request)
+        request.cancel()
+        request.done.set()
+        METRICS.increment(counter)
+
+    def _next_request(self):
+        # Called with the condition held; blocks until a request can start.
+        while not self._closed:
+            for lane in self.LANES:
+                for request in self._queues[lane]:
+                    if request.key not in self._running:
+                        self._queues[lane].remove(request)
+                        self._running[request.key] = request
+                        METRICS.set_gauge(f'request_queue_{lane}', len(self._queues[lane]))
+                        return request
+            self._cond.wait()
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                request = self._next_request()
+            if request is None:
+                return
+            METRICS.record(f'request_wait_{request.lane}', time.monotonic() - request.submitted)
+            self._current.request = request
+            try:
+                if not request.cancelled:
+                    request.function(*request.args)
+            except Exception as e:
+                logging.error(f"Error in {request.lane} request: {e}")
+            finally:
+                self._current.request = None
+                request.done.set()
+                with self._cond:
+                    del self._running[request.key]
+                    # Another request of the same session and lane may be waiting for this one.
+                    self._cond.notify_all()
+
+    def close(self, timeout=1):
+        """Drops queued requests, cancels running ones and waits briefly for the workers."""
+        with self._cond:
+            self._closed = True
+            for pending in self._queues.values():
+                for request in list(pending):
+                    self._drop(request, 'request_dropped')
+            for request in self._running.values():
+                request.cancel()
+            self._cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for worker in self._workers:
+            worker.join(max(0, deadline - time.monotonic()))
+
+class ConversationContext:
+    """Multi-turn context for conversational requests, kept within a token budget.
+
+    The last `recent_turns` turns are sent verbatim. Older turns are folded into
+    a rolling summary by `summarize(summary, turns)`, which runs on a background
+    thread once `summarize_every` turns have left the verbatim window, so no
+    request ever waits for it. `build_contents` drops the oldest verbatim turns
+    when the request would exceed `token_budget`.
+    """
+
+    def __init__(self, summarize, recent_turns=6, token_budget=2000, summarize_every=4):
+        self._summarize = summarize
+        self.recent_turns = recent_turns
+        self.token_budget = token_budget
+        self.summarize_every = summarize_every
+        self.summary = ""
+        self._turns = collections.deque()
+        self._unsummarized = []
+        self._summarizing = False
+        self._lock = threading.Lock()
+
+    def add_turn(self, user_query, assistant_response):
+        if not user_query or not assistant_response:
+            return
+        with self._lock:
+            self._turns.append((str(user_query), str(assistant_response)))
+            while len(self._turns) > self.recent_turns:
+                self._unsummarized.append(self._turns.popleft())
+            if self._summarizing or len(self._unsummarized) < self.summarize_every:
+                return
+            self._summarizing = True
+        Thread(target=self._refresh_summary, daemon=True, name="context-summary").start()
+
+    def _refresh_summary(self):
+        # Keeps folding while turns pile up faster than summaries come back.
+        while True:
+            with self._lock:
+                if len(self._unsummarized) < self.summarize_every:
+                    self._summarizing = False
+                    return
+                batch, self._unsummarized = self._unsummarized, []
+                previous_summary = self.summary
+            new_summary = None
+            try:
+                new_summary = self._summarize(previous_summary, batch)
+            except Exception as e:
+                logging.error(f"Error refreshing the conversation summary: {e}")
+            with self._lock:
+                if not new_summary:
+                    # Keep the turns so that the next new turn retries them.
+                    self._unsummarized[:0] = batch
+                    self._summarizing = False
+                    return
+                self.summary = new_summary.strip()
+
+    def build_contents(self, user_query, system_tokens=0):
+        """Returns (contents, summary, stats) for a request; the oldest verbatim turns go first when over budget."""
+        with self._lock:
+            turns = list(self._turns)
+            summary = self.summary
+        estimate = FactRetriever.estimate_tokens
+        used = system_tokens + estimate(user_query) + (estimate(summary) if summary else 0)
+        kept = []
+        for user_text, model_text in reversed(turns):
+            cost = estimate(user_text) + estimate(model_text)
+            if used + cost > self.token_budget:
+                break
+            kept.append((user_text, model_text))
+            used += cost
+        kept.reverse()
+        contents = []
+        for user_text, model_text in kept:
+            contents.append({"role": "user", "parts": [{"text": user_text}]})
+            contents.append({"role": "model", "parts": [{"text": model_text}]})
+        contents.append({"role": "user", "parts": [{"text": user_query}]})
+        stats = {'prompt_tokens': used, 'turns_sent': len(kept), 'turns_dropped': len(turns) - len(kept),
+                 'summary_tokens': estimate(summary) if summary else 0}
+        return contents, summary, stats
+
+    def clear(self):
+        with self._lock:
+            self._turns.clear()
+            self._unsummarized = []
+            self.summary = ""
+
+class AhoCorasick:
+    """Trie with failure links that finds every occurrence of many literal patterns in one pass.
+
+    `extend` inserts many patterns and links the automaton once. `add` inserts
+    one pattern at any time: it links only the new trie nodes, re-points the
+    failure links of the existing nodes whose longest suffix in the trie is now
+    one of the new nodes, and refreshes the outputs below the nodes that
+    changed, so it costs about the size of that neighbourhood instead of a
+    rebuild of the whole automaton. It is not thread-safe: callers serialize
+    `add` against `finditer`.
+    """
+
+    def __init__(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._parent = [0]
+        self._char = [""]
+        self._depth = [0]
+        # Inverse failure links, keyed by the child's character just before the target's string:
+        # {target: {char: {child, ...}}}
+        self._fail_children = collections.defaultdict(lambda: collections.defaultdict(set))
+        self._own = [[]]   # Patterns ending exactly at this node
+        self._out = [[]]   # Own patterns plus those reachable through failure links
+
+    def extend(self, items):
+        """Adds (pattern, value) pairs and relinks the whole automaton once."""
+        for pattern, value in items:
+            self._insert(pattern, value)
+        self._fail_children.clear()
+        self._out[0] = list(self._own[0])
+        pending = collections.deque(self._goto[0].values())
+        while pending:
+            node = pending.popleft()
+            fail = self._fail_target(node)
+            self._fail[node] = fail
+            self._fail_children[fail][self._char_before(node, fail)].add(node)
+            self._out[node] = self._own[node] + self._out[fail]
+            pending.extend(self._goto[node].values())
+
+    def add(self, pattern, value):
+        changed = self._insert(pattern, value)
+        for new_node in changed[1:]:  # Shallowest first, so a parent is linked before its child
+            changed += self._link(new_node)
+        self._refresh_outputs(changed)
+
+    def _insert(self, pattern, value):
+        """Adds the pattern to the trie; returns its end node followed by the nodes created for it."""
+        node, created = 0, []
+        for char in pattern:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._parent.append(node)
+                self._char.append(char)
+                self._depth.append(self._depth[node] + 1)
+                self._own.append([])
+                self._out.append([])
+                created.append(next_node)
+            node = next_node
+        self._own[node].append((len(pattern), value))
+        return [node] + created
+
+    def _fail_target(self, node):
+        parent, char = self._parent[node], self._char[node]
+        if not parent:
+            return 0
+        fallback = self._fail[parent]
+        while fallback and char not in self._goto[fallback]:
+            fallback = self._fail[fallback]
+        return self._goto[fallback].get(char, 0)
+
+    def _link(self, node):
+        """Sets the failure link of a new node; returns it with the existing nodes that now fail to it."""
+        fail = self._fail_target(node)
+        # Every node whose string ends with the new string fails through `fail` today, via nodes that
+        # are suffixes of the new string. The first deeper node on each such path is re-pointed if it
+        # ends with the new string; if it does not, nothing under it can.
+        # Those share the new string's character before each suffix, so only that bucket is visited.
+        relinked, pending = [node], list(self._fail_children_before(fail, node))
+        while pending:
+            candidate = pending.pop()
+            if self._depth[candidate] < self._depth[node]:
+                if self._ends_with(node, candidate):
+                    pending.extend(self._fail_children_before(candidate, node))
+            elif self._depth[candidate] > self._depth[node] and self._ends_with(candidate, node):
+                old = self._fail[candidate]
+                self._fail_children[old][self._char_before(candidate, old)].discard(candidate)
+                self._fail[candidate] = node
+                self._fail_children[node][self._char_before(candidate, node)].add(candidate)
+                relinked.append(candidate)
+        self._fail[node] = fail
+        self._fail_children[fail][self._char_before(node, fail)].add(node)
+        return relinked
+
+    def _char_before(self, node, suffix_node):
+        """The character of `node`'s string just before its suffix `suffix_node`."""
+        for _ in range(self._depth[suffix_node]):
+            node = self._parent[node]
+        return self._char[node]
+
+    def _fail_children_before(self, target, node):
+        children = self._fail_children.get(target)
+        return children.get(self._char_before(node, target), ()) if children else ()
+
+    def _ends_with(self, node, suffix_node):
+        while suffix_node:
+            if self._char[node] != self._char[suffix_node]:
+                return False
+            node, suffix_node = self._parent[node], self._parent[suffix_node]
+        return True
+
+    def _refresh_outputs(self, nodes):
+        # A node's outputs include those of its failure target, so each changed node's failure
+        # subtree is refreshed top-down, shallowest changed node first.
+        refreshed = set()
+        for root in sorted(set(nodes), key=self._depth.__getitem__):
+            if root in refreshed:
+                continue
+            pending = [root]
+            while pending:
+                node = pending.pop()
+                refreshed.add(node)
+                self._out[node] = self._own[node] + (self._out[self._fail[node]] if node else [])
+                for children in self._fail_children.get(node, {}).values():
+                    pending.extend(children)
+
+    def finditer(self, text):
+        """Yields (start, end, value) for every pattern occurrence in text."""
+        node = 0
+        for i, char in enumerate(text):
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            for length, value in self._out[node]:
+                yield i + 1 - length, i + 1, value
+
+
+CommandMatch = collections.namedtuple('CommandMatch', 'route start end specificity')
 
-# --- MODEL AND DATABASE CONFIGURATION ---
-GEMINI_MODEL = "gemini-2.5-flash-preview-05-20"
-API_URL_BASE = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:generateContent"
-DB_NAME = "assistant_memory.db"
 
-try:
-    from PIL import Image
-    import pystray
-except ImportError:
+class CommandDispatcher:
+    """Routes a command to a built-in handler or learned skill in a single pass.
+
+    Keyword and skill-key routes share one Aho-Corasick automaton; regex routes
+    are merged into one alternation of named groups. Every hit is collected with
+    its span, and the winner is the one with the highest priority, then the
+    longest trigger phrase (the most specific match), then the earliest position.
+    Skills may be added from one thread while others match.
+    """
+    DEFAULT_PRIORITY = 10
+
+    def __init__(self, registry, learned_skills=None):
+        self.routes = []
+        self._keywords = AhoCorasick()
+        self._lock = threading.Lock()  # Guards the automaton and routes while a skill is added
+        regex_alternatives, keywords = [], []
+        for entry in registry:
+            route = dict(entry, kind='regex' if 'regex' in entry else 'keyword', order=len(self.routes))
+            route.setdefault('priority', self.DEFAULT_PRIORITY)
+            self.routes.append(route)
+            if route['kind'] == 'regex':
+                regex_alternatives.append(f"(?P<r{route['order']}>{entry['regex'].pattern})")
+            else:
+                keywords += [(keyword.lower(), route) for keyword in entry['keywords']]
+        # Zero-width lookahead so a candidate is reported at every position, not just the leftmost one.
+        self._combined_regex = re.compile(f"(?=(?:{'|'.join(regex_alternatives)}))", flags=re.IGNORECASE) if regex_alternatives else None
+        for skill_key, script_name in (learned_skills or {}).items():
+            keywords.append((skill_key.lower().strip(), self._skill_route(skill_key, script_name)))
+        self._keywords.extend(keywords)
+
+    def _skill_route(self, skill_key, script_name):
+        route = {'kind': 'skill', 'skill_key': skill_key, 'script': script_name,
+                 'priority': self.DEFAULT_PRIORITY, 'order': len(self.routes)}
+        self.routes.append(route)
+        return route
+
+    def add_skill(self, skill_key, script_name):
+        with self._lock:
+            self._keywords.add(skill_key.lower().strip(), self._skill_route(skill_key, script_name))
+
+    @staticmethod
+    def _at_word_boundary(text, start, end):
+        return (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum())
+
+    def match_all(self, text):
+        candidates = []
+        with self._lock:
+            for start, end, route in self._keywords.finditer(text):
+                if self._at_word_boundary(text, start, end):
+                    candidates.append(CommandMatch(route, start, end, end - start))
+        if self._combined_regex:
+            for m in self._combined_regex.finditer(text):
+                name = next(name for name, value in m.groupdict().items() if value is not None)
+                start = m.start(name)
+                if start and text[start - 1].isalnum():
+                    continue
+                # The group after the named one is the route's argument; what precedes it is the trigger phrase.
+                argument_group = self._combined_regex.groupindex[name] + 1
+                trigger_end = m.start(argument_group) if m.start(argument_group) >= 0 else m.end(name)
+                candidates.append(CommandMatch(self.routes[int(name[1:])], start, m.end(name), len(text[start:trigger_end].strip())))
+        return candidates
+
+    def match(self, text):
+        candidates = self.match_all(text)
+        if not candidates:
+            return None
+        return max(candidates, key=lambda c: (c.route['priority'], c.specificity, -c.start, -c.route['order']))
+
+class SkillLoader:
+    """Compiles each learned skill once and keeps the code object in memory and on disk.
+
+    The compiled form is marshalled next to the script (`skill_x.marshal`) with a
+    header holding the interpreter magic number and the source's mtime, size and
+    SHA-256. A cached entry is reused while mtime and size are unchanged; if they
+    differ but the content hash still matches, the marshalled code is reused too.
+    """
+    HEADER = struct.Struct('<4sqq32s')
+
+    def __init__(self, skills_dir):
+        self.skills_dir = skills_dir
+        self._cache = {}  # script_name -> (mtime_ns, size, code)
+        self._lock = threading.Lock()
+
+    def _paths(self, script_name):
+        source_path = os.path.join(self.skills_dir, script_name)
+        return source_path, os.path.splitext(source_path)[0] + ".marshal"
+
+    def load(self, script_name):
+        """Returns the skill's code object, or None if the script does not exist."""
+        source_path, marshal_path = self._paths(script_name)
+        try:
+            st = os.stat(source_path)
+        except FileNotFoundError:
+            return None
+        cached = self._cache.get(script_name)
+        if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+            return cached[2]
+        with self._lock:
+            code = self._load_marshal(source_path, marshal_path, st)
+            if code is None:
+                with open(source_path, 'rb') as f: source = f.read()
+                code = compile(source, source_path, 'exec')
+                self._write_marshal(marshal_path, st, hashlib.sha256(source).digest(), code)
+            self._cache[script_name] = (st.st_mtime_ns, st.st_size, code)
+            return code
+
+    def _load_marshal(self, source_path, marshal_path, st):
+        try:
+            with open(marshal_path, 'rb') as f: data = f.read()
+            magic, mtime_ns, size, digest = self.HEADER.unpack_from(data)
+        except (OSError, struct.error):
+            return None
+        if magic != importlib.util.MAGIC_NUMBER:
+            return None
+        if (mtime_ns, size) != (st.st_mtime_ns, st.st_size):
+            with open(source_path, 'rb') as f: source_digest = hashlib.sha256(f.read()).digest()
+            if source_digest != digest:
+                return None
+        try:
+            code = marshal.loads(data[self.HEADER.size:])
+        except (EOFError, ValueError, TypeError):
+            return None
+        if (mtime_ns, size) != (st.st_mtime_ns, st.st_size):
+            self._write_marshal(marshal_path, st, digest, code)
+        return code
+
+    def _write_marshal(self, marshal_path, st, digest, code):
+        try:
+            temp_path = marshal_path + ".tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(self.HEADER.pack(importlib.util.MAGIC_NUMBER, st.st_mtime_ns, st.st_size, digest))
+                f.write(marshal.dumps(code))
+            os.replace(temp_path, marshal_path)
+        except OSError as e:
+            logging.warning(f"Could not cache compiled skill '{marshal_path}': {e}")
+
+    def remember(self, script_name, source, code):
+        """Caches a code object compiled from source that has just been written to script_name."""
+        source_path, marshal_path = self._paths(script_name)
+        st = os.stat(source_path)
+        with self._lock:
+            self._write_marshal(marshal_path, st, hashlib.sha256(source.encode('utf-8')).digest(), code)
+            self._cache[script_name] = (st.st_mtime_ns, st.st_size, code)
+
+    def preload(self, script_names):
+        start = time.perf_counter()
+        for script_name in script_names:
+            try:
+                self.load(script_name)
+            except (OSError, SyntaxError, ValueError) as e:
+                logging.warning(f"Could not preload skill '{script_name}': {e}")
+        logging.info(f"Preloaded {len(self._cache)} compiled skills in {time.perf_counter() - start:.2f}s.")
+
+class SkillIndex:
+    """Character n-gram TF-IDF index that matches paraphrased commands to learned skill keys.
+
+    N-grams are hashed into a fixed number of columns, so adding a skill only
+    appends a row and updates document frequencies. The IDF-weighted,
+    L2-normalized matrix is rebuilt lazily after an add, and a query only
+    touches the columns of its own n-grams.
+    """
+
+    def __init__(self, ngram=3, dims=2048, threshold=0.7, margin=0.15):
+        self.ngram = ngram
+        self.dims = dims
+        self.threshold = threshold
+        self.margin = margin
+        self.keys = []
+        self._rows = []
+        self._df = np.zeros(dims, dtype=np.float32)
+        self._weighted = None
+        self._idf = None
+
+    def _columns(self, text):
+        text = " " + re.sub(r'\s+', ' ', text.lower().strip()) + " "
+        grams = [text[i:i + self.ngram] for i in range(len(text) - self.ngram + 1)]
+        return np.fromiter((zlib.crc32(g.encode('utf-8')) % self.dims for g in grams), dtype=np.int64, count=len(grams))
+
+    def _tf(self, text):
+        counts = np.bincount(self._columns(text), minlength=self.dims).astype(np.float32)
+        nonzero = counts > 0
+        counts[nonzero] = 1.0 + np.log(counts[nonzero])
+        return counts
+
+    def add(self, key):
+        if key in self.keys:
+            return
+        tf = self._tf(key)
+        self.keys.append(key)
+        self._rows.append(tf)
+        self._df += tf > 0
+        self._weighted = None
+
+    def search(self, text, top_k=3):
+        """Returns up to top_k (skill_key, cosine score) pairs, best first."""
+        if not self.keys:
+            return []
+        if self._weighted is None:
+            self._idf = np.log((1.0 + len(self.keys)) / (1.0 + self._df)) + 1.0
+            weighted = np.vstack(self._rows) * self._idf
+            weighted /= np.maximum(np.linalg.norm(weighted, axis=1, keepdims=True), 1e-9)
+            # Stored column-major so a query gathers contiguous rows for its few n-grams.
+            self._weighted = np.ascontiguousarray(weighted.T)
+        query = self._tf(text)
+        columns = np.flatnonzero(query)
+        if not columns.size:
+            return []
+        query_weights = query[columns] * self._idf[columns]
+        query_weights /= max(float(np.linalg.norm(query_weights)), 1e-9)
+        scores = query_weights @ self._weighted[columns]
+        if len(scores) > top_k:
+            best = np.argpartition(scores, -top_k)[-top_k:]
+            best = best[np.argsort(scores[best])[::-1]]
+        else:
+            best = np.argsort(scores)[::-1]
+        return [(self.keys[i], float(scores[i])) for i in best]
+
+    def best_match(self, text):
+        """Returns (skill_key, score) for the best match above the threshold, or None.
+
+        A match that is not at least `margin` ahead of the runner-up is ambiguous
+        ("type hello" vs "type goodbye") and is not returned either.
+        """
+        results = self.search(text, top_k=2)
+        if not results or results[0][1] < self.threshold:
+            return None
+        if len(results) > 1 and results[0][1] - results[1][1] < self.margin:
+            return None
+        return results[0]
+
+
+class SkillTimeoutError(Exception):
+    pass
+
+
+class SkillExecutionError(Exception):
+    """A skill raised inside a worker process; carries the remote type and traceback."""
+    def __init__(self, error_type, message, remote_traceback="", output=""):
+        super().__init__(f"{error_type}: {message}" if message else error_type)
+        self.error_type = error_type
+        self.remote_traceback = remote_traceback
+        self.output = output
+
+
+def skill_exec_globals():
+    """The names every learned skill can use without importing them."""
+    return {'pyautogui': pyautogui, 'psutil': psutil, 'winshell': winshell, 'os': os, 'requests': requests, 'webbrowser': webbrowser, 're': re, 'time': time}
+
+
+def _skill_worker_main(conn):
+    # Entry point of a skill worker process. The modules skills use are imported
+    # before it reports ready, so the worker is warm when the first skill arrives.
+    for module in (pyautogui, psutil, requests):
+        try:
+            module.load()
+        except Exception:
+            pass
+    conn.send(('ready', None))
+    while True:
+        try:
+            message = conn.recv_bytes()
+        except (EOFError, OSError):
+            break
+        if not message:
+            break
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output):
+                exec(marshal.loads(message), skill_exec_globals())
+            conn.send(('ok', output.getvalue()))
+        except BaseException as e:
+            conn.send(('error', (type(e).__name__, str(e), traceback.format_exc(), output.getvalue())))
+
+
+class SkillWorkerPool:
+    """Pre-started worker processes that execute learned skills with a wall-clock timeout.
+
+    Code objects are sent marshalled; stdout and exceptions come back to the
+    caller. At most `size` skills run at once. A worker that exceeds its
+    timeout is killed and replaced, so a hanging or crashing skill never takes
+    the assistant down with it. `close` stops every worker, busy or idle.
+    """
+
+    def __init__(self, size=2, timeout=30, startup_timeout=60):
+        self.size = size
+        self.timeout = timeout
+        self.startup_timeout = startup_timeout
+        self._ctx = multiprocessing.get_context('spawn')
+        self._idle = queue.Queue()
+        self._workers = []
+        self._closed = False
+        self._lock = threading.Lock()
+        for _ in range(size):
+            self._idle.put(self._spawn())
+
+    def _spawn(self):
+        parent_conn, child_conn = self._ctx.Pipe()
+        process = self._ctx.Process(target=_skill_worker_main, args=(child_conn,), daemon=True, name="skill-worker")
+        process.start()
+        child_conn.close()
+        worker = {'process': process, 'conn': parent_conn, 'ready': False}
+        with self._lock:
+            self._workers.append(worker)
+            if self._closed:  # Replaced a worker while close() was running
+                process.kill()
+        return worker
+
+    def _replace(self, worker):
+        worker['conn'].close()
+        if worker['process'].is_alive():
+            worker['process'].kill()
+        worker['process'].join(1)
+        with self._lock:
+            self._workers.remove(worker)
+            if self._closed:
+                return worker
+        return self._spawn()
+
+    def run(self, code, timeout=None):
+        """Runs a code object in a worker and returns whatever it printed."""
+        timeout = timeout or self.timeout
+        if self._closed:
+            raise SkillExecutionError("PoolClosed", "the assistant is shutting down")
+        try:
+            worker = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise SkillTimeoutError(f"all {self.size} skill workers are busy")
+        try:
+            if not worker['process'].is_alive():
+                worker = self._replace(worker)
+            if not worker['ready']:
+                if not worker['conn'].poll(self.startup_timeout):
+                    worker = self._replace(worker)
+                    raise SkillTimeoutError("the skill worker did not start in time")
+                worker['conn'].recv()
+                worker['ready'] = True
+            worker['conn'].send_bytes(marshal.dumps(code))
+            if not worker['conn'].poll(timeout):
+                worker = self._replace(worker)
+                raise SkillTimeoutError(f"the skill took longer than {timeout}s and was stopped")
+            status, payload = worker['conn'].recv()
+        except (EOFError, OSError):
+            worker = self._replace(worker)
+            raise SkillExecutionError("WorkerCrashed", "the skill worker exited unexpectedly")
+        finally:
+            self._idle.put(worker)
+        if status == 'error':
+            raise SkillExecutionError(*payload)
+        return payload
+
+    def close(self):
+        """Stops every worker: idle ones are asked to exit, busy or hung ones are terminated, then killed."""
+        with self._lock:
+            self._closed = True
+            workers = list(self._workers)
+        while True:
+            try:
+                worker = self._idle.get(block=False)
+            except queue.Empty:
+                break
+            try:
+                worker['conn'].send_bytes(b"")
+            except OSError:
+                pass
+        deadline = time.monotonic() + 0.5
+        for worker in workers:
+            worker['process'].join(max(0, deadline - time.monotonic()))
+            if worker['process'].is_alive():
+                worker['process'].terminate()
+                worker['process'].join(0.5)
+            if worker['process'].is_alive():
+                worker['process'].kill()
+                worker['process'].join(1)
+
+class StartupScheduler:
+    """Runs startup stages on background threads, each as soon as the stages it depends on are done.
+
+    A stage whose dependency failed is skipped. `on_ready(name, ok)` is called
+    from the stage's thread when it ends, so the caller can enable whatever the
+    stage backs. Completion times are kept relative to `started_at`, which gives
+    the time-to-interactive of every stage.
+    """
+
+    def __init__(self, on_ready=None, started_at=None):
+        self.on_ready = on_ready
+        self.started_at = started_at or time.perf_counter()
+        self.stages = {}
+        self.finished_at = {}
+        self.failed = set()
+        self._lock = threading.Lock()
+
+    def add(self, name, function, after=()):
+        self.stages[name] = (function, tuple(after), threading.Event())
+        return self
+
+    def start(self):
+        for name in self.stages:
+            Thread(target=self._run, args=(name,), daemon=True, name=f"startup-{name}").start()
+        return self
+
+    def done(self, name):
+        return self.stages[name][2].is_set() and name not in self.failed
+
+    def _run(self, name):
+        function, after, finished = self.stages[name]
+        for dependency in after:
+            self.stages[dependency][2].wait()
+        ok = not any(dependency in self.failed for dependency in after)
+        if ok:
+            start = time.perf_counter()
+            try:
+                function()
+            except Exception as e:
+                logging.error(f"Startup stage '{name}' failed: {e}")
+                ok = False
+            METRICS.record(f"startup_{name}", time.perf_counter() - start)
+        else:
+            logging.warning(f"Startup stage '{name}' skipped because a stage it needs failed.")
+        with self._lock:
+            if not ok:
+                self.failed.add(name)
+            self.finished_at[name] = time.perf_counter() - self.started_at
+            last = len(self.finished_at) == len(self.stages)
+        finished.set()
+        if self.on_ready:
+            self.on_ready(name, ok)
+        if last:
+            logging.info(f"Startup finished: {self.report()}")
+
+    def report(self):
+        return ", ".join(f"{name} {'failed' if name in self.failed else 'ready'} at {seconds * 1000:.0f} ms"
+                         for name, seconds in sorted(self.finished_at.items(), key=lambda item: item[1]))
+
+
+# Optional dependencies are only looked up here; they are imported where first used (tray, startup, wake word, Vosk).
+Image = _optional_module('PIL.Image')
+pystray = _optional_module('pystray')
+if not (Image and pystray):
     Image, pystray = None, None
     print("WARNING: 'Pillow (PIL)' and 'pystray' libraries are missing.")
 
+winshell = _optional_module('winshell')
+if not winshell:
+    print("WARNING: 'winshell' library is missing. Startup functionality will be disabled.")
+
+pvporcupine = _optional_module('pvporcupine')
+
+vosk = _optional_module('vosk')
+if vosk:
+    vosk.after_load(lambda module: module.SetLogLevel(-1))
+
 try:
-    import winshell
+    import winsound
 except ImportError:
-    winshell = None
-    print("WARNING: 'winshell' library is missing. Startup functionality will be disabled.")
+    winsound = None  # Not on Windows: cached phrase audio is disabled and everything is synthesized live
 
 # Precompilation of regular expressions for Spanish
 RE_LEARN_ES = re.compile(r'(?:aprende a|nueva habilidad para|enséñate a)\s+(.+)', flags=re.IGNORECASE)
@@ -95,48 +2976,138 @@ class VirtualAssistant:
     DEFAULT_ASSISTANT_NAME_EN = "Assistant"
     SKILLS_DIR = "learned_skills"
     SKILLS_REGISTRY = "skills_registry.json"
+    RESPONSE_CACHE_FILE = "llm_cache.db"
+    PHRASE_AUDIO_DIR = "tts_cache"
+    WAKE_TEMPLATES_DIR = "wake_templates"
+    # Replies that are always worded the same way; their audio is rendered once and replayed.
+    FIXED_SPOKEN_PHRASES = (
+        "Media command executed.", "Volume control executed.",
+        "Note mode activated. Tell me what to write or 'end note'.", "Note saved. Continue or say 'end note'.",
+        "Note mode finished.", "I couldn't save the note.", "Exiting translator mode.", "Sorry, I couldn't translate that.",
+        "Which application do you want me to open?", "Which application do you want to close?",
+        "What do you want me to calculate?", "I couldn't perform the calculation.", "What video would you like to watch?",
+        "What do you want to search for?", "What do you want to listen to?",
+        "The Gemini API did not respond. Check your connection.",
+        "I can't connect to my brain. Check the connection and the API Key.",
+    )
+    # Failure messages returned in place of an LLM reply; they are never added to the conversation or mined for facts.
+    ERROR_REPLIES = (
+        "Error: Gemini API key is not configured. Please set it in the 'Settings' menu.",
+        "The Gemini API did not respond. Check your connection.",
+        "I can't connect to my brain. Check the connection and the API Key.",
+    )
 
-    def __init__(self, app_instance):
+    def __init__(self, app_instance, defer_startup=False):
         self.app = app_instance
         self.is_running = True
         self.config = self._load_configuration()
         self.language = self.config.get("language", "en") # Default to English
+        METRICS.enabled = self.config.get("metrics_enabled", True)
+        if METRICS.enabled and self.config.get("metrics_export_path"):
+            METRICS.start_export(self.config["metrics_export_path"], self.config.get("metrics_export_interval", 60))
         
         self.assistant_name = self.config.get("assistant_name", self.DEFAULT_ASSISTANT_NAME_EN if self.language == "en" else self.DEFAULT_ASSISTANT_NAME_ES)
         self.tts_enabled = self.config.get("tts_enabled", True)
+        self.stream_responses = self.config.get("stream_responses", True)
         self.api_key = self.config.get("api_key")
+        self.gemini = GeminiClient(
+            self.api_key,
+            pool_maxsize=self.config.get("http_pool_size", HTTP_POOL_MAXSIZE),
+            connect_timeout=self.config.get("http_connect_timeout", HTTP_CONNECT_TIMEOUT),
+            read_timeout=self.config.get("http_timeout", HTTP_READ_TIMEOUT),
+        )
+        self.response_cache = None
         self.user_name = self._load_user_name()
         self.user_id = self.user_name if self.user_name else "guest"
+        # Guards translator_mode/translation_language/note_mode, which are read while classifying requests.
+        self.mode_lock = threading.RLock()
         self.translator_mode = False
         self.translation_language = None
         self.note_mode = False
-        self.engine = None
         self.voices = []
         self.voice_index = self.config.get("voice_id", 0)
-        self.tts_is_speaking = False
+        self.tts_barge_in = self.config.get("tts_barge_in", True)
+        self.wake_vad = VoiceActivityGate(
+            min_speech=self.config.get("wake_vad_min_seconds", 0.3),
+            max_speech=self.config.get("wake_vad_max_seconds", 2.5),
+        ) if self.config.get("wake_vad_enabled", True) else None
         self.wake_word_thread = None
+        self.wake_backend_reload = False
         
         self._init_tts_thread()
         self._init_recognizer()
-        self._init_db()
+        self.fact_retriever = FactRetriever(top_k=self.config.get("fact_top_k", 8), token_budget=self.config.get("fact_token_budget", 250))
+        self.memory = None
+        self.chat_history_store = ChatHistoryStore(None, window=self.config.get("history_window", 200))
+        self.fact_queue = FactExtractionQueue(
+            self._extract_and_save_facts,
+            batch_turns=self.config.get("fact_batch_turns", 4),
+            idle_seconds=self.config.get("fact_idle_seconds", 20),
+        )
+        self.conversation = ConversationContext(
+            self._summarize_turns,
+            recent_turns=self.config.get("context_recent_turns", 6),
+            token_budget=self.config.get("context_token_budget", 2000),
+            summarize_every=self.config.get("context_summarize_every", 4),
+        )
         self._update_language_settings()
-
-        if not os.path.exists(self.SKILLS_DIR):
-            os.makedirs(self.SKILLS_DIR)
-        self.learned_skills = self._load_learned_skills()
-        logging.info(f"Loaded {len(self.learned_skills)} learned skills.")
+        # Built-in commands work right away; learned skills are added by the 'skills' stage.
+        self.learned_skills = {}
+        self.dispatcher = CommandDispatcher(self.command_registry)
+        self.skill_index = SkillIndex(threshold=self.config.get("skill_match_threshold", 0.7), margin=self.config.get("skill_match_margin", 0.15))
+        self.skill_loader = SkillLoader(self.SKILLS_DIR)
+        self.skill_pool = None
+        if not defer_startup:
+            for name, stage, _ in self.startup_stages():
+                try:
+                    stage()
+                except Exception as e:
+                    logging.error(f"Startup stage '{name}' failed: {e}")
 
         if not self.api_key or self.api_key == "YOUR_API_KEY_HERE":
             logging.critical("SECURITY ALERT! The Gemini API Key is not configured. Change it in 'Settings'.")
     
+    def startup_stages(self):
+        """(name, function, dependencies) of the slow initialization that can run after the window is shown."""
+        return [
+            ('database', self._init_storage, ()),
+            ('skills', self._init_skills, ()),
+            ('microphone', self._init_microphone, ()),
+        ]
+
+    def _init_storage(self):
+        self.response_cache = self._init_response_cache()
+        self._init_db()
+        if self.memory:
+            self.chat_history_store.attach(self.memory, legacy_path=self.HISTORY_FILE)
+
+    def _init_skills(self):
+        if not os.path.exists(self.SKILLS_DIR):
+            os.makedirs(self.SKILLS_DIR)
+        learned_skills = self._load_learned_skills()
+        logging.info(f"Loaded {len(learned_skills)} learned skills.")
+        skill_index = SkillIndex(threshold=self.config.get("skill_match_threshold", 0.7), margin=self.config.get("skill_match_margin", 0.15))
+        for skill_key in learned_skills:
+            skill_index.add(skill_key)
+        dispatcher = CommandDispatcher(self.command_registry, learned_skills)
+        # The worker pool exists before any skill can be routed, so none runs in-process through the fallback.
+        self.skill_pool = self._init_skill_pool()
+        # Replaced as a whole, so a command routed meanwhile sees either none of the skills or all of them;
+        # the dispatcher goes last because it is what makes the skills reachable.
+        self.learned_skills = learned_skills
+        self.skill_index = skill_index
+        self.dispatcher = dispatcher
+        Thread(target=self.skill_loader.preload, args=(list(learned_skills.values()),), daemon=True).start()
+
     def _update_language_settings(self):
         """Sets language-specific variables."""
         self.WAKE_WORD = "hey assistant" if self.language == "en" else "oye asistente"
-        wikipedia.set_lang(self.language)
+        self.active_wake_word = self.WAKE_WORD
+        wikipedia.after_load(lambda module, language=self.language: module.set_lang(language))
 
         if self.language == 'en':
             self.command_registry = [
-                {'regex': RE_LEARN_EN, 'handler': self.handle_learning_request},
+                {'regex': RE_LEARN_EN, 'handler': self.handle_learning_request, 'priority': 100},
                 {'regex': RE_OPEN_EN, 'handler': self.open_application},
                 {'regex': RE_CLOSE_EN, 'handler': self.close_application},
                 {'regex': RE_SEARCH_GOOGLE_EN, 'handler': self.search_on_google},
@@ -144,16 +3115,18 @@ class VirtualAssistant:
                 {'regex': RE_SPOTIFY_EN, 'handler': self.play_on_spotify},
                 {'regex': RE_CALCULATE_EN, 'handler': self.calculate_arithmetic},
                 {'keywords': ['system status', 'system information'], 'handler': self.system_status},
-                {'keywords': ['screenshot', 'take a screenshot'], 'handler': self.take_screenshot},
-                {'keywords': ['pause', 'play', 'next song', 'previous song', 'media control'], 'handler': self.control_media},
-                {'keywords': ['volume up', 'volume down', 'mute'], 'handler': self.control_volume},
-                {'keywords': ['translator to', 'translate to'], 'handler': self.start_translator_mode},
-                {'keywords': ['take a note', 'write a note'], 'handler': self.start_note_mode},
-                {'keywords': ['end note', 'finish note'], 'handler': self.end_note_mode},
+                {'keywords': ['screenshot', 'take a screenshot'], 'handler': self.take_screenshot, 'early': True},
+                # 'play' also starts "play <song>", so it only fires once the utterance is complete.
+                {'keywords': ['pause', 'play', 'next song', 'previous song', 'media control'], 'handler': self.control_media,
+                 'early': ['pause', 'next song', 'previous song', 'media control']},
+                {'keywords': ['volume up', 'volume down', 'mute'], 'handler': self.control_volume, 'early': True},
+                {'keywords': ['translator to', 'translate to'], 'handler': self.start_translator_mode, 'changes_mode': True},
+                {'keywords': ['take a note', 'write a note'], 'handler': self.start_note_mode, 'changes_mode': True},
+                {'keywords': ['end note', 'finish note'], 'handler': self.end_note_mode, 'changes_mode': True},
             ]
         else: # Spanish
             self.command_registry = [
-                {'regex': RE_LEARN_ES, 'handler': self.handle_learning_request},
+                {'regex': RE_LEARN_ES, 'handler': self.handle_learning_request, 'priority': 100},
                 {'regex': RE_OPEN_ES, 'handler': self.open_application},
                 {'regex': RE_CLOSE_ES, 'handler': self.close_application},
                 {'regex': RE_SEARCH_GOOGLE_ES, 'handler': self.search_on_google},
@@ -161,19 +3134,35 @@ class VirtualAssistant:
                 {'regex': RE_SPOTIFY_ES, 'handler': self.play_on_spotify},
                 {'regex': RE_CALCULATE_ES, 'handler': self.calculate_arithmetic},
                 {'keywords': ['estado del sistema', 'información del sistema'], 'handler': self.system_status},
-                {'keywords': ['captura de pantalla', 'pantallazo'], 'handler': self.take_screenshot},
-                {'keywords': ['pausa', 'reproduce', 'siguiente canción', 'anterior canción', 'control multimedia'], 'handler': self.control_media},
-                {'keywords': ['sube el volumen', 'baja el volumen', 'silencio', 'mudo'], 'handler': self.control_volume},
-                {'keywords': ['traductor al'], 'handler': self.start_translator_mode},
-                {'keywords': ['tomar nota', 'escribe una nota'], 'handler': self.start_note_mode},
-                {'keywords': ['terminar nota', 'finalizar nota'], 'handler': self.end_note_mode},
+                {'keywords': ['captura de pantalla', 'pantallazo'], 'handler': self.take_screenshot, 'early': True},
+                {'keywords': ['pausa', 'reproduce', 'siguiente canción', 'anterior canción', 'control multimedia'], 'handler': self.control_media,
+                 'early': ['pausa', 'siguiente canción', 'anterior canción', 'control multimedia']},
+                {'keywords': ['sube el volumen', 'baja el volumen', 'silencio', 'mudo'], 'handler': self.control_volume, 'early': True},
+                {'keywords': ['traductor al'], 'handler': self.start_translator_mode, 'changes_mode': True},
+                {'keywords': ['tomar nota', 'escribe una nota'], 'handler': self.start_note_mode, 'changes_mode': True},
+                {'keywords': ['terminar nota', 'finalizar nota'], 'handler': self.end_note_mode, 'changes_mode': True},
             ]
 
 
+    def _init_response_cache(self):
+        if not self.config.get("response_cache_enabled", True):
+            return None
+        try:
+            return ResponseCache(
+                self.RESPONSE_CACHE_FILE,
+                ttl=self.config.get("response_cache_ttl", 86400),
+                max_entries=self.config.get("response_cache_max_entries", 500),
+                max_bytes=int(self.config.get("response_cache_max_mb", 5) * 1024 * 1024),
+            )
+        except sqlite3.Error as e:
+            logging.error(f"Could not open the response cache, continuing without it: {e}")
+            return None
+
     def set_api_key(self, new_key):
         """Updates the API key and saves it to the configuration."""
         if new_key and isinstance(new_key, str):
             self.api_key = new_key
+            self.gemini.api_key = new_key
             self.save_configuration()
             logging.info("API Key updated successfully by the user.")
             return True
@@ -187,7 +3176,57 @@ class VirtualAssistant:
             "wake_word_enabled": True, 
             "voice_id": 0,
             "api_key": default_api_key,
-            "language": "en" # Default language
+            "language": "en", # Default language
+            "http_pool_size": HTTP_POOL_MAXSIZE,
+            "http_connect_timeout": HTTP_CONNECT_TIMEOUT,
+            "http_timeout": HTTP_READ_TIMEOUT,
+            "stream_responses": True,
+            "response_cache_enabled": True,
+            "response_cache_ttl": 86400,
+            "response_cache_max_entries": 500,
+            "response_cache_max_mb": 5,
+            "fact_top_k": 8,
+            "fact_token_budget": 250,
+            "fact_batch_turns": 4,
+            "fact_idle_seconds": 20,
+            "request_workers": 3,
+            "request_queue_max": 8,
+            "skill_isolation": True,
+            "skill_workers": 2,
+            "skill_timeout": 30,
+            "skill_match_threshold": 0.7,
+            "skill_match_margin": 0.15,
+            "history_window": 200,
+            "history_page_size": 50,
+            "context_recent_turns": 6,
+            "context_token_budget": 2000,
+            "context_summarize_every": 4,
+            "tts_barge_in": True,
+            "tts_phrase_cache": True,
+            "tts_phrase_cache_max_mb": 30,
+            "wake_vad_enabled": True,
+            "wake_vad_min_seconds": 0.3,
+            "wake_vad_max_seconds": 2.5,
+            "wake_word_backend": "auto",
+            "wake_word_google_fallback": True,
+            "wake_template_threshold": None,
+            "porcupine_access_key": "",
+            "porcupine_keyword_path": "",
+            "porcupine_keyword": "computer",
+            "porcupine_sensitivity": 0.6,
+            "audio_buffer_seconds": 10,
+            "ptt_preroll_seconds": 0.5,
+            "speech_backend": "auto",
+            "vosk_models": {"en": "models/vosk-model-small-en-us-0.15", "es": "models/vosk-model-small-es-0.42"},
+            "early_command_stable_seconds": 0.3,
+            "console_max_lines": 2000,
+            "console_max_lines_per_frame": 200,
+            "chat_max_lines": 3000,
+            "metrics_enabled": True,
+            "metrics_export_path": "",  # Opt-in, e.g. "metrics.prom"
+            "metrics_export_interval": 60,
+            "lazy_import_prewarm": True,
+            "lazy_import_prewarm_delay": 1.0
         }
         if os.path.exists(self.CONFIG_FILE):
             try:
@@ -216,66 +3255,136 @@ class VirtualAssistant:
         except Exception as e:
             logging.error(f"Error saving configuration: {e}")
 
-    def _call_gemini_api(self, user_query, include_grounding=False, structured_output=None):
-        if not self.api_key or self.api_key == "YOUR_API_KEY_HERE":
-            return "Error: Gemini API key is not configured. Please set it in the 'Settings' menu."
-        
+    def _build_gemini_payload(self, user_query, include_grounding=False, structured_output=None, with_history=False):
         system_prompt = (
             f"You are {self.assistant_name}, a friendly and helpful virtual assistant. "
             f"Purpose: Converse, answer questions, and execute commands.\n"
-            f"--- CONTEXTUAL MEMORY ---\n{self._get_user_facts()}\n"
+            f"--- CONTEXTUAL MEMORY ---\n{self._get_user_facts(user_query)}\n"
             f"--- INSTRUCTIONS ---\n1. Use known facts to personalize responses.\n"
             "2. Briefly acknowledge new personal data.\n3. Do not mention the database.\n4. Be concise."
         )
         payload = {"contents": [{"parts": [{"text": user_query}]}]}
+        if with_history:
+            payload["contents"], summary, stats = self.conversation.build_contents(user_query, FactRetriever.estimate_tokens(system_prompt))
+            if summary:
+                system_prompt += f"\n--- EARLIER IN THIS CONVERSATION ---\n{summary}"
+            logging.info(f"Prompt size: ~{stats['prompt_tokens']} tokens ({stats['turns_sent']} recent turns, "
+                         f"{stats['turns_dropped']} over budget, summary ~{stats['summary_tokens']}).")
         if "Act as an expert programmer" not in user_query and "Actúa como un programador experto" not in user_query:
             payload["systemInstruction"] = {"parts": [{"text": system_prompt}]}
         if include_grounding:
             payload['tools'] = [{"google_search": {}}]
         if structured_output:
             payload['generationConfig'] = {"responseMimeType": "application/json", "responseSchema": structured_output}
-        
+        return payload
+
+    @METRICS.timed('gemini_call')
+    def _call_gemini_api(self, user_query, include_grounding=False, structured_output=None, use_cache=None, with_history=False):
+        if not self.api_key or self.api_key == "YOUR_API_KEY_HERE":
+            return "Error: Gemini API key is not configured. Please set it in the 'Settings' menu."
+        payload = self._build_gemini_payload(user_query, include_grounding, structured_output, with_history)
+        # Grounded answers depend on live search results, so they are not cached by default.
+        if use_cache is None:
+            use_cache = not include_grounding
         try:
-            for i in range(3):
-                response = requests.post(f"{API_URL_BASE}?key={self.api_key}", headers={'Content-Type': 'application/json'}, json=payload, timeout=25)
-                if response.status_code == 200:
-                    result = response.json()
-                    generated_text = result['candidates'][0]['content']['parts'][0]['text']
-                    return json.loads(generated_text) if structured_output else generated_text
-                elif response.status_code == 429:
-                    time.sleep(2 ** i)
-                    logging.warning(f"Rate limit reached. Retrying in {2 ** i}s...")
-                else:
-                    response.raise_for_status()
-            return "The Gemini API did not respond. Check your connection."
+            if use_cache and self.response_cache:
+                cache_key = ResponseCache.make_key(self.gemini.model, payload.get('systemInstruction'), user_query,
+                                                   payload.get('generationConfig'), payload['contents'][:-1])
+                generated_text = self.response_cache.get_or_compute(cache_key, lambda: self.gemini.generate_text(payload))
+            else:
+                generated_text = self.gemini.generate_text(payload)
+            if generated_text is None:
+                return "The Gemini API did not respond. Check your connection."
+            return json.loads(generated_text) if structured_output else generated_text
         except Exception as e:
             logging.error(f"Error calling Gemini API: {e}")
             return "I can't connect to my brain. Check the connection and the API Key."
 
-    def _extract_and_save_facts(self, user_query, assistant_response):
+    def _stream_gemini_api(self, user_query, on_text, include_grounding=False):
+        """Streams a plain-text reply, calling on_text for every fragment. Returns the full text."""
+        if not self.api_key or self.api_key == "YOUR_API_KEY_HERE":
+            error_message = "Error: Gemini API key is not configured. Please set it in the 'Settings' menu."
+            on_text(error_message)
+            return error_message
+        payload = self._build_gemini_payload(user_query, include_grounding, with_history=True)
+        fragments = []
+        try:
+            with contextlib.closing(self.gemini.stream_text(payload)) as stream:
+                for fragment in stream:
+                    # A newer request replaced this one; closing the stream drops the connection.
+                    if RequestScheduler.cancelled():
+                        return "".join(fragments)
+                    fragments.append(fragment)
+                    on_text(fragment)
+            if not fragments:
+                error_message = "The Gemini API did not respond. Check your connection."
+                on_text(error_message)
+                return error_message
+        except Exception as e:
+            logging.error(f"Error streaming from Gemini API: {e}")
+            error_message = "I can't connect to my brain. Check the connection and the API Key."
+            on_text(f" ({error_message})" if fragments else error_message)
+            if not fragments:
+                return error_message
+        return "".join(fragments)
+
+    def _stream_conversation(self, command):
+        """Renders the reply into the chat as it streams and speaks each sentence as soon as it ends."""
+        splitter = SentenceSplitter()
+        stream_id = self.app.begin_stream_message()
+        # Once the user interrupts, the rest of this reply is still shown but no longer spoken.
+        generation = self.tts.generation
+
+        def on_text(fragment):
+            self.app.append_stream_text(stream_id, fragment)
+            for sentence in splitter.feed(fragment):
+                self.say_text(sentence, generation=generation)
+
+        full_text = self._stream_gemini_api(command, on_text, include_grounding=True)
+        if not RequestScheduler.cancelled():
+            for sentence in splitter.flush():
+                self.say_text(sentence, generation=generation)
+        self.app.end_stream_message(stream_id, full_text)
+        return full_text
+
+    def _summarize_turns(self, previous_summary, turns):
+        """Folds older conversation turns into the rolling summary. Runs off the UI thread."""
+        summary_system_prompt = (
+            "You maintain a running summary of a conversation between a user and an assistant. "
+            "Merge the previous summary with the new turns into a single summary of at most 120 words. "
+            "Keep names, decisions, open questions and anything the user may refer back to. Return only the summary."
+        )
+        new_turns = "\n".join(f"User: {user_query}\nAssistant: {assistant_response}" for user_query, assistant_response in turns)
+        payload = {
+            "contents": [{"parts": [{"text": f"Previous summary:\n{previous_summary or '(none)'}\n\nNew turns:\n{new_turns}"}]}],
+            "systemInstruction": {"parts": [{"text": summary_system_prompt}]}
+        }
+        return self.gemini.generate_text(payload, timeout=20)
+
+    @METRICS.timed('fact_extraction')
+    def _extract_and_save_facts(self, turns):
+        """Extracts user facts from a batch of (user_query, assistant_response) turns with one request."""
         fact_system_prompt = (
-            "You are an information extractor. Analyze the conversation. If a personal fact about the user is mentioned (name, hobby, preference), "
+            "You are an information extractor. Analyze the conversation turns. If a personal fact about the user is mentioned (name, hobby, preference), "
             "extract it as a list of concise phrases. If there are no facts, return an empty JSON list: []."
         )
-        conversation_context = f"User: '{user_query}'. Assistant: '{assistant_response}'."
+        conversation_context = "\n".join(
+            f"Turn {i}: User: '{user_query}'. Assistant: '{assistant_response}'."
+            for i, (user_query, assistant_response) in enumerate(turns, start=1)
+        )
         payload = {
             "contents": [{"parts": [{"text": conversation_context}]}],
             "systemInstruction": {"parts": [{"text": fact_system_prompt}]},
             "generationConfig": {"responseMimeType": "application/json", "responseSchema": {"type": "ARRAY", "items": {"type": "STRING"}}}
         }
         try:
-            response = requests.post(f"{API_URL_BASE}?key={self.api_key}", headers={'Content-Type': 'application/json'}, json=payload, timeout=15)
-            if response.status_code == 200:
-                result = response.json()
-                new_facts = json.loads(result['candidates'][0]['content']['parts'][0]['text'])
-                if isinstance(new_facts, list) and new_facts:
-                    conn = sqlite3.connect(DB_NAME)
-                    cursor = conn.cursor()
+            generated_text = self.gemini.generate_text(payload, timeout=20)
+            if generated_text is not None:
+                new_facts = json.loads(generated_text)
+                if isinstance(new_facts, list) and new_facts and self.memory:
+                    self.memory.add_facts(self.user_id, new_facts)
                     for fact in new_facts:
-                        cursor.execute("INSERT OR IGNORE INTO user_facts (user_id, fact) VALUES (?, ?)", (self.user_id, fact.strip()))
-                        logging.info(f"Fact saved: {fact.strip()}")
-                    conn.commit()
-                    conn.close()
+                        logging.info(f"Fact queued for memory: {fact.strip()}")
         except Exception as e:
             logging.error(f"Error in fact extraction: {e}")
 
@@ -289,13 +3398,20 @@ class VirtualAssistant:
                 return {}
         return {}
 
-    def _save_skill(self, command_key, code):
-        file_name = f"skill_{re.sub(r'[^a-z0-9_]', '', command_key.lower().replace(' ', '_'))}.py"
+    def _skill_file_name(self, command_key):
+        return f"skill_{re.sub(r'[^a-z0-9_]', '', command_key.lower().replace(' ', '_'))}.py"
+
+    def _save_skill(self, command_key, code, compiled_code=None):
+        file_name = self._skill_file_name(command_key)
         file_path = os.path.join(self.SKILLS_DIR, file_name)
         try:
             with open(file_path, 'w', encoding='utf-8') as f:
                 f.write(code)
+            if compiled_code is not None:
+                self.skill_loader.remember(file_name, code, compiled_code)
             self.learned_skills[command_key] = file_name
+            self.dispatcher.add_skill(command_key, file_name)
+            self.skill_index.add(command_key)
             with open(self.SKILLS_REGISTRY, 'w', encoding='utf-8') as f:
                 json.dump(self.learned_skills, f, indent=4)
             logging.info(f"New skill '{command_key}' saved in '{file_name}'.")
@@ -345,7 +3461,7 @@ class VirtualAssistant:
 
         try:
             response_schema = {"type": "OBJECT", "properties": {"python_code": {"type": "STRING"}}}
-            json_response = self._call_gemini_api(programmer_prompt, structured_output=response_schema)
+            json_response = self._call_gemini_api(programmer_prompt, structured_output=response_schema, use_cache=False)
             if not json_response or 'python_code' not in json_response:
                 return "My attempt to generate code failed. I couldn't find a solution."
             
@@ -356,11 +3472,13 @@ class VirtualAssistant:
                 return "Okay, I will not execute the code. Canceling the operation."
             
             self.app.add_text_to_chat("Confirmation received. Executing code...", is_assistant=False, tag='system')
-            exec_globals = {'pyautogui': pyautogui, 'psutil': psutil, 'winshell': winshell, 'os': os, 'requests': requests, 'webbrowser': webbrowser, 're': re, 'time': time}
-            
             try:
-                exec(generated_code, exec_globals)
-                return self._save_skill(task, generated_code)
+                compiled_code = compile(generated_code, os.path.join(self.SKILLS_DIR, self._skill_file_name(task)), 'exec')
+                output = self._execute_skill_code(compiled_code)
+                return self._save_skill(task, generated_code, compiled_code) + self._format_skill_output(output)
+            except SkillTimeoutError as e:
+                logging.error(f"Generated code for '{task}' timed out: {e}")
+                return f"The code did not finish: {e}. I have not learned the skill."
             except Exception as e:
                 logging.error(f"Error executing generated code for '{task}': {e}")
                 return f"The code executed but failed with an error: {str(e)}. I have not learned the skill."
@@ -368,6 +3486,101 @@ class VirtualAssistant:
             logging.error(f"Error in the skill learning process: {e}")
             return "An error occurred while trying to learn. Please check the logs."
 
+    def _create_wake_word_backend(self):
+        """Picks the local keyword spotter per config; None means the Google transcription loop."""
+        choice = self.config.get("wake_word_backend", "auto")
+        # Built-in Porcupine keywords don't include the assistant's phrase, so 'auto' needs a keyword file.
+        porcupine_ready = choice == "porcupine" or self.config.get("porcupine_keyword_path")
+        if porcupine_ready and pvporcupine and self.config.get("porcupine_access_key"):
+            try:
+                return PorcupineWakeWord(
+                    self.config["porcupine_access_key"],
+                    keyword_path=self.config.get("porcupine_keyword_path"),
+                    keyword=self.config.get("porcupine_keyword"),
+                    sensitivity=self.config.get("porcupine_sensitivity", 0.6),
+                )
+            except Exception as e:
+                logging.error(f"Could not start Porcupine: {e}")
+        if choice in ("auto", "template"):
+            try:
+                backend = TemplateWakeWord.load(self._wake_templates_dir(), threshold=self.config.get("wake_template_threshold"))
+                if backend:
+                    return backend
+            except (OSError, ValueError) as e:
+                logging.error(f"Could not load the wake word templates: {e}")
+            if choice == "template":
+                logging.warning("No wake word templates recorded yet; record them in Settings.")
+        return None
+
+    def _wake_templates_dir(self):
+        return os.path.join(self.WAKE_TEMPLATES_DIR, self.language)
+
+    def run_wake_word_loop(self):
+        """Wake-word thread body: a local backend when one is available, Google transcription otherwise."""
+        while self.is_running and self.app.is_listening_continuously:
+            self.wake_backend_reload = False
+            backend = self._create_wake_word_backend()
+            self.active_wake_word = (backend.phrase if backend else None) or self.WAKE_WORD
+            if backend:
+                try:
+                    self._listen_for_wake_word_loop_local(backend)
+                finally:
+                    backend.close()
+            elif self.config.get("wake_word_google_fallback", True):
+                self._listen_for_wake_word_loop_sr()
+            else:
+                logging.warning("No local wake word backend is available and the Google fallback is disabled.")
+                return
+            if not self.wake_backend_reload:
+                return
+
+    def _listen_for_wake_word_loop_local(self, backend):
+        logging.info(f"Wake Word listening thread ({backend.name}) started.")
+        if not self.audio_capture:
+            logging.error("No audio capture is running; local wake word detection is unavailable.")
+            return
+        try:
+            source = self.audio_capture.source()
+            logging.info(f"Listening locally for the wake word '{self.active_wake_word}' with {backend.name}.")
+            while self.is_running and self.app.is_listening_continuously and not self.wake_backend_reload:
+                frame = source.read_frame(backend.frame_length)
+                if len(frame) < backend.frame_length:
+                    if not self.audio_capture.alive:
+                        break
+                    continue
+                if self.command_capture_active or (self.tts_is_speaking and not self.tts_barge_in):
+                    continue
+                if backend.detect(frame):
+                    logging.info(f"Wake Word detected by {backend.name}!")
+                    self.wake_position = source.position
+                    self.app.root.after(0, self.app._on_wake_word_detected)
+        except Exception as e:
+            logging.error(f"Unexpected error in local wake word thread: {e}")
+        logging.info(f"Wake word backend cost: {backend.cost_summary()}")
+        logging.info("Wake Word listening thread stopped.")
+
+    def enroll_wake_word(self, takes=3):
+        """Records the wake phrase a few times and saves MFCC templates for the local matcher."""
+        if not self.audio_capture:
+            return "No microphone is available to record the wake word."
+        recordings = []
+        self.command_capture_active = True
+        try:
+            for take in range(1, takes + 1):
+                self.app.add_text_to_chat(f"Say '{self.WAKE_WORD}' ({take}/{takes})...", is_assistant=False, tag='system')
+                self.recognizer.energy_threshold = self.audio_capture.energy_threshold()
+                audio = self.recognizer.listen(self.audio_capture.source(), timeout=5, phrase_time_limit=3)
+                recordings.append(audio.get_raw_data(convert_rate=16000, convert_width=2))
+        except sr.WaitTimeoutError:
+            return "I didn't hear the wake word. Please try again."
+        finally:
+            self.command_capture_active = False
+        saved = TemplateWakeWord.enroll(self._wake_templates_dir(), recordings)
+        if saved < 2:
+            return "The recordings were too short. Please try again in a quieter place."
+        self.wake_backend_reload = True
+        return f"Wake word recorded ({saved} samples). It is now detected offline."
+
     def _listen_for_wake_word_loop_sr(self):
         logging.info("Wake Word listening thread (SpeechRecognition) started.")
         ww_recognizer = sr.Recognizer()
@@ -375,19 +3588,31 @@ class VirtualAssistant:
         ww_recognizer.energy_threshold = 1000
         ww_recognizer.pause_threshold = 0.5
         
-        with sr.Microphone(sample_rate=16000) as source:
+        vad = self.wake_vad
+        if not self.audio_capture:
+            logging.error("No audio capture is running; wake word detection is unavailable.")
+            return
+        with self.audio_capture.source() as source:
             logging.info(f"Listening in the background for the phrase: '{self.WAKE_WORD}'")
-            while self.is_running and self.app.is_listening_continuously:
-                if self.tts_is_speaking:
+            while self.is_running and self.app.is_listening_continuously and not self.wake_backend_reload:
+                # With barge-in the wake word is also heard while an answer is being spoken.
+                if self.command_capture_active or (self.tts_is_speaking and not self.tts_barge_in):
                     time.sleep(0.1)
+                    source.skip_to_live()
                     continue
+                if not self.audio_capture.alive:
+                    break
                 try:
                     audio = ww_recognizer.listen(source, timeout=3, phrase_time_limit=4)
+                    # Noise and long speech are discarded locally instead of being transcribed by Google.
+                    if vad and not vad.accept(audio.get_raw_data(convert_rate=16000, convert_width=2)):
+                        continue
                     heard_text = ww_recognizer.recognize_google(audio, language=f"{self.language}-{self.language.upper()}").lower()
                     if self.WAKE_WORD in heard_text:
                         logging.info(f"Wake Word '{self.WAKE_WORD}' detected!")
+                        # Transcription took a while: the command may already be in the ring, just after this segment.
+                        self.wake_position = source.position
                         self.app.root.after(0, self.app._on_wake_word_detected)
-                        time.sleep(1)
                 except sr.WaitTimeoutError: pass
                 except sr.UnknownValueError: pass
                 except sr.RequestError as e:
@@ -398,45 +3623,99 @@ class VirtualAssistant:
                 except Exception as e:
                     logging.error(f"Unexpected error in wake word thread: {e}")
                     time.sleep(1)
+        if vad:
+            logging.info(f"Wake word VAD stats: {vad.stats}")
         logging.info("Wake Word listening thread stopped.")
 
     def _init_db(self):
+        self.memory = None
         try:
-            conn = sqlite3.connect(DB_NAME)
-            cursor = conn.cursor()
-            cursor.execute("CREATE TABLE IF NOT EXISTS user_facts (user_id TEXT, fact TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (user_id, fact))")
-            conn.commit()
-            conn.close()
+            self.memory = MemoryStore(DB_NAME)
             logging.info(f"SQLite database '{DB_NAME}' initialized.")
         except sqlite3.Error as e:
             logging.error(f"Error initializing the database: {e}")
             self.app.add_text_to_chat("DB ERROR: Could not connect to local memory.", is_assistant=False, tag='system')
 
-    def _get_user_facts(self):
-        conn = None
+    def _get_user_facts(self, query=""):
+        if not self.memory:
+            return "Error querying memory."
         try:
-            conn = sqlite3.connect(DB_NAME)
-            cursor = conn.cursor()
-            cursor.execute("SELECT fact FROM user_facts WHERE user_id = ? ORDER BY timestamp DESC", (self.user_id,))
-            facts = [row[0] for row in cursor.fetchall()]
+            facts = self.fact_retriever.retrieve(self.memory.reader(), self.user_id, query)
             if facts:
-                return f"Known facts about the user (total {len(facts)}): \n- {'\n- '.join(facts)}"
+                facts_list = '\n- '.join(facts)
+                return f"Known facts about the user relevant to this request: \n- {facts_list}"
             return "No specific facts are known about the user."
         except sqlite3.Error as e:
             logging.error(f"Error getting facts: {e}")
             return "Error querying memory."
-        finally:
-            if conn: conn.close()
 
-    def listen_for_command(self):
-        if not self.microphone: return "error_not_understood"
+    def _init_speech_backends(self):
+        self.local_speech = None
+        self.google_speech = GoogleSpeechBackend(self.recognizer)
+        model_path = self.config.get("vosk_models", {}).get(self.language)
+        if self.config.get("speech_backend", "auto") in ("auto", "vosk") and vosk and model_path and os.path.isdir(model_path):
+            # Loading a model takes a few seconds; Google is used until it is ready.
+            Thread(target=self._load_local_speech, args=(model_path,), daemon=True, name="vosk-load").start()
+
+    def _load_local_speech(self, model_path):
+        start = time.perf_counter()
+        try:
+            self.local_speech = VoskSpeechBackend(model_path)
+            self.google_speech.fallback = self.local_speech
+            logging.info(f"Local speech model '{model_path}' loaded in {time.perf_counter() - start:.1f}s.")
+        except Exception as e:
+            logging.error(f"Could not load the local speech model '{model_path}': {e}")
+
+    def _speech_backend(self):
+        if self.local_speech and self.config.get("speech_backend", "auto") != "google":
+            return self.local_speech
+        return self.google_speech
+
+    def _on_partial_transcript(self, text, stable_seconds):
+        """Shows the running transcript; returns True to act on it before the user finishes."""
+        self.app.show_partial_transcript(text)
+        if stable_seconds < self.config.get("early_command_stable_seconds", 0.3):
+            return False
+        # Only short, unambiguous device commands fire early, and only when nothing follows the trigger phrase.
+        match = self.dispatcher.match(text)
+        # 'early' is True for every keyword of the route, or the list of keywords that are not the start of a longer command.
+        early = match.route.get('early') if match else None
+        if early and (early is True or text[match.start:match.end].strip() in early) and match.end >= len(text.rstrip()):
+            logging.info(f"Command fired on a partial transcript: '{text}'")
+            METRICS.increment('early_commands')
+            return True
+        return False
+
+    def _strip_wake_phrase(self, text):
+        """Removes a leading wake phrase, or its last words, that a late detection left in the command."""
+        words = self.active_wake_word.lower().split()
+        for i in range(len(words)):
+            tail = " ".join(words[i:])
+            if text.startswith(tail + " "):
+                return text[len(tail):].strip()
+        return text
+
+    @METRICS.timed('listen')
+    def listen_for_command(self, after_wake_word=False):
+        if not self.audio_capture or not self.audio_capture.alive: return "error_not_understood"
+        # After a wake word, read from exactly where it ended: the ring already holds anything said since,
+        # and starting earlier would put the end of the wake phrase in the command. With push-to-talk,
+        # include a little audio from before the click.
+        start, self.wake_position = (self.wake_position if after_wake_word else None), None
+        preroll = 0.0 if start is not None else self.config.get("ptt_preroll_seconds", 0.5)
+        self.command_capture_active = True
+        backend = self._speech_backend()
         try:
-            with self.microphone as source:
-                self.app.add_text_to_chat("Listening for command...", is_assistant=False, tag='system')
-                self.recognizer.adjust_for_ambient_noise(source, duration=0.5)
-                audio = self.recognizer.listen(source, timeout=5, phrase_time_limit=10)
-            self.app.add_text_to_chat("Processing command...", is_assistant=False, tag='system')
-            return self.recognizer.recognize_google(audio, language=f"{self.language}-{self.language.upper()}").lower()
+            self.app.add_text_to_chat("Listening for command...", is_assistant=False, tag='system')
+            self.recognizer.energy_threshold = self.audio_capture.energy_threshold()
+            text = backend.transcribe(
+                self.audio_capture.source(start, preroll),
+                language=f"{self.language}-{self.language.upper()}",
+                on_partial=self._on_partial_transcript,
+                on_captured=lambda: self.app.add_text_to_chat("Processing command...", is_assistant=False, tag='system'),
+                timeout=5, phrase_time_limit=10,
+            ).lower()
+            return self._strip_wake_phrase(text) if after_wake_word else text
         except sr.WaitTimeoutError:
             self.app.add_text_to_chat("I didn't hear any command.", is_assistant=False, tag='system')
             return "timeout"
@@ -450,7 +3729,11 @@ class VirtualAssistant:
         except Exception as e:
             logging.error(f"!!! CRITICAL AUDIO ERROR (listening for command): {e} ({type(e).__name__})")
             return "error_unknown"
+        finally:
+            self.command_capture_active = False
+            self.app.clear_partial_transcript()
 
+    @METRICS.timed('process_command')
     def process_command(self, command):
         if not command or not isinstance(command, str): return None
         clean_command = re.sub(r'[¿?¡!]', '', command.lower()).strip()
@@ -471,39 +3754,114 @@ class VirtualAssistant:
             error_message = (error_messages_en if self.language == 'en' else error_messages_es).get(command, "Error processing your voice.")
             return None if not error_message else self._call_gemini_api(f"Respond friendly: {error_message}")
 
-        if self.translator_mode: return self.translate(command)
-        if self.note_mode: return self.handle_note(command)
+        with self.mode_lock:
+            translator_mode, note_mode = self.translator_mode, self.note_mode
+        if translator_mode: return self.translate(command)
+        if note_mode: return self.handle_note(command)
+
+        with METRICS.span('route'):
+            match = self.dispatcher.match(clean_command)
+        if match and match.route['kind'] != 'skill':
+            return match.route['handler'](command)
+        if match:
+            result = self._run_learned_skill(match.route['skill_key'], match.route['script'])
+            if result is not None:
+                return result
+
+        # Paraphrases of a learned skill are matched locally before falling back to the LLM.
+        similar = self.skill_index.best_match(clean_command)
+        if similar and similar[0] in self.learned_skills:
+            logging.info(f"Command matched skill '{similar[0]}' by similarity ({similar[1]:.2f}).")
+            # Skills have side effects and a paraphrase may mean something else, so ask before running one.
+            if self.app.ask_user_confirmation(f"'{command}' looks like the learned skill '{similar[0]}'.\n\nDo you want me to run it?"):
+                result = self._run_learned_skill(similar[0], self.learned_skills[similar[0]])
+                if result is not None:
+                    return result
 
-        for cmd_data in self.command_registry:
-            if ('regex' in cmd_data and cmd_data['regex'].search(clean_command)) or \
-               ('keywords' in cmd_data and any(kw in clean_command for kw in cmd_data['keywords'])):
-                return cmd_data['handler'](command)
-        
-        for skill_key, script_name in self.learned_skills.items():
-            if skill_key in clean_command:
-                try:
-                    full_path = os.path.join(self.SKILLS_DIR, script_name)
-                    if not os.path.exists(full_path): continue
-                    with open(full_path, 'r', encoding='utf-8') as f: code = f.read()
-                    self.app.add_text_to_chat(f"Executing skill: '{skill_key}'...", is_assistant=False, tag='system')
-                    exec(code, {'pyautogui': pyautogui, 'psutil': psutil, 'winshell': winshell, 'os': os, 'requests': requests, 'webbrowser': webbrowser, 're': re, 'time': time})
-                    return f"Done, I executed the task '{skill_key}'."
-                except Exception as e:
-                    logging.error(f"Error executing skill '{skill_key}': {e}")
-                    return f"I tried to use a learned skill, but it failed: {e}"
-        
         logging.info(f"Treating as conversation: '{command}'")
-        llm_response = self._call_gemini_api(command, include_grounding=True)
-        Thread(target=self._extract_and_save_facts, args=(command, llm_response), daemon=True).start()
+        if self.stream_responses:
+            # The reply has already been rendered and spoken while streaming.
+            llm_response = self._stream_conversation(command)
+            if not RequestScheduler.cancelled() and llm_response not in self.ERROR_REPLIES:
+                self.conversation.add_turn(command, llm_response)
+                self.fact_queue.submit(command, llm_response)
+            return None
+        llm_response = self._call_gemini_api(command, include_grounding=True, with_history=True)
+        if RequestScheduler.cancelled():
+            logging.info(f"Dropped the reply to '{command}', a newer request superseded it.")
+            return None
+        if llm_response not in self.ERROR_REPLIES:
+            self.conversation.add_turn(command, llm_response)
+            self.fact_queue.submit(command, llm_response)
         return llm_response
 
+    def request_lane(self, command):
+        """Returns (lane, supersedable, changes_mode) for scheduling a typed or transcribed command.
+
+        Quick local routes (the ones that may fire on a partial transcript) get the
+        'local' lane. Commands that would go to the LLM can be superseded by the
+        next command; everything else runs in order in the 'conversation' lane.
+        changes_mode is true for commands that turn the note or translator mode on or off.
+        """
+        with self.mode_lock:
+            if self.translator_mode or self.note_mode or not isinstance(command, str):
+                return 'conversation', False, False
+        match = self.dispatcher.match(re.sub(r'[¿?¡!]', '', command.lower()).strip())
+        if match is None:
+            return 'conversation', True, False
+        return ('local' if match.route.get('early') else 'conversation'), False, bool(match.route.get('changes_mode'))
+
+    @METRICS.timed('skill')
+    def _run_learned_skill(self, skill_key, script_name):
+        """Executes a saved skill. Returns None if its script is missing."""
+        try:
+            code = self.skill_loader.load(script_name)
+            if code is None: return None
+            self.app.add_text_to_chat(f"Executing skill: '{skill_key}'...", is_assistant=False, tag='system')
+            output = self._execute_skill_code(code)
+            return f"Done, I executed the task '{skill_key}'." + self._format_skill_output(output)
+        except SkillTimeoutError as e:
+            logging.error(f"Skill '{skill_key}' timed out: {e}")
+            return f"The skill '{skill_key}' did not finish: {e}."
+        except SkillExecutionError as e:
+            logging.error(f"Error executing skill '{skill_key}': {e}\n{e.remote_traceback}")
+            return f"I tried to use a learned skill, but it failed: {e}" + self._format_skill_output(e.output)
+        except Exception as e:
+            logging.error(f"Error executing skill '{skill_key}': {e}")
+            return f"I tried to use a learned skill, but it failed: {e}"
+
+    def _execute_skill_code(self, code):
+        """Runs a skill's code object in the worker pool (or in-process without one) and returns its output."""
+        if self.skill_pool:
+            return self.skill_pool.run(code, timeout=self.config.get("skill_timeout", 30))
+        exec(code, skill_exec_globals())
+        return ""
+
+    @staticmethod
+    def _format_skill_output(output):
+        output = (output or "").strip()
+        if not output:
+            return ""
+        return f"\nOutput: {output[:500]}{'...' if len(output) > 500 else ''}"
+
+    def _init_skill_pool(self):
+        if not self.config.get("skill_isolation", True):
+            return None
+        try:
+            return SkillWorkerPool(size=self.config.get("skill_workers", 2), timeout=self.config.get("skill_timeout", 30))
+        except Exception as e:
+            logging.error(f"Could not start skill workers, skills will run in-process: {e}")
+            return None
+
     def start_note_mode(self, _):
-        self.note_mode = True
+        with self.mode_lock:
+            self.note_mode = True
         return "Note mode activated. Tell me what to write or 'end note'."
 
     def handle_note(self, command):
         if 'end note' in command or 'finish note' in command or 'terminar nota' in command or 'finalizar nota' in command:
-            self.note_mode = False
+            with self.mode_lock:
+                self.note_mode = False
             return "Note mode finished."
         try:
             with open("notes.txt", 'a', encoding='utf-8') as f:
@@ -512,7 +3870,8 @@ class VirtualAssistant:
         except IOError: return "I couldn't save the note."
 
     def end_note_mode(self, _):
-        self.note_mode = False
+        with self.mode_lock:
+            self.note_mode = False
         return "Note mode finished."
 
     def play_on_spotify(self, command):
@@ -523,12 +3882,11 @@ class VirtualAssistant:
             return f"Searching for '{query.capitalize()}' on Spotify."
         return "What do you want to listen to?"
 
-    def _tts_worker(self):
-        try: self.engine = pyttsx3.init('sapi5')
-        except Exception as e: logging.critical(f"Could not initialize pyttsx3: {e}"); return
-        
-        self.engine.setProperty('rate', 160)
-        self.voices = self.engine.getProperty('voices')
+    def _create_tts_engine(self):
+        # Runs on the TTS thread: the SAPI5 driver must be used from the thread that created it.
+        engine = pyttsx3.init('sapi5')
+        engine.setProperty('rate', 160)
+        self.voices = engine.getProperty('voices')
         if self.voices:
             if self.voice_index >= len(self.voices): self.voice_index = 0
             
@@ -538,42 +3896,67 @@ class VirtualAssistant:
                 if lang_keyword in voice.name.lower():
                     self.voice_index = i
                     break
-            self.engine.setProperty('voice', self.voices[self.voice_index].id)
-        
-        self.engine.connect('finished-utterance', self.app._on_speech_finished)
-        self.engine.startLoop(False)
-        while self.is_running:
-            try:
-                task = self.tts_queue.get(block=False)
-                if isinstance(task, str): 
-                    self.tts_is_speaking = True
-                    self.engine.say(task)
-                elif isinstance(task, dict) and task.get('action') == 'change_voice':
-                    new_index = task.get('index')
-                    if self.voices and 0 <= new_index < len(self.voices): 
-                        self.engine.setProperty('voice', self.voices[new_index].id)
-                self.tts_queue.task_done()
-            except queue.Empty: pass
-            self.engine.iterate()
-            time.sleep(0.1)
-        self.engine.endLoop()
-
-    def _init_tts_thread(self):
-        self.tts_queue = queue.Queue()
-        self.tts_thread = Thread(target=self._tts_worker, daemon=True)
-        self.tts_thread.start()
+            engine.setProperty('voice', self.voices[self.voice_index].id)
+        return engine
+
+    def _init_tts_thread(self, engine_factory=None):
+        self.tts = TTSScheduler(engine_factory or self._create_tts_engine, on_idle=self.app._on_speech_finished,
+                                audio_cache=self._init_phrase_audio_cache())
+        self.tts.prewarm(self.FIXED_SPOKEN_PHRASES)
+
+    def _init_phrase_audio_cache(self):
+        if not winsound or not self.config.get("tts_phrase_cache", True):
+            return None
+        try:
+            return PhraseAudioCache(self.PHRASE_AUDIO_DIR, self.FIXED_SPOKEN_PHRASES,
+                                    max_bytes=int(self.config.get("tts_phrase_cache_max_mb", 30) * 1024 * 1024))
+        except OSError as e:
+            logging.error(f"Could not open the phrase audio cache, continuing without it: {e}")
+            return None
+
+    @property
+    def tts_is_speaking(self):
+        return self.tts.busy
+
+    def change_voice(self, index):
+        def apply(engine):
+            if self.voices and 0 <= index < len(self.voices):
+                engine.setProperty('voice', self.voices[index].id)
+        self.tts.configure(apply)
+
+    def interrupt_speech(self):
+        """Barge-in: silences the current answer when the user starts a new interaction."""
+        # Cancelled even when nothing is queued, so a reply that is still streaming stops speaking too.
+        busy = self.tts.busy
+        self.tts.cancel()
+        if busy:
+            logging.info("Speech interrupted.")
 
     def _init_recognizer(self):
         self.recognizer = sr.Recognizer()
         self.recognizer.energy_threshold = 400
-        self.recognizer.dynamic_energy_threshold = True
+        # The threshold is set from AudioCapture's running noise estimate before each command.
+        self.recognizer.dynamic_energy_threshold = False
         self.recognizer.pause_threshold = 0.8
+        self.wake_position = None
+        self.command_capture_active = False
+        self.audio_capture = None
+        self._init_speech_backends()
+
+    def _init_microphone(self, calibration_seconds=0.25):
+        """Starts the shared capture and waits for enough audio to estimate the room noise."""
         try:
-            self.microphone = sr.Microphone(sample_rate=16000, chunk_size=1024)
-            with self.microphone as source: self.recognizer.adjust_for_ambient_noise(source, duration=1)
+            capture = AudioCapture(seconds=self.config.get("audio_buffer_seconds", 10), open_stream=self._open_audio_stream).start()
+            capture.read(0, int(calibration_seconds * AudioCapture.SAMPLE_RATE), timeout=2.0)
         except Exception as e:
             logging.critical(f"Could not initialize microphone: {e}")
-            self.microphone = None
+            raise
+        if not capture.alive:
+            raise RuntimeError("the audio capture stopped while calibrating")
+        self.audio_capture = capture
+
+    def _open_audio_stream(self):
+        return sr.Microphone(sample_rate=AudioCapture.SAMPLE_RATE, chunk_size=AudioCapture.CHUNK)
 
     def _save_user_name(self, name):
         try:
@@ -589,8 +3972,8 @@ class VirtualAssistant:
             except Exception: return None
         return None
 
-    def say_text(self, text):
-        if self.tts_enabled and text: self.tts_queue.put(text)
+    def say_text(self, text, priority=TTSScheduler.PRIORITY_NORMAL, generation=None):
+        if self.tts_enabled and text: self.tts.say(text, priority, generation)
 
     def open_application(self, command):
         match = (RE_OPEN_EN if self.language == 'en' else RE_OPEN_ES).search(command)
@@ -672,44 +4055,94 @@ class VirtualAssistant:
     LANGUAGE_MAP = {'english': 'en', 'inglés': 'en', 'spanish': 'es', 'español': 'es', 'french': 'fr', 'francés': 'fr', 'german': 'de', 'alemán': 'de'}
     def translate(self, text):
         if "exit translator mode" in text or "sal del modo traductor" in text:
-            self.translator_mode = False; self.translation_language = None
+            with self.mode_lock:
+                self.translator_mode = False; self.translation_language = None
             return "Exiting translator mode."
+        with self.mode_lock:
+            target = self.translation_language
         try:
-            return f"The translation is: {GoogleTranslator(source='auto', target=self.translation_language).translate(text=text)}"
+            return f"The translation is: {deep_translator.GoogleTranslator(source='auto', target=target).translate(text=text)}"
         except Exception: return "Sorry, I couldn't translate that."
 
     def start_translator_mode(self, command):
         match = re.search(r'(?:to|al)\s+([a-zA-Záéíóú]+)', command, flags=re.IGNORECASE)
         language = match.group(1).lower() if match else None
         if language in self.LANGUAGE_MAP:
-            self.translator_mode = True
-            self.translation_language = self.LANGUAGE_MAP[language]
+            with self.mode_lock:
+                self.translator_mode = True
+                self.translation_language = self.LANGUAGE_MAP[language]
             return f"Translator mode activated to {language}. Tell me what to translate."
         return f"I don't recognize the language '{language}'. Try English, French, Spanish or German."
 
 class App:
     def __init__(self, root):
         self.root = root
+        self._started_at = time.perf_counter()
         self.console_queue = queue.Queue()
         self._configure_logging()
         
-        self.assistant = VirtualAssistant(self)
+        self.assistant = VirtualAssistant(self, defer_startup=True)
         self.language = self.assistant.language
 
         self._setup_window()
         self.is_listening_continuously = self.assistant.config.get("wake_word_enabled", True)
         self.is_running = True
         self.tray_icon = None
-        self.chat_history = []
+        self._oldest_history_id = None
+        self._loading_history_page = False
+        self._stream_ids = itertools.count(1)
+        self._stream_timestamps = {}
+        self.voice_ready = False
+        self._submit_lock = threading.Lock()
+        self.requests = RequestScheduler(workers=self.assistant.config.get("request_workers", 3),
+                                         max_queued=self.assistant.config.get("request_queue_max", 8))
         
         self._setup_ui()
         self._setup_tray_icon()
         self._poll_console_queue()
+        if METRICS.enabled:
+            self._refresh_metrics_view()
 
-        self._load_history()
-        if self.is_listening_continuously:
-            self._start_continuous_listening()
-        if not self.chat_history or self.chat_history[-1]['tag'] == 'system':
+        # The window is shown right away; everything slow finishes in the background and
+        # enables the controls that depend on it (see _on_startup_stage).
+        self.startup = StartupScheduler(on_ready=lambda name, ok: self.root.after(0, self._on_startup_stage, name, ok),
+                                        started_at=self._started_at)
+        for name, stage, after in self.assistant.startup_stages():
+            self.startup.add(name, stage, after)
+        self.startup.add('greeting', self._greet, after=('database',))
+        self.startup.start()
+        self.root.after_idle(lambda: logging.info(f"Window shown {(time.perf_counter() - self._started_at) * 1000:.0f} ms after start."))
+        logging.info(import_time_report())
+        if self.assistant.config.get("lazy_import_prewarm", True):
+            self.root.after(int(self.assistant.config.get("lazy_import_prewarm_delay", 1.0) * 1000),
+                            lambda: Thread(target=prewarm_lazy_modules, daemon=True, name="prewarm-imports").start())
+
+    def _on_startup_stage(self, name, ok):
+        """Runs on the Tk thread when a startup stage ends."""
+        elapsed = f"{(time.perf_counter() - self._started_at) * 1000:.0f} ms"
+        if name == 'database' and ok:
+            self._load_history()
+        if name in ('database', 'skills') and all(stage in self.startup.finished_at for stage in ('database', 'skills')):
+            self.text_entry.config(state=tk.NORMAL)
+            self.send_button.config(state=tk.NORMAL)
+            self.text_entry.focus_set()
+            logging.info(f"Commands available {elapsed} after start.")
+        if name == 'microphone':
+            self.wake_word_button.config(state=tk.NORMAL)
+            if ok:
+                self.voice_ready = True
+                self._reactivate_button()
+                logging.info(f"Voice input available {elapsed} after start.")
+                if self.is_listening_continuously:
+                    self._start_continuous_listening()
+            else:
+                self.listen_button.config(text="🎙️ No microphone" if self.language == "en" else "🎙️ Sin micrófono")
+                self.add_text_to_chat("No microphone is available; voice commands are disabled.", is_assistant=False, tag='system')
+
+    def _greet(self):
+        # Only earlier runs count, so messages shown while starting up do not change the decision.
+        last = self.assistant.chat_history_store.earlier_runs_page(1)
+        if not last or last[-1]['tag'] == 'system':
             greeting = "Hello, briefly introduce yourself and explain that you are learning over time." if self.language == 'en' else "Hola, preséntate brevemente y explica que estás aprendiendo con el tiempo."
             self._handle_assistant_response_root(self.assistant._call_gemini_api(greeting))
 
@@ -727,24 +4160,22 @@ class App:
         logger.addHandler(queue_handler)
 
     def _poll_console_queue(self):
-        while not self.console_queue.empty():
-            try:
-                record = self.console_queue.get(block=False)
-                self._update_console_text(record)
-            except queue.Empty:
-                pass
+        self.console_renderer.drain()
         self.root.after(100, self._poll_console_queue)
 
-    def _update_console_text(self, text):
-        self.console_area.config(state='normal')
-        tag = "info"
-        if "ERROR" in text or "CRITICAL" in text:
-            tag = "error"
-        elif "WARNING" in text:
-            tag = "warning"
-        self.console_area.insert('end', text + '\n', tag)
-        self.console_area.config(state='disabled')
-        self.console_area.see('end')
+    def _refresh_metrics_view(self):
+        """Shows p50/p95 per pipeline stage above the log, once a second."""
+        stages, counters = METRICS.snapshot()
+        lines = [f"{'stage':<20}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}"]
+        lines += [f"{name:<20}{summary['count']:>6}{summary['p50'] * 1000:>10.1f}{summary['p95'] * 1000:>10.1f}"
+                  for name, summary in stages.items()]
+        if counters:
+            lines.append("  ".join(f"{name}: {value}" for name, value in sorted(counters.items())))
+        gauges = METRICS.gauges()
+        if gauges:
+            lines.append("  ".join(f"{name}: {value}" for name, value in sorted(gauges.items())))
+        self.metrics_label.config(text="\n".join(lines))
+        self.root.after(1000, self._refresh_metrics_view)
 
     def ask_user_confirmation(self, message):
         title = "Code Execution Confirmation"
@@ -758,32 +4189,77 @@ class App:
         self.root.protocol("WM_DELETE_WINDOW", self._handle_close)
 
     def _load_history(self):
-        if os.path.exists(VirtualAssistant.HISTORY_FILE):
-            try:
-                with open(VirtualAssistant.HISTORY_FILE, 'r', encoding='utf-8') as f:
-                    self.chat_history = json.load(f)
-                for entry in self.chat_history:
-                    self._add_history_text(entry)
-                self.add_text_to_chat("Chat history loaded.", is_assistant=False, tag='system')
-            except Exception as e:
-                logging.error(f"Could not load history: {e}")
-
-    def _add_history_text(self, entry):
+        """Renders the newest page of earlier runs above this run's messages; older pages are loaded when scrolling up."""
+        try:
+            entries = self.assistant.chat_history_store.earlier_runs_page(self.assistant.config.get("history_page_size", 50))
+        except sqlite3.Error as e:
+            logging.error(f"Could not load history: {e}")
+            return
+        if not entries:
+            return
+        self._oldest_history_id = entries[0].get('id')
         self.chat_area.config(state='normal')
-        tag = entry.get('tag', 'assistant' if entry['is_assistant'] else 'user')
-        you_text = "You" if self.language == "en" else "Tú"
-        prefix = f"[{entry.get('timestamp', '')}] {self.assistant.assistant_name if entry['is_assistant'] else you_text}: "
-        self.chat_area.insert('end', prefix, 'system')
-        self.chat_area.insert('end', entry['text'] + '\n\n', tag)
+        self.chat_area.insert('1.0', *self._history_insert_args(entries))
         self.chat_area.config(state='disabled')
         self.chat_area.see('end')
+        self.add_text_to_chat("Chat history loaded.", is_assistant=False, tag='system')
+
+    def _history_insert_args(self, entries):
+        # One Text.insert call with alternating (chars, tags) pairs, instead of two per message.
+        you_text = "You" if self.language == "en" else "Tú"
+        args = []
+        for entry in entries:
+            tag = entry.get('tag') or ('assistant' if entry['is_assistant'] else 'user')
+            args += [f"[{entry.get('timestamp', '')}] {self.assistant.assistant_name if entry['is_assistant'] else you_text}: ", ('system', ChatRenderer.MESSAGE_START)]
+            args += ChatRenderer.format(entry['text'], tag) + ['\n\n', tag]
+        return args
+
+    def _on_chat_scroll(self, first, last):
+        self.chat_area.vbar.set(first, last)
+        if float(first) <= 0.0 and self._oldest_history_id is not None and not self._loading_history_page:
+            self._loading_history_page = True
+            self.root.after_idle(self._load_older_history)
 
-    def _save_history(self):
+    def _load_older_history(self):
         try:
-            with open(VirtualAssistant.HISTORY_FILE, 'w', encoding='utf-8') as f:
-                json.dump(self.chat_history[-100:], f, indent=4)
-        except Exception as e:
-            logging.error(f"Could not save history: {e}")
+            entries = self.assistant.chat_history_store.page_before(self._oldest_history_id, self.assistant.config.get("history_page_size", 50))
+        except sqlite3.Error as e:
+            logging.error(f"Could not load older history: {e}")
+            entries = []
+        if not entries:
+            self._oldest_history_id = None
+            self._loading_history_page = False
+            return
+        self._oldest_history_id = entries[0]['id']
+        # Keep the message that was at the top in view while the page is prepended.
+        self.chat_area.mark_set('history_anchor', '@0,0')
+        self.chat_area.mark_gravity('history_anchor', 'right')
+        self.chat_area.config(state='normal')
+        self.chat_area.insert('1.0', *self._history_insert_args(entries))
+        self.chat_area.config(state='disabled')
+        self.chat_area.yview('history_anchor')
+        self.chat_area.mark_unset('history_anchor')
+        self._loading_history_page = False
+
+    def _open_history_search(self, event=None):
+        title = "Search history" if self.language == 'en' else "Buscar en el historial"
+        query = simpledialog.askstring(title, "Text to search:" if self.language == 'en' else "Texto a buscar:", parent=self.root)
+        if not query:
+            return "break"
+        try:
+            results = self.assistant.chat_history_store.search(query)
+        except sqlite3.Error as e:
+            logging.error(f"History search failed: {e}")
+            results = []
+        if not results:
+            self.add_text_to_chat(f"No past messages match '{query}'.", is_assistant=False, tag='system')
+            return "break"
+        lines = [f"[{r.get('created') or r['timestamp']}] {r['text'][:160]}" for r in results]
+        self.add_text_to_chat(f"{len(results)} past messages match '{query}':\n" + "\n".join(lines), is_assistant=False, tag='system')
+        return "break"
+
+    def _record_history(self, text, is_assistant, tag, timestamp):
+        self.assistant.chat_history_store.append({'text': str(text), 'is_assistant': is_assistant, 'tag': tag, 'timestamp': timestamp})
 
     def _setup_tray_icon(self):
         if pystray and Image:
@@ -814,7 +4290,7 @@ class App:
     def _open_settings_window(self):
         settings_win = tk.Toplevel(self.root)
         settings_win.title("Advanced Settings")
-        settings_win.geometry("450x450")
+        settings_win.geometry("450x540")
         BG_COLOR, FG_COLOR = "#212121", "#e0e0e0"
         ACCENT_COLOR, BUTTON_COLOR = "#61dafb", "#424242"
         settings_win.configure(bg=BG_COLOR)
@@ -844,11 +4320,23 @@ class App:
         def update_voice():
             if self.assistant.voices:
                 self.assistant.voice_index = (self.assistant.voice_index + 1) % len(self.assistant.voices)
-                self.assistant.tts_queue.put({'action': 'change_voice', 'index': self.assistant.voice_index})
+                self.assistant.change_voice(self.assistant.voice_index)
                 voice_label.config(text=f"Current Voice ID: {self.assistant.voice_index + 1}")
         
         tk.Button(voice_frame, text="Change Voice", command=update_voice, bg=BUTTON_COLOR, fg=ACCENT_COLOR, relief="flat").pack(side=tk.RIGHT, padx=5)
 
+        # Offline wake word
+        wake_frame = tk.LabelFrame(settings_win, text="Wake Word (offline)", font=("Segoe UI", 11, "bold"), bg=BG_COLOR, fg=FG_COLOR, padx=10, pady=10)
+        wake_frame.pack(pady=10, padx=10, fill='x')
+        tk.Label(wake_frame, text=f"Phrase: '{self.assistant.active_wake_word}'", bg=BG_COLOR, fg=FG_COLOR).pack(side=tk.LEFT, padx=5)
+
+        def record_wake_word():
+            def run():
+                self.add_text_to_chat(self.assistant.enroll_wake_word(), is_assistant=False, tag='system')
+            Thread(target=run, daemon=True).start()
+
+        tk.Button(wake_frame, text="Record Wake Word", command=record_wake_word, bg=BUTTON_COLOR, fg=ACCENT_COLOR, relief="flat").pack(side=tk.RIGHT, padx=5)
+
         # Credentials
         api_frame = tk.LabelFrame(settings_win, text="Credentials", font=("Segoe UI", 11, "bold"), bg=BG_COLOR, fg=FG_COLOR, padx=10, pady=10)
         api_frame.pack(pady=10, padx=10, fill='x')
@@ -966,18 +4454,30 @@ class App:
         self.chat_area.tag_config('user', foreground='#b0b0b0')
         self.chat_area.tag_config('system', foreground='#FFC107', font=(FONT_NAME, 10, "italic"))
         self.chat_area.tag_config('user_invoked', foreground=FG_COLOR)
+        self.chat_area.tag_config('partial', foreground='#808080', font=(FONT_NAME, FONT_SIZE, "italic"))
+        self.chat_area.tag_config('md_bold', foreground='#ffffff', font=(FONT_NAME, FONT_SIZE, "bold"))
+        self.chat_area.tag_config('md_italic', font=(FONT_NAME, FONT_SIZE, "italic"))
+        self.chat_area.tag_config('md_code', font=("Consolas", FONT_SIZE - 1), background='#2d2d2d')
+        self.chat_area.config(yscrollcommand=self._on_chat_scroll)
+        self.chat_renderer = ChatRenderer(self.chat_area, max_lines=self.assistant.config.get("chat_max_lines", 3000), on_trim=self._on_chat_trimmed)
+        self.root.bind("<Control-f>", self._open_history_search)
         
         input_frame = tk.Frame(main_frame, bg=BG_COLOR)
         input_frame.pack(fill="x", pady=(0, 10))
         self.text_entry = tk.Entry(input_frame, font=(FONT_NAME, 12), bg=CHAT_BG, fg=FG_COLOR, bd=0, relief="flat", insertbackground=FG_COLOR)
         self.text_entry.pack(side=tk.LEFT, fill="x", expand=True, padx=(0, 5), ipady=8)
         self.text_entry.bind("<Return>", self._process_text_entry)
-        tk.Button(input_frame, text=send_button_text, command=lambda: self._process_text_entry(None), font=(FONT_NAME, 10, "bold"), bg=ACCENT_BLUE, fg="white", relief="flat", padx=15, pady=5).pack(side=tk.RIGHT)
+        self.send_button = tk.Button(input_frame, text=send_button_text, command=lambda: self._process_text_entry(None), font=(FONT_NAME, 10, "bold"), bg=ACCENT_BLUE, fg="white", relief="flat", padx=15, pady=5)
+        self.send_button.pack(side=tk.RIGHT)
+        # Enabled by _on_startup_stage once the stages they need are done.
+        self.text_entry.config(state=tk.DISABLED)
+        self.send_button.config(state=tk.DISABLED)
         
         ptt_frame = tk.Frame(main_frame, bg=BG_COLOR)
         ptt_frame.pack(fill="x", pady=(5, 5))
         self.listen_button = tk.Button(ptt_frame, text=ptt_button_text, command=self._start_listening_thread, font=(FONT_NAME, 12, "bold"), bg=BUTTON_COLOR, fg="white", relief="flat", padx=15, pady=10)
         self.listen_button.pack(side=tk.LEFT, expand=True, fill="x")
+        self.listen_button.config(state=tk.DISABLED, text="🎙️ Starting..." if self.language == "en" else "🎙️ Iniciando...")
         
         toggle_frame = tk.Frame(main_frame, bg=BG_COLOR)
         toggle_frame.pack(pady=(5, 0), fill="x")
@@ -996,44 +4496,74 @@ class App:
         wake_status = wake_word_on_text if self.is_listening_continuously else wake_word_off_text
         self.wake_word_button = tk.Button(toggle_frame, text=wake_status, command=self._toggle_wake_word, font=(FONT_NAME, 10, "bold"), bg=wake_color, fg="white", relief="flat", padx=10, pady=5)
         self.wake_word_button.pack(side=tk.RIGHT, padx=(5, 0), expand=True)
+        self.wake_word_button.config(state=tk.DISABLED)
         
         console_tab_frame = ttk.Frame(notebook, style="TFrame")
         notebook.add(console_tab_frame, text=console_tab_text)
+        level_frame = tk.Frame(console_tab_frame, bg=BG_COLOR)
+        level_frame.pack(fill="x", padx=5, pady=(5, 0))
+        tk.Label(level_frame, text="Level:" if self.language == "en" else "Nivel:", bg=BG_COLOR, fg=FG_COLOR).pack(side=tk.LEFT)
+        self.console_level_var = tk.StringVar(value="INFO")
+        level_menu = tk.OptionMenu(level_frame, self.console_level_var, "DEBUG", "INFO", "WARNING", "ERROR",
+                                   command=lambda name: self.console_renderer.set_level(logging.getLevelName(name)))
+        level_menu.config(bg=BUTTON_COLOR, fg=FG_COLOR, relief="flat", highlightthickness=0)
+        level_menu.pack(side=tk.LEFT, padx=5)
+        self.metrics_label = tk.Label(console_tab_frame, text="", font=("Consolas", 9), bg=BG_COLOR, fg="#61dafb", justify=tk.LEFT, anchor='w')
+        if METRICS.enabled:
+            self.metrics_label.pack(fill="x", padx=5, pady=(5, 0))
         self.console_area = scrolledtext.ScrolledText(console_tab_frame, wrap='char', font=("Consolas", 9), bg="#101010", fg="#c0c0c0", bd=0, relief="flat")
         self.console_area.pack(fill="both", expand=True, padx=5, pady=5)
         self.console_area.tag_config('info', foreground="#c0c0c0")
         self.console_area.tag_config('warning', foreground="#FFC107")
         self.console_area.tag_config('error', foreground="#F44336")
         self.console_area.config(state='disabled')
+        self.console_renderer = ConsoleRenderer(
+            self.console_area, self.console_queue,
+            max_lines=self.assistant.config.get("console_max_lines", 2000),
+            max_lines_per_frame=self.assistant.config.get("console_max_lines_per_frame", 200),
+        )
 
     def _process_text_entry(self, event=None):
         command = self.text_entry.get().strip()
         if not command: return
         self.text_entry.delete(0, tk.END)
+        self.assistant.interrupt_speech()
         self.add_text_to_chat(command, is_assistant=False)
-        Thread(target=self._execute_logic_in_thread, args=(command,), daemon=True).start()
+        self._submit_command(command)
+
+    def _submit_command(self, command):
+        """Queues a typed or transcribed command on the request scheduler. Thread-safe."""
+        lane, supersedable, changes_mode = self.assistant.request_lane(command)
+        with self._submit_lock:
+            # Behind a pending command such as "take a note" or "translate to", the mode this command
+            # will run in is not known yet: it may be note text, so it must neither overtake nor be dropped.
+            if self.requests.has_barrier('default', 'conversation'):
+                lane, supersedable = 'conversation', False
+            # Replies to local commands are short and are spoken ahead of any queued LLM sentences.
+            priority = TTSScheduler.PRIORITY_HIGH if lane == 'local' else TTSScheduler.PRIORITY_NORMAL
+            self.requests.submit(self._execute_logic_in_thread, command, priority, lane=lane,
+                                 supersedable=supersedable, barrier=changes_mode)
 
-    def _on_speech_finished(self, name, completed):
-        self.root.after(0, self._on_speech_finished_thread_safe, completed)
+    def _on_speech_finished(self):
+        self.root.after(0, self._on_speech_finished_thread_safe)
 
-    def _on_speech_finished_thread_safe(self, completed):
-        if completed:
-            self.assistant.tts_is_speaking = False
-            logging.info("TTS has finished speaking.")
-            self._reactivate_button()
+    def _on_speech_finished_thread_safe(self):
+        logging.info("TTS has finished speaking.")
+        self._reactivate_button()
 
     def _on_wake_word_detected(self):
+        self.assistant.interrupt_speech()
         self.root.lift()
         self.root.focus_force()
         self.listen_button.config(state=tk.DISABLED, text="Detected...")
         self.add_text_to_chat(f"{self.assistant.assistant_name} is listening!", is_assistant=False, tag='system')
-        Thread(target=lambda: self._execute_voice_logic_in_thread(was_by_wake_word=True), daemon=True).start()
+        self.requests.submit(self._execute_voice_logic_in_thread, True, lane='voice', supersedable=True)
 
     def _start_continuous_listening(self):
         self.is_listening_continuously = True
         self.assistant.config["wake_word_enabled"] = True
         self.assistant.save_configuration()
-        self.assistant.wake_word_thread = Thread(target=self.assistant._listen_for_wake_word_loop_sr, daemon=True)
+        self.assistant.wake_word_thread = Thread(target=self.assistant.run_wake_word_loop, daemon=True)
         self.assistant.wake_word_thread.start()
 
     def _stop_continuous_listening(self):
@@ -1069,50 +4599,71 @@ class App:
         self.add_text_to_chat(status_msg, is_assistant=False, tag='system')
 
     def add_text_to_chat(self, text, is_assistant=True, tag=None):
-        self.root.after(0, self._add_text, text, is_assistant, tag)
-
-    def _add_text(self, text, is_assistant, tag):
-        self.chat_area.config(state='normal')
+        """Queues a message for the next chat frame. Thread-safe."""
         if tag is None: tag = 'assistant' if is_assistant else 'user'
         timestamp = datetime.datetime.now().strftime('%H:%M:%S')
         
         you_text = "You" if self.language == "en" else "Tú"
         prefix = f"[{timestamp}] {self.assistant.assistant_name if is_assistant else you_text}: "
-        
-        self.chat_area.insert('end', prefix, 'system')
-        self.chat_area.insert('end', str(text) + '\n\n', tag)
+        self.chat_renderer.add_message(prefix, str(text), tag)
         if tag != 'system':
-            self.chat_history.append({'text': str(text), 'is_assistant': is_assistant, 'tag': tag, 'timestamp': timestamp})
-        self.chat_area.config(state='disabled')
-        self.chat_area.see('end')
+            self._record_history(text, is_assistant, tag, timestamp)
+
+    def show_partial_transcript(self, text):
+        """Replaces the provisional line that shows what the recognizer has heard so far. Thread-safe."""
+        self.chat_renderer.set_partial(text)
+
+    def clear_partial_transcript(self):
+        self.chat_renderer.set_partial(None)
+
+    def begin_stream_message(self):
+        """Opens an assistant message that will be filled in by append_stream_text. Thread-safe."""
+        stream_id = f"stream_{next(self._stream_ids)}"
+        timestamp = datetime.datetime.now().strftime('%H:%M:%S')
+        self._stream_timestamps[stream_id] = timestamp
+        self.chat_renderer.begin_stream(stream_id, f"[{timestamp}] {self.assistant.assistant_name}: ")
+        return stream_id
+
+    def append_stream_text(self, stream_id, text):
+        self.chat_renderer.append_stream(stream_id, text)
+
+    def end_stream_message(self, stream_id, full_text):
+        self.chat_renderer.end_stream(stream_id)
+        self._record_history(full_text, True, 'assistant', self._stream_timestamps.pop(stream_id, ''))
+
+    def _on_chat_trimmed(self):
+        # The oldest rendered messages were dropped, so prepending older pages would leave a gap.
+        # They are still in the database and can be found with Ctrl+F.
+        self._oldest_history_id = None
 
     def _start_listening_thread(self):
+        self.assistant.interrupt_speech()
         self.listen_button.config(state=tk.DISABLED, text="Listening...")
-        Thread(target=lambda: self._execute_voice_logic_in_thread(was_by_wake_word=False), daemon=True).start()
+        self.requests.submit(self._execute_voice_logic_in_thread, False, lane='voice', supersedable=True)
 
     def _execute_voice_logic_in_thread(self, was_by_wake_word=True):
-        command = self.assistant.listen_for_command()
+        # Only the capture runs in the voice lane; the microphone is free again while the command is processed.
+        command = self.assistant.listen_for_command(after_wake_word=was_by_wake_word)
         if command and "error_" not in command and "timeout" not in command:
             tag = 'user_invoked' if was_by_wake_word else 'user'
-            self.root.after(0, lambda: self.add_text_to_chat(command, is_assistant=False, tag=tag))
-        response = self.assistant.process_command(command)
-        self._handle_assistant_response_root(response)
+            self.add_text_to_chat(command, is_assistant=False, tag=tag)
+        self._submit_command(command)
 
-    def _execute_logic_in_thread(self, command):
+    def _execute_logic_in_thread(self, command, priority=TTSScheduler.PRIORITY_NORMAL):
         response = self.assistant.process_command(command)
-        self._handle_assistant_response_root(response)
+        self._handle_assistant_response_root(response, priority)
 
-    def _handle_assistant_response_root(self, text):
-        self.root.after(0, self.__handle_assistant_response_sync, text)
+    def _handle_assistant_response_root(self, text, priority=TTSScheduler.PRIORITY_NORMAL):
+        self.root.after(0, self.__handle_assistant_response_sync, text, priority)
 
-    def __handle_assistant_response_sync(self, text):
+    def __handle_assistant_response_sync(self, text, priority):
         if text:
             self.add_text_to_chat(text)
-            self.assistant.say_text(text)
+            self.assistant.say_text(text, priority)
         self._reactivate_button()
 
     def _reactivate_button(self):
-        if not self.assistant.tts_is_speaking:
+        if self.voice_ready and not self.assistant.tts_is_speaking:
             ptt_button_text = "🎙️ Speak (PTT)" if self.language == "en" else "🎙️ Hablar (PTT)"
             self.listen_button.config(state=tk.NORMAL, text=ptt_button_text)
 
@@ -1120,16 +4671,33 @@ class App:
         logging.info("Initiating closing sequence...")
         self.is_running = False
         self.assistant.is_running = False
+        self.requests.close()
         if self.assistant.wake_word_thread and self.assistant.wake_word_thread.is_alive():
             self.assistant.wake_word_thread.join(timeout=1)
         self.assistant.save_configuration()
-        self._save_history()
+        METRICS.stop_export()
+        logging.info(f"TTS latency: {self.assistant.tts.latency_summary()}")
+        if self.assistant.tts.audio_cache:
+            logging.info(f"Phrase audio cache stats: {self.assistant.tts.audio_cache.stats}")
+        self.assistant.tts.close()
+        if self.assistant.audio_capture:
+            self.assistant.audio_capture.stop()
+        self.assistant.fact_queue.close()
+        if self.assistant.memory:
+            self.assistant.memory.close()
+        self.assistant.gemini.close()
+        if self.assistant.skill_pool:
+            self.assistant.skill_pool.close()
+        if self.assistant.response_cache:
+            logging.info(f"Response cache stats: {self.assistant.response_cache.stats}")
+            self.assistant.response_cache.close()
         if self.tray_icon: self.tray_icon.stop()
         self.root.destroy()
         logging.info("Application closed successfully.")
         os._exit(0)
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     try:
         root = tk.Tk()
         app = App(root)